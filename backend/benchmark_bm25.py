@@ -0,0 +1,130 @@
+"""
+BM25ベンチマーク
+rank_bm25（全件スコアリング）と BM25Index（転置インデックス）の構築時間・検索レイテンシを比較する
+backendディレクトリから実行すること
+
+    python benchmark_bm25.py                      # 10k / 100k / 1M チャンク
+    python benchmark_bm25.py --sizes 10000 100000 --baseline-max 100000
+"""
+import argparse
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from bm25_index import BM25Index
+
+
+def make_corpus(size: int, vocab_size: int, doc_length: int, seed: int):
+    """Zipf分布に従う単語からなる疑似チャンクを生成"""
+    rng = np.random.default_rng(seed)
+    vocab = [f"t{i}" for i in range(vocab_size)]
+    lengths = rng.integers(doc_length // 2, doc_length * 3 // 2, size=size)
+    term_ids = (rng.zipf(1.2, size=int(lengths.sum())) - 1) % vocab_size
+    corpus = []
+    start = 0
+    for length in lengths:
+        corpus.append([vocab[i] for i in term_ids[start:start + length]])
+        start += length
+    return vocab, corpus
+
+
+def make_queries(vocab, count: int, seed: int):
+    """出現頻度の高い語と低い語を混ぜたクエリを生成"""
+    rng = np.random.default_rng(seed + 1)
+    queries = []
+    for _ in range(count):
+        common = rng.integers(0, 200, size=1)
+        rare = rng.integers(200, len(vocab), size=rng.integers(2, 5))
+        queries.append([vocab[i] for i in np.concatenate([common, rare])])
+    return queries
+
+
+def measure(search, queries):
+    """1クエリあたりのレイテンシ（ミリ秒）の平均とp95"""
+    latencies = []
+    for query in queries:
+        started_at = time.perf_counter()
+        search(query)
+        latencies.append((time.perf_counter() - started_at) * 1000)
+    latencies.sort()
+    return statistics.mean(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+def run(size: int, args) -> None:
+    print(f"\n[{size:,} chunks]")
+    vocab, corpus = make_corpus(size, args.vocab_size, args.doc_length, args.seed)
+    queries = make_queries(vocab, args.queries, args.seed)
+    ids = [str(i) for i in range(size)]
+
+    # BM25Index
+    started_at = time.perf_counter()
+    index = BM25Index()
+    index.add(ids, corpus)
+    build_sec = time.perf_counter() - started_at
+    mean_ms, p95_ms = measure(lambda q: index.search(q, args.top_n), queries)
+    print(f"BM25Index  build {build_sec:8.2f}s  query mean {mean_ms:9.3f}ms  p95 {p95_ms:9.3f}ms")
+
+    # 保存と読み込み（起動時の読み込みに相当）
+    with tempfile.TemporaryDirectory() as directory:
+        started_at = time.perf_counter()
+        index.save(directory)
+        save_sec = time.perf_counter() - started_at
+        started_at = time.perf_counter()
+        loaded = BM25Index.load(directory)
+        load_sec = time.perf_counter() - started_at
+        mean_ms, p95_ms = measure(lambda q: loaded.search(q, args.top_n), queries)
+        print(f"BM25Index  save  {save_sec:8.2f}s  load {load_sec:8.2f}s  query mean {mean_ms:9.3f}ms  (loaded)")
+
+    if size > args.baseline_max:
+        print(f"rank_bm25  skipped (--baseline-max {args.baseline_max:,})")
+        return
+
+    # rank_bm25（従来の実装: 全件スコアリング後にソート）
+    started_at = time.perf_counter()
+    baseline = BM25Okapi(corpus)
+    build_sec = time.perf_counter() - started_at
+
+    def baseline_search(query):
+        scores = baseline.get_scores(query)
+        return sorted(zip(ids, scores), key=lambda x: x[1], reverse=True)[:args.top_n]
+
+    baseline_queries = queries[:args.baseline_queries]
+    mean_ms, p95_ms = measure(baseline_search, baseline_queries)
+    print(f"rank_bm25  build {build_sec:8.2f}s  query mean {mean_ms:9.3f}ms  p95 {p95_ms:9.3f}ms")
+
+    # 上位の一致率（同点の順序の違いは許容）
+    overlaps = []
+    for query in baseline_queries:
+        expected = {chunk_id for chunk_id, score in baseline_search(query) if score > 0}
+        actual = {chunk_id for chunk_id, _ in index.search(query, args.top_n)}
+        if expected:
+            overlaps.append(len(expected & actual) / len(expected))
+    if overlaps:
+        print(f"top-{args.top_n} overlap with rank_bm25: {statistics.mean(overlaps):.3f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="BM25 benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-n", type=int, default=15)
+    parser.add_argument("--vocab-size", type=int, default=50_000)
+    parser.add_argument("--doc-length", type=int, default=120)
+    parser.add_argument("--baseline-max", type=int, default=1_000_000,
+                        help="rank_bm25 を計測する最大チャンク数（大規模では構築に時間とメモリを要する）")
+    parser.add_argument("--baseline-queries", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print("BM25 Benchmark")
+    print("=" * 50)
+    for size in args.sizes:
+        run(size, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,547 @@
+"""
+BM25インデックス - 転置インデックスを使い、クエリ語を含むチャンクだけをスコアリングするBM25（Okapi）
+"""
+import hashlib
+import json
+import os
+import threading
+import uuid
+from array import array
+from collections import Counter
+from datetime import datetime
+from itertools import repeat
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# 未マージのポスティングがこの件数（または圧縮済みポスティングの一定割合）を超えたらマージする
+_MERGE_MIN_POSTINGS = 50_000
+_MERGE_RATIO = 0.25
+
+# 保存形式のバージョン（配列の構成を変えたら上げる）
+_FORMAT_VERSION = 2
+_MANIFEST_NAME = "manifest.json"
+# メモリマップで読み込む配列（それ以外は書き換えるためメモリに読み込む）
+_MMAP_ARRAYS = ("offsets", "post_slots", "post_freqs", "doc_term_offsets", "doc_term_ids")
+
+
+class BM25Index:
+    """
+    差分更新に対応したBM25インデックス
+
+    ポスティングは単語ごとに連続したNumPy配列（CSR形式）で保持する。
+    追加されたチャンクは未マージのポスティングに、削除されたチャンクはトゥームストーンとして記録し、
+    一定量たまったらまとめて圧縮済みポスティングへマージする。
+    文書頻度・平均文書長はその場で更新するため、追加・削除のコストは対象チャンク数に比例する。
+    スコア計算は rank_bm25.BM25Okapi と同じ式を用いる。
+
+    チャンクはIDで管理し、本文やメタデータは保持しない（検索結果はIDで返す）。
+    タグはタグごとのビットセット（スロット番号のビット）で保持し、検索時の候補の絞り込みに使う。
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        """
+        Args:
+            k1: 単語頻度の飽和パラメータ
+            b: 文書長による正規化の強さ
+            epsilon: 負のIDFを置き換える際の平均IDFに対する係数
+        """
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self) -> None:
+        """インデックスを空の状態に初期化"""
+        # 語彙: 単語 -> 単語ID、単語IDごとの文書頻度
+        self._vocab: Dict[str, int] = {}
+        self._df = np.zeros(0, dtype=np.int32)
+
+        # スロット番号ごとのチャンク情報（削除済みスロットはマージ時に詰める）
+        self._ids: List[Optional[str]] = []
+        self._doc_lengths = np.zeros(0, dtype=np.float32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._slot_of: Dict[str, int] = {}
+        self._live_count = 0
+        self._total_length = 0
+        # チャンクIDのハッシュのXOR（コレクションとの整合性確認用）
+        self._id_digest = 0
+
+        # 圧縮済みポスティング: 単語IDの範囲 offsets[t]:offsets[t+1] がその単語のスロットと出現回数
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._post_slots = np.zeros(0, dtype=np.int32)
+        self._post_freqs = np.zeros(0, dtype=np.float32)
+
+        # スロットごとの単語ID（削除時に文書頻度を戻すため）
+        # マージ済みのスロットはCSR形式、それ以降に追加されたスロットはリストで保持
+        self._doc_term_offsets = np.zeros(1, dtype=np.int64)
+        self._doc_term_ids = np.zeros(0, dtype=np.int32)
+        self._pending_doc_terms: List[np.ndarray] = []
+
+        # タグ -> タグ番号、タグ番号ごとのビットセット（スロット番号 s のビットは s >> 3 バイト目の 1 << (s & 7)）
+        self._tag_ids: Dict[str, int] = {}
+        self._tag_bits = np.zeros((0, 0), dtype=np.uint8)
+
+        # 未マージのポスティング: 単語ID -> (スロット, 出現回数)
+        self._pending: Dict[int, Tuple[array, array]] = {}
+        self._pending_count = 0
+
+        # 単語IDごとのIDF（更新後の最初の検索で再計算）
+        self._idf_cache: Optional[np.ndarray] = None
+        self.merge_count = 0
+
+    def __len__(self) -> int:
+        return self._live_count
+
+    @staticmethod
+    def _hash_id(chunk_id: str) -> int:
+        return int.from_bytes(hashlib.blake2b(chunk_id.encode("utf-8"), digest_size=8).digest(), "big")
+
+    @staticmethod
+    def version_of(chunk_ids: Iterable[str]) -> str:
+        """
+        チャンクIDの集合からバージョン文字列を計算（順序に依存しない）
+
+        Args:
+            chunk_ids: チャンクID
+
+        Returns:
+            "件数-ダイジェスト" 形式の文字列
+        """
+        count = 0
+        digest = 0
+        for chunk_id in chunk_ids:
+            digest ^= BM25Index._hash_id(chunk_id)
+            count += 1
+        return f"{count}-{digest:016x}"
+
+    @property
+    def version(self) -> str:
+        """インデックスに含まれるチャンクIDの集合に対応するバージョン文字列"""
+        with self._lock:
+            return f"{self._live_count}-{self._id_digest:016x}"
+
+    def add(self, chunk_ids: Iterable[str], token_lists: Iterable[List[str]],
+            tag_lists: Iterable[Iterable[str]] = None) -> None:
+        """
+        チャンクを追加（同じIDが既にある場合は置き換える）
+
+        Args:
+            chunk_ids: チャンクID
+            token_lists: トークン化済みのチャンク
+            tag_lists: チャンクごとのタグ（省略時はタグなし）
+        """
+        # 同じバッチ内でIDが重複する場合は後のものを採用
+        chunk_ids = list(chunk_ids)
+        batch = dict(zip(chunk_ids, token_lists))
+        if not batch:
+            return
+        tags_of = dict(zip(chunk_ids, tag_lists)) if tag_lists is not None else {}
+
+        with self._lock:
+            vocab = self._vocab
+            batch_words = []
+            slots, freqs = array("i"), array("f")
+            bounds = []
+            lengths = []
+            first_slot = len(self._ids)
+            for chunk_id, tokens in batch.items():
+                if chunk_id in self._slot_of:
+                    self._remove_one(chunk_id)
+                slot = len(self._ids)
+                counts = Counter(tokens)
+                start = len(batch_words)
+                batch_words.extend(counts)
+                freqs.extend(counts.values())
+                slots.extend(repeat(slot, len(counts)))
+                bounds.append((start, len(batch_words)))
+                lengths.append(len(tokens))
+                self._ids.append(chunk_id)
+                self._slot_of[chunk_id] = slot
+                self._id_digest ^= self._hash_id(chunk_id)
+
+            for word in dict.fromkeys(batch_words):
+                if word not in vocab:
+                    vocab[word] = len(vocab)
+            batch_terms = np.fromiter(map(vocab.__getitem__, batch_words), dtype=np.int32, count=len(batch_words))
+            self._ensure_vocab_capacity(len(vocab))
+            self._ensure_doc_capacity(len(self._ids))
+            self._df[:len(vocab)] += np.bincount(batch_terms, minlength=len(vocab)).astype(np.int32)
+            self._doc_lengths[first_slot:len(self._ids)] = lengths
+            self._alive[first_slot:len(self._ids)] = True
+            self._pending_doc_terms.extend(batch_terms[start:end] for start, end in bounds)
+            self._set_tags((self._slot_of[chunk_id], tags) for chunk_id, tags in tags_of.items())
+            self._live_count += len(batch)
+            self._total_length += sum(lengths)
+            self._idf_cache = None
+
+            if self._pending_count + len(batch_terms) > self._merge_threshold():
+                # 大きなバッチは未マージのポスティングを経由せず直接マージする
+                self._merge((batch_terms, np.array(slots, dtype=np.int32), np.array(freqs, dtype=np.float32)))
+            else:
+                pending = self._pending
+                for term_id, slot, freq in zip(batch_terms.tolist(), slots, freqs):
+                    entry = pending.get(term_id)
+                    if entry is None:
+                        entry = pending[term_id] = (array("i"), array("f"))
+                    entry[0].append(slot)
+                    entry[1].append(freq)
+                self._pending_count += len(batch_terms)
+
+    def remove(self, chunk_ids: Iterable[str]) -> int:
+        """
+        チャンクを削除
+
+        Args:
+            chunk_ids: 削除するチャンクID
+
+        Returns:
+            削除したチャンク数
+        """
+        removed = 0
+        with self._lock:
+            for chunk_id in chunk_ids:
+                if chunk_id in self._slot_of:
+                    self._remove_one(chunk_id)
+                    removed += 1
+            if removed:
+                self._idf_cache = None
+                if self._needs_merge():
+                    self._merge()
+        return removed
+
+    def _remove_one(self, chunk_id: str) -> None:
+        """チャンクを1件削除（ポスティングはマージ時に除去）"""
+        slot = self._slot_of.pop(chunk_id)
+        self._df[self._doc_terms(slot)] -= 1
+        self._total_length -= int(self._doc_lengths[slot])
+        self._live_count -= 1
+        self._alive[slot] = False
+        self._ids[slot] = None
+        self._id_digest ^= self._hash_id(chunk_id)
+
+    def _doc_terms(self, slot: int) -> np.ndarray:
+        """スロットに含まれる単語ID"""
+        merged = len(self._doc_term_offsets) - 1
+        if slot < merged:
+            return self._doc_term_ids[self._doc_term_offsets[slot]:self._doc_term_offsets[slot + 1]]
+        return self._pending_doc_terms[slot - merged]
+
+    def clear(self) -> None:
+        """すべてのチャンクを削除"""
+        with self._lock:
+            self._reset()
+
+    def _ensure_doc_capacity(self, size: int) -> None:
+        if size > len(self._doc_lengths):
+            capacity = max(size, len(self._doc_lengths) * 2, 1024)
+            doc_lengths = np.zeros(capacity, dtype=np.float32)
+            doc_lengths[:len(self._doc_lengths)] = self._doc_lengths
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:len(self._alive)] = self._alive
+            self._doc_lengths, self._alive = doc_lengths, alive
+        width = (len(self._doc_lengths) + 7) // 8
+        if self._tag_bits.shape[1] < width:
+            tag_bits = np.zeros((len(self._tag_bits), width), dtype=np.uint8)
+            tag_bits[:, :self._tag_bits.shape[1]] = self._tag_bits
+            self._tag_bits = tag_bits
+
+    def _set_tags(self, slot_tags: Iterable[Tuple[int, Iterable[str]]]) -> None:
+        """スロットのタグのビットを立てる"""
+        rows, slots = [], []
+        for slot, tags in slot_tags:
+            for tag in tags:
+                tag_id = self._tag_ids.get(tag)
+                if tag_id is None:
+                    tag_id = self._tag_ids[tag] = len(self._tag_ids)
+                rows.append(tag_id)
+                slots.append(slot)
+        if not rows:
+            return
+        if len(self._tag_ids) > len(self._tag_bits):
+            tag_bits = np.zeros((len(self._tag_ids), self._tag_bits.shape[1]), dtype=np.uint8)
+            tag_bits[:len(self._tag_bits)] = self._tag_bits
+            self._tag_bits = tag_bits
+        slots = np.array(slots, dtype=np.int64)
+        np.bitwise_or.at(self._tag_bits, (np.array(rows), slots >> 3),
+                         np.left_shift(1, slots & 7).astype(np.uint8))
+
+    def _tag_filter_bits(self, tags: Iterable[str]) -> np.ndarray:
+        """いずれかのタグを持つスロットのビットセット"""
+        rows = [self._tag_ids[tag] for tag in tags if tag in self._tag_ids]
+        if not rows:
+            return np.zeros(self._tag_bits.shape[1], dtype=np.uint8)
+        return np.bitwise_or.reduce(self._tag_bits[rows], axis=0)
+
+    def _ensure_vocab_capacity(self, size: int) -> None:
+        if size > len(self._df):
+            df = np.zeros(max(size, len(self._df) * 2, 1024), dtype=np.int32)
+            df[:len(self._df)] = self._df
+            self._df = df
+
+    def _merge_threshold(self) -> int:
+        return max(_MERGE_MIN_POSTINGS, int(len(self._post_slots) * _MERGE_RATIO))
+
+    def _needs_merge(self) -> bool:
+        """未マージのポスティングまたは削除済みスロットが一定量を超えたか"""
+        dead = len(self._ids) - self._live_count
+        return (self._pending_count > self._merge_threshold()
+                or dead > max(1024, int(self._live_count * _MERGE_RATIO)))
+
+    def _merge(self, extra: Tuple[np.ndarray, np.ndarray, np.ndarray] = None) -> None:
+        """
+        未マージのポスティングを取り込み、削除済みスロットを詰めて圧縮済みポスティングを再構築
+
+        Args:
+            extra: 併せて取り込む(単語ID, スロット, 出現回数)の配列
+        """
+        slot_count = len(self._ids)
+        alive = self._alive[:slot_count]
+        new_slots = (np.cumsum(alive) - 1).astype(np.int32)
+
+        vocab_size = len(self._vocab)
+        terms = [np.repeat(np.arange(len(self._offsets) - 1, dtype=np.int32), np.diff(self._offsets))]
+        slots = [self._post_slots]
+        freqs = [self._post_freqs]
+        for term_id, (pending_slots, pending_freqs) in self._pending.items():
+            terms.append(np.full(len(pending_slots), term_id, dtype=np.int32))
+            slots.append(np.frombuffer(pending_slots, dtype=np.int32))
+            freqs.append(np.frombuffer(pending_freqs, dtype=np.float32))
+        if extra is not None:
+            terms.append(extra[0])
+            slots.append(extra[1])
+            freqs.append(extra[2])
+        terms = np.concatenate(terms)
+        slots = np.concatenate(slots)
+        freqs = np.concatenate(freqs)
+
+        # 削除済みスロットのポスティングを除去し、スロット番号を詰める
+        keep = alive[slots]
+        terms, slots, freqs = terms[keep], new_slots[slots[keep]], freqs[keep]
+        live_count = int(alive.sum())
+
+        # スロット番号は追加順に増加するため、単語IDの安定ソートだけで(単語, スロット)順になる
+        order = np.argsort(terms, kind="stable")
+        offsets = np.zeros(vocab_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=vocab_size), out=offsets[1:])
+        self._offsets = offsets
+        self._post_slots = slots[order]
+        self._post_freqs = freqs[order]
+
+        order = np.argsort(slots, kind="stable")
+        doc_term_offsets = np.zeros(live_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(slots, minlength=live_count), out=doc_term_offsets[1:])
+        self._doc_term_offsets = doc_term_offsets
+        self._doc_term_ids = terms[order]
+        self._pending_doc_terms = []
+
+        self._pending = {}
+        self._pending_count = 0
+        self.merge_count += 1
+
+        if live_count != slot_count:
+            live_slots = np.flatnonzero(alive)
+            self._ids = [self._ids[i] for i in live_slots]
+            self._doc_lengths = self._doc_lengths[live_slots]
+            self._alive = np.ones(live_count, dtype=bool)
+            self._slot_of = {chunk_id: slot for slot, chunk_id in enumerate(self._ids)}
+            if len(self._tag_bits):
+                bits = np.unpackbits(self._tag_bits, axis=1, count=slot_count, bitorder="little")
+                self._tag_bits = np.packbits(bits[:, live_slots], axis=1, bitorder="little")
+
+    def _idf(self) -> np.ndarray:
+        """単語IDごとのIDF（負の値は平均IDFに基づく下限値に置き換える）"""
+        if self._idf_cache is None:
+            df = self._df[:len(self._vocab)].astype(np.float64)
+            idf = np.log(self._live_count - df + 0.5) - np.log(df + 0.5)
+            present = df > 0
+            if present.any():
+                floor = self.epsilon * idf[present].mean()
+                idf[present & (idf < 0)] = floor
+            self._idf_cache = idf
+        return self._idf_cache
+
+    def _postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """単語のポスティング（圧縮済み + 未マージ）"""
+        if term_id + 1 < len(self._offsets):
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            slots, freqs = self._post_slots[start:end], self._post_freqs[start:end]
+        else:
+            slots, freqs = self._post_slots[:0], self._post_freqs[:0]
+        pending = self._pending.get(term_id)
+        if pending is not None:
+            slots = np.concatenate([slots, np.frombuffer(pending[0], dtype=np.int32)])
+            freqs = np.concatenate([freqs, np.frombuffer(pending[1], dtype=np.float32)])
+        return slots, freqs
+
+    def search(self, query_tokens: List[str], top_n: int,
+               tags: List[str] = None) -> List[Tuple[str, float]]:
+        """
+        クエリ語を含むチャンクだけをスコアリングし、上位を返す
+
+        Args:
+            query_tokens: トークン化済みのクエリ
+            top_n: 返す件数
+            tags: 指定した場合、いずれかのタグを持つチャンクだけを対象にする
+
+        Returns:
+            スコアの高い順の(チャンクID, スコア)のタプルのリスト
+        """
+        with self._lock:
+            if not self._live_count or top_n <= 0:
+                return []
+            tag_bits = None
+            if tags:
+                tag_bits = self._tag_filter_bits(tags)
+                if not tag_bits.any():
+                    return []
+            idf = self._idf()
+            avg_length = self._total_length / self._live_count
+
+            slot_parts = []
+            score_parts = []
+            for term, query_freq in Counter(query_tokens).items():
+                term_id = self._vocab.get(term)
+                if term_id is None or self._df[term_id] == 0:
+                    continue
+                slots, freqs = self._postings(term_id)
+                norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[slots] / avg_length)
+                slot_parts.append(slots)
+                score_parts.append(idf[term_id] * query_freq * (freqs * (self.k1 + 1) / (freqs + norm)))
+            if not slot_parts:
+                return []
+
+            slots = np.concatenate(slot_parts)
+            scores = np.concatenate(score_parts)
+            live = self._alive[slots]
+            if tag_bits is not None:
+                live &= ((tag_bits[slots >> 3] >> (slots & 7)) & 1).astype(bool)
+            candidates, inverse = np.unique(slots[live], return_inverse=True)
+            totals = np.bincount(inverse, weights=scores[live])
+
+            if len(totals) > top_n:
+                top = np.argpartition(-totals, top_n - 1)[:top_n]
+            else:
+                top = np.arange(len(totals))
+            top = top[np.argsort(-totals[top], kind="stable")]
+            return [(self._ids[candidates[i]], float(totals[i])) for i in top]
+
+    def save(self, directory: str) -> None:
+        """
+        インデックスをディレクトリに保存
+        配列は .npy 形式で保存し、読み込み時はメモリマップで開く。
+        新しいファイルを書き終えてからマニフェストを差し替えるため、途中で失敗しても以前の保存内容が残る。
+
+        Args:
+            directory: 保存先ディレクトリ
+        """
+        os.makedirs(directory, exist_ok=True)
+        token = uuid.uuid4().hex[:12]
+        with self._lock:
+            if self._pending_count or len(self._ids) != self._live_count:
+                self._merge()
+            vocab_size = len(self._vocab)
+            arrays = {
+                "vocab": np.array(list(self._vocab), dtype=str),
+                "df": self._df[:vocab_size],
+                "ids": np.array(self._ids, dtype=str),
+                "doc_lengths": self._doc_lengths[:self._live_count],
+                "offsets": self._offsets,
+                "post_slots": self._post_slots,
+                "post_freqs": self._post_freqs,
+                "doc_term_offsets": self._doc_term_offsets,
+                "doc_term_ids": self._doc_term_ids,
+                "tag_names": np.array(list(self._tag_ids), dtype=str),
+                "tag_bits": self._tag_bits[:, :(self._live_count + 7) // 8],
+            }
+            for name, values in arrays.items():
+                np.save(os.path.join(directory, f"{token}.{name}.npy"), values)
+            manifest = {
+                "format": _FORMAT_VERSION,
+                "token": token,
+                "version": self.version,
+                "chunks": self._live_count,
+                "terms": vocab_size,
+                "k1": self.k1,
+                "b": self.b,
+                "epsilon": self.epsilon,
+                "saved_at": datetime.now().isoformat(timespec="seconds"),
+            }
+
+        manifest_path = os.path.join(directory, _MANIFEST_NAME)
+        temp_path = f"{manifest_path}.{token}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, manifest_path)
+
+        # 以前の保存ファイルを削除（読み込み済みのメモリマップは削除後も有効）
+        for name in os.listdir(directory):
+            if name.endswith(".npy") and not name.startswith(f"{token}."):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+        logger.debug("BM25 index saved to %s (%d chunks)", directory, manifest["chunks"])
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["BM25Index"]:
+        """
+        保存されたインデックスを読み込む
+        ポスティングはメモリマップで開くため、実際の読み込みは検索時に必要な部分だけ行われる
+
+        Args:
+            directory: 保存先ディレクトリ
+
+        Returns:
+            読み込んだインデックス（保存されていない、または形式が異なる場合はNone）
+        """
+        manifest_path = os.path.join(directory, _MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != _FORMAT_VERSION:
+            logger.info("BM25 index format changed (%s -> %s)", manifest.get("format"), _FORMAT_VERSION)
+            return None
+
+        def load_array(name: str) -> np.ndarray:
+            path = os.path.join(directory, f"{manifest['token']}.{name}.npy")
+            return np.load(path, mmap_mode="r" if name in _MMAP_ARRAYS else None)
+
+        index = cls(k1=manifest["k1"], b=manifest["b"], epsilon=manifest["epsilon"])
+        index._vocab = {term: term_id for term_id, term in enumerate(load_array("vocab").tolist())}
+        index._df = load_array("df")
+        index._ids = load_array("ids").tolist()
+        index._doc_lengths = load_array("doc_lengths")
+        index._alive = np.ones(len(index._ids), dtype=bool)
+        index._slot_of = {chunk_id: slot for slot, chunk_id in enumerate(index._ids)}
+        index._live_count = len(index._ids)
+        index._total_length = int(index._doc_lengths.sum())
+        for chunk_id in index._ids:
+            index._id_digest ^= cls._hash_id(chunk_id)
+        index._tag_ids = {tag: tag_id for tag_id, tag in enumerate(load_array("tag_names").tolist())}
+        index._tag_bits = load_array("tag_bits")
+        for name in _MMAP_ARRAYS:
+            setattr(index, f"_{name}", load_array(name))
+        return index
+
+    def stats(self) -> Dict[str, int]:
+        """インデックスのメトリクスを取得"""
+        with self._lock:
+            return {
+                "chunks": self._live_count,
+                "terms": int(np.count_nonzero(self._df[:len(self._vocab)])),
+                "postings": len(self._post_slots),
+                "pending_postings": self._pending_count,
+                "deleted_slots": len(self._ids) - self._live_count,
+                "tags": len(self._tag_ids),
+                "merges": self.merge_count,
+            }
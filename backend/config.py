@@ -11,6 +11,25 @@ class RAGConfig:
     OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
     DEFAULT_EMBEDDING_MODEL = "nomic-embed-text"
 
+    # Ollamaクライアント設定（すべてのAPI呼び出しで接続プールを共有）
+    OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "300"))  # 応答の読み取りタイムアウト（秒）
+    OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))  # 接続タイムアウト（秒）
+    OLLAMA_HEALTH_TIMEOUT = 2.0  # モデル一覧・ヘルスチェックのタイムアウト（秒）
+    OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "32"))  # 同時接続数の上限
+    OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", "16"))  # 再利用のため保持する接続数
+    OLLAMA_KEEPALIVE_EXPIRY = 60.0  # 使われていない接続を保持する時間（秒）
+    OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # 生成後にモデル（とプロンプトのKVキャッシュ）をメモリに残す時間
+
+    # 埋め込み設定（取り込み時のバッチ処理）
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))  # 1リクエストあたりのチャンク数
+    EMBEDDING_MAX_INFLIGHT = int(os.getenv("EMBEDDING_MAX_INFLIGHT", "4"))  # 同時に送信するバッチ数
+    EMBEDDING_TIMEOUT = 120.0  # 秒
+
+    # 埋め込みキャッシュ設定（再アップロード時に計算済みのベクトルを再利用）
+    EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+    EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "../cache/embedding_cache.sqlite3")
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))  # 保持するベクトル数の上限
+
     # LLMデフォルトパラメータ
     DEFAULT_TEMPERATURE = 0.3
     DEFAULT_TOP_P = 0.9
@@ -24,12 +43,62 @@ class RAGConfig:
     DEFAULT_DOCUMENT_COUNT = 5  # 取得する関連文書数
     DEFAULT_SEARCH_MULTIPLIER = 10  # 検索範囲倍率（k * multiplier）
     HYBRID_SEARCH_VECTOR_WEIGHT = 0.5  # ベクトル検索の重み（0.0-1.0）
+    HYBRID_FUSION_STRATEGY = os.getenv("HYBRID_FUSION_STRATEGY", "weighted")  # スコア統合の方式（"weighted": 正規化スコアの重み付き和、"rrf": Reciprocal Rank Fusion）
+    RRF_K = 60  # RRFで順位に加える定数
+    TAG_METADATA_PREFIX = "tag:"  # タグ絞り込み用のメタデータキーの接頭辞（"tag:<タグ名>": True）
+    QUERY_EMBEDDING_CACHE_SIZE = 256  # 直近のクエリベクトルを保持する件数
+    QUERY_EXPANSION_TIMEOUT = float(os.getenv("QUERY_EXPANSION_TIMEOUT", "3.0"))  # 拡張クエリの検索結果を待つ上限（秒、質問の受付から）。超えた場合は元の質問の結果のみ使用
+    QUERY_EXPANSION_NUM_PREDICT = 64  # クエリ拡張で生成するトークン数の上限
+    QUERY_EXPANSION_CACHE_SIZE = 512  # 拡張クエリを保持する質問数
+    QUERY_EXPANSION_CACHE_TTL = 3600.0  # 拡張クエリの有効期限（秒）
+
+    # 検索結果キャッシュ設定（生成パラメータが異なる再質問でも検索結果を再利用）
+    RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "true").lower() == "true"
+    RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "512"))  # 保持する検索結果の数
+    RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "600"))  # 検索結果の有効期限（秒）
+
+    # 回答キャッシュ設定（同じ質問への回答を再利用）
+    ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))  # 保持する回答数の上限
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))  # 回答の有効期限（秒）
+    ANSWER_CACHE_MAX_CHARS = 20000  # これより長い回答はキャッシュしない
+    SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"  # 言い換えた質問にも回答を再利用
+    SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))  # 保持する質問ベクトル数の上限
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # 同じ質問とみなすコサイン類似度
 
     # ChromaDB設定
     CHROMA_PERSIST_DIRECTORY = "../chroma_db"
+    CHROMA_WRITE_BATCH_SIZE = 1000  # 1回の書き込みで登録するチャンク数
+    BM25_INDEX_DIRNAME = "bm25_index"  # BM25インデックスの保存先（CHROMA_PERSIST_DIRECTORY 内）
+    DOCUMENT_CATALOG_FILENAME = "catalog.sqlite3"  # ドキュメントカタログの保存先（CHROMA_PERSIST_DIRECTORY 内）
 
     # 会話履歴設定
     CHAT_HISTORY_LIMIT = 10  # 保持する会話の往復数
+    CONVERSATION_MODE_ENABLED = os.getenv("CONVERSATION_MODE_ENABLED", "true").lower() == "true"  # 会話履歴がある場合はChat APIでプロンプトの先頭をそろえ、KVキャッシュを再利用させる
+    CONVERSATION_HISTORY_MESSAGES = 10  # 会話モードでプロンプトに含める履歴のメッセージ数の上限
+
+    # コンテキストの詰め込み設定（参照ドキュメントと会話履歴を num_ctx に収める）
+    DEFAULT_NUM_CTX = int(os.getenv("OLLAMA_CONTEXT_LENGTH", "4096"))  # num_ctx の指定もモデルの設定もない場合のコンテキスト長（Ollamaの既定値）
+    CONTEXT_RESERVED_PREDICT = 1024  # num_predict 未指定（無制限）の場合に回答用に空けておくトークン数
+    CONTEXT_SAFETY_MARGIN = 64  # チャットテンプレートなど、見積もりに含まれないトークン数
+    CONTEXT_HISTORY_RATIO = 0.25  # 会話履歴に優先して割り当てる予算の割合
+    CONTEXT_MIN_TRIM_TOKENS = 64  # 切り詰めてでも入れるチャンクの最小トークン数（これ未満しか残らない場合は落とす）
+    TOKEN_ESTIMATE_ASCII_CHARS_PER_TOKEN = 4.0  # トークン数の見積もり: ASCII文字の1トークンあたりの文字数
+    TOKEN_ESTIMATE_TOKENS_PER_NON_ASCII_CHAR = 1.0  # トークン数の見積もり: 日本語など非ASCII文字1文字あたりのトークン数
+    MODEL_INFO_CACHE_TTL = 600.0  # モデルごとのコンテキスト長（/api/show）の有効期限（秒）
+
+    # 生成スケジューラ設定（Ollamaへの生成リクエストの同時実行数と待ち行列）
+    GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", os.getenv("OLLAMA_NUM_PARALLEL", "2")))  # モデルごとの同時生成数
+    GENERATION_MAX_QUEUE = int(os.getenv("GENERATION_MAX_QUEUE", "16"))  # モデルごとに待たせるリクエスト数の上限（超えた場合は429）
+    GENERATION_MAX_QUEUE_PER_CLIENT = int(os.getenv("GENERATION_MAX_QUEUE_PER_CLIENT", "4"))  # 1クライアントが待たせられるリクエスト数
+    GENERATION_QUEUE_TIMEOUT = float(os.getenv("GENERATION_QUEUE_TIMEOUT", "120"))  # 待ち行列で待つ時間の上限（秒）
+    GENERATION_DEFAULT_DURATION = 10.0  # 実績がない場合の生成1件の所要時間の目安（秒、Retry-After の算出用）
+
+    # モデル常駐設定（起動時の読み込み、使用中のモデルの keep_alive 延長、待ち行列に入った時点での事前読み込み）
+    MODEL_PRELOAD_ENABLED = os.getenv("MODEL_PRELOAD_ENABLED", "true").lower() == "true"  # 起動時に既定のモデルを読み込む
+    OLLAMA_MAX_LOADED_MODELS = int(os.getenv("OLLAMA_MAX_LOADED_MODELS", "3"))  # 同時にメモリに置くモデル数の上限（Ollama側の設定と合わせる）
+    MODEL_KEEPALIVE_INTERVAL = float(os.getenv("MODEL_KEEPALIVE_INTERVAL", "240"))  # 常駐モデルの確認と keep_alive の延長の間隔（秒）
+    MODEL_IN_USE_WINDOW = float(os.getenv("MODEL_IN_USE_WINDOW", "1800"))  # この時間内に使われたモデルを使用中とみなす（秒）
 
     # ストリーミング設定
     STREAMING_TIMEOUT = 300.0  # 秒
@@ -41,6 +110,21 @@ class RAGConfig:
     SUPPORTED_EXTENSIONS = {'.pdf', '.txt', '.md', '.csv'}
     MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
     UPLOAD_DIRECTORY = "../uploads"
+    UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB（ストリーミング保存時の書き込み単位）
+
+    # 実行レイヤー設定（ブロッキング処理をイベントループ外で実行）
+    EXECUTOR_MAX_WORKERS = int(os.getenv("EXECUTOR_MAX_WORKERS", "8"))  # スレッドプールの同時実行数
+    EXECUTOR_MAX_QUEUE = int(os.getenv("EXECUTOR_MAX_QUEUE", "64"))  # 実行待ちキューの上限
+    PARSER_PROCESS_WORKERS = int(os.getenv("PARSER_PROCESS_WORKERS", "2"))  # ファイル解析用プロセス数（0でスレッド内実行）
+    SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "8"))  # 検索（クエリごとのベクトル検索・BM25）の同時実行数
+
+    # 取り込みジョブ設定（アップロードはバックグラウンドで処理）
+    INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))  # 同時に取り込むファイル数
+    INGESTION_QUEUE_SIZE = int(os.getenv("INGESTION_QUEUE_SIZE", "100"))  # 処理待ちファイル数の上限
+    INGESTION_JOB_HISTORY = 100  # 保持するジョブ履歴の件数
+
+    # 起動設定（RAGサービスはサーバーの起動後にバックグラウンドで初期化する）
+    STARTUP_WAIT_TIMEOUT = float(os.getenv("STARTUP_WAIT_TIMEOUT", "30"))  # 初期化の完了をリクエストが待つ上限（秒、超えた場合は503）
 
     # ログ設定
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -92,6 +176,28 @@ class PromptTemplates:
 
 回答:"""
 
+    # 会話モードのシステムメッセージ（会話の間は変えず、Ollamaのプロンプトキャッシュに再利用させる）
+    CONVERSATION_SYSTEM_TEMPLATE = """{persona}
+
+ユーザーの質問には参照情報が添えられます。
+
+指示:
+- 参照情報に含まれる情報を最大限活用して、質問に対して詳しく丁寧に答えてください
+- 会話の文脈を考慮し、自然な対話を心がけてください
+- 直接的な答えが見つからない場合でも、関連する情報や類似の内容があれば、それを基に推論して回答してください
+- 参照情報に複数の関連情報がある場合は、それらを統合して包括的な回答を提供してください
+- 参照情報内の具体的な情報（数値、固有名詞、事実など）を積極的に引用してください
+- どうしても関連する情報が全く見つからない場合のみ、その旨を伝えてください
+- 回答は読みやすいように、適切に段落分けや改行を入れてください
+- 複数の項目を説明する場合は、項目ごとに改行して見やすくしてください
+{constraint}"""
+
+    # 会話モードのユーザーメッセージ（質問ごとに変わる部分）
+    CONVERSATION_USER_TEMPLATE = """参照情報:
+{context}
+
+質問: {question}"""
+
     # RAGなしプロンプト
     SIMPLE_PROMPT_TEMPLATE = """あなたは親切で知識豊富なアシスタントです。以下の質問に答えてください。
 
@@ -129,6 +235,35 @@ class PromptTemplates:
             question=question
         )
 
+    @staticmethod
+    def build_conversation_system_prompt(persona: str = None, constraint: str = "") -> str:
+        """会話モードのシステムメッセージを構築
+
+        Args:
+            persona: キャラクター設定（Noneの場合は標準のアシスタント）
+            constraint: タグフィルターなどの制約
+
+        Returns:
+            構築されたシステムメッセージ
+        """
+        return PromptTemplates.CONVERSATION_SYSTEM_TEMPLATE.format(
+            persona=persona or "あなたは親切で知識豊富なアシスタントです。",
+            constraint=constraint
+        )
+
+    @staticmethod
+    def build_conversation_user_message(context: str, question: str) -> str:
+        """会話モードのユーザーメッセージを構築
+
+        Args:
+            context: 参照ドキュメント
+            question: ユーザーの質問
+
+        Returns:
+            構築されたユーザーメッセージ
+        """
+        return PromptTemplates.CONVERSATION_USER_TEMPLATE.format(context=context, question=question)
+
     @staticmethod
     def build_simple_prompt(question: str) -> str:
         """シンプルなプロンプトを構築（RAGなし）
@@ -0,0 +1,219 @@
+"""
+コンテキストの詰め込み - 参照ドキュメントと会話履歴を、モデルのコンテキスト長（num_ctx）に収まるよう選ぶ
+"""
+import math
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+from config import RAGConfig
+
+# チャンクのメタデータに保存するトークン数の見積もり（取り込み時に計算）
+TOKEN_COUNT_METADATA_KEY = "token_count"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    テキストのトークン数を見積もる（トークナイザーを使わない概算）
+    ASCII文字は数文字で1トークン、日本語などの非ASCII文字は1文字ごとにトークンになりやすいため分けて数える
+
+    Args:
+        text: テキスト
+
+    Returns:
+        トークン数の見積もり
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    other_chars = len(text) - ascii_chars
+    return math.ceil(ascii_chars / RAGConfig.TOKEN_ESTIMATE_ASCII_CHARS_PER_TOKEN
+                     + other_chars * RAGConfig.TOKEN_ESTIMATE_TOKENS_PER_NON_ASCII_CHAR)
+
+
+def document_tokens(doc) -> int:
+    """チャンクのトークン数（取り込み時に保存した見積もり、ない場合はその場で計算）"""
+    tokens = doc.metadata.get(TOKEN_COUNT_METADATA_KEY)
+    return tokens if isinstance(tokens, int) else estimate_tokens(doc.page_content)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    見積もりが max_tokens 以下になるようテキストの末尾を切り詰める
+
+    Args:
+        text: テキスト
+        max_tokens: トークン数の上限
+
+    Returns:
+        切り詰めたテキスト（収まる場合はそのまま）
+    """
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    # 文字数とトークン数はほぼ比例するため、比率で切ってから収まるまで少しずつ縮める
+    length = int(len(text) * max_tokens / tokens)
+    while length > 0 and estimate_tokens(text[:length]) > max_tokens:
+        length = int(length * 0.9)
+    return text[:length]
+
+
+class PackedContext:
+    """詰め込みの結果"""
+
+    def __init__(self, documents: List[str], history: List[str], context_tokens: int, history_tokens: int,
+                 fixed_tokens: int, budget: int, dropped_documents: int, trimmed_documents: int,
+                 dropped_history: int):
+        self.documents = documents  # 採用したチャンクのテキスト（順位順、最後の1件は切り詰めている場合あり）
+        self.history = history  # 採用した会話履歴の行（古い順）
+        self.context_tokens = context_tokens
+        self.history_tokens = history_tokens
+        self.fixed_tokens = fixed_tokens  # プロンプトの固定部分（指示・質問）
+        self.budget = budget
+        self.dropped_documents = dropped_documents
+        self.trimmed_documents = trimmed_documents
+        self.dropped_history = dropped_history
+
+    @property
+    def prompt_tokens(self) -> int:
+        """プロンプト全体のトークン数の見積もり"""
+        return self.fixed_tokens + self.context_tokens + self.history_tokens
+
+    @property
+    def context(self) -> str:
+        return "\n\n".join(self.documents)
+
+    @property
+    def history_text(self) -> str:
+        return "\n".join(self.history)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "context_tokens": self.context_tokens,
+            "history_tokens": self.history_tokens,
+            "budget": self.budget,
+            "documents": len(self.documents),
+            "dropped_documents": self.dropped_documents,
+            "trimmed_documents": self.trimmed_documents,
+            "dropped_history": self.dropped_history,
+        }
+
+
+class ContextPacker:
+    """
+    トークン予算に収まるよう参照ドキュメントと会話履歴を選ぶ
+    予算は num_ctx から回答用の num_predict とプロンプトの固定部分を引いたもの。
+    会話履歴は新しいものから一定の割合まで先に確保し、残りを順位の高いチャンクから埋める
+    （収まらないチャンクは切り詰めるか落とし、余った分でさらに古い会話履歴を入れる）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._packed = 0
+        self._prompt_tokens = 0
+        self._dropped_documents = 0
+        self._trimmed_documents = 0
+        self._dropped_history = 0
+
+    @staticmethod
+    def budget(num_ctx: int, num_predict: Optional[int], fixed_tokens: int) -> int:
+        """
+        参照ドキュメントと会話履歴に使えるトークン数
+
+        Args:
+            num_ctx: コンテキスト長
+            num_predict: 生成するトークン数の上限（Noneや負の場合は無制限）
+            fixed_tokens: プロンプトの固定部分のトークン数
+
+        Returns:
+            トークン数（0以上）
+        """
+        reserved = num_predict if num_predict is not None and num_predict > 0 else RAGConfig.CONTEXT_RESERVED_PREDICT
+        # num_predict が大きすぎても参照ドキュメントが入らなくならないよう、回答用はコンテキスト長の半分まで
+        reserved = min(reserved, num_ctx // 2)
+        return max(num_ctx - reserved - fixed_tokens - RAGConfig.CONTEXT_SAFETY_MARGIN, 0)
+
+    def pack(self, documents: Sequence, fixed_tokens: int, num_ctx: int, num_predict: Optional[int] = None,
+             history: Sequence[str] = ()) -> PackedContext:
+        """
+        予算に収まる参照ドキュメントと会話履歴を選ぶ
+
+        Args:
+            documents: チャンク（Document、順位順）
+            fixed_tokens: プロンプトの固定部分（指示・質問）のトークン数
+            num_ctx: コンテキスト長
+            num_predict: 生成するトークン数の上限
+            history: 会話履歴の行（古い順）
+
+        Returns:
+            詰め込みの結果
+        """
+        budget = self.budget(num_ctx, num_predict, fixed_tokens)
+        history_costs = [estimate_tokens(line) + 1 for line in history]  # 改行の分を加える
+
+        # 会話履歴を新しいものから、予算の一定の割合まで確保
+        history_budget = int(budget * RAGConfig.CONTEXT_HISTORY_RATIO)
+        history_start = len(history)
+        history_tokens = 0
+        while history_start > 0 and history_tokens + history_costs[history_start - 1] <= history_budget:
+            history_start -= 1
+            history_tokens += history_costs[history_start]
+
+        # 残りを順位の高いチャンクから埋める（収まらないチャンクは切り詰め、それ以降は落とす）
+        remaining = budget - history_tokens
+        packed_documents = []
+        context_tokens = 0
+        trimmed = 0
+        for doc in documents:
+            tokens = document_tokens(doc) + 1  # 区切りの空行の分を加える
+            if tokens <= remaining:
+                packed_documents.append(doc.page_content)
+            elif remaining - 1 >= RAGConfig.CONTEXT_MIN_TRIM_TOKENS:
+                text = truncate_to_tokens(doc.page_content, remaining - 1)
+                packed_documents.append(text)
+                tokens = estimate_tokens(text) + 1
+                trimmed = 1
+            else:
+                break
+            remaining -= tokens
+            context_tokens += tokens
+            if trimmed:
+                break
+
+        # チャンクで使い切らなかった分で、さらに古い会話履歴を入れる
+        while history_start > 0 and history_costs[history_start - 1] <= remaining:
+            history_start -= 1
+            history_tokens += history_costs[history_start]
+            remaining -= history_costs[history_start]
+
+        packed = PackedContext(
+            documents=packed_documents,
+            history=list(history[history_start:]),
+            context_tokens=context_tokens,
+            history_tokens=history_tokens,
+            fixed_tokens=fixed_tokens,
+            budget=budget,
+            dropped_documents=len(documents) - len(packed_documents),
+            trimmed_documents=trimmed,
+            dropped_history=history_start,
+        )
+        with self._lock:
+            self._packed += 1
+            self._prompt_tokens += packed.prompt_tokens
+            self._dropped_documents += packed.dropped_documents
+            self._trimmed_documents += packed.trimmed_documents
+            self._dropped_history += packed.dropped_history
+        return packed
+
+    def stats(self) -> Dict[str, Any]:
+        """詰め込みのメトリクスを取得"""
+        with self._lock:
+            return {
+                "packed": self._packed,
+                "avg_prompt_tokens": round(self._prompt_tokens / self._packed, 1) if self._packed else 0.0,
+                "dropped_documents": self._dropped_documents,
+                "trimmed_documents": self._trimmed_documents,
+                "dropped_history": self._dropped_history,
+            }
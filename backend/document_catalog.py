@@ -0,0 +1,396 @@
+"""
+ドキュメントカタログ - 登録済みファイル・チャンクID・タグをSQLiteに記録する
+一覧系のAPIがベクトルストア全体を読み込まずに済むよう、Chromaと並行して維持する
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# SQLiteのプレースホルダ数の上限を超えないよう分割して問い合わせる
+_QUERY_BATCH_SIZE = 500
+
+
+class DocumentCatalog:
+    """ファイル単位のドキュメント情報（チャンクID、タグ、ページ数、サイズ、登録日時）を管理するクラス"""
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: SQLiteファイルのパス
+        """
+        self.path = path
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                filename TEXT PRIMARY KEY,
+                content_sha256 TEXT,
+                size INTEGER,
+                chunk_count INTEGER NOT NULL DEFAULT 0,
+                page_count INTEGER,
+                ingested_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                chunk_id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                page INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunks_filename ON chunks (filename);
+            CREATE TABLE IF NOT EXISTS document_tags (
+                filename TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                PRIMARY KEY (filename, tag)
+            );
+            CREATE INDEX IF NOT EXISTS idx_document_tags_tag ON document_tags (tag, filename);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            """
+        )
+        self._conn.commit()
+
+        # 件数のカウンタ（追加・削除時に更新し、統計の取得ではテーブルを走査しない）
+        self._document_count = 0
+        self._chunk_count = 0
+        self._tag_files: Counter = Counter()  # タグごとのファイル数
+        self._index_version = 0
+        self._load_counters()
+
+    def _load_counters(self) -> None:
+        """カウンタをテーブルから読み込む（起動時と作り直し時のみ）"""
+        self._document_count = self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        self._chunk_count = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        self._tag_files = Counter(dict(
+            self._conn.execute("SELECT tag, COUNT(*) FROM document_tags GROUP BY tag").fetchall()
+        ))
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'index_version'").fetchone()
+        self._index_version = row[0] if row else 0
+
+    def _bump_version(self, minimum: int = 0) -> None:
+        """インデックスのバージョンを進める（更新と同じトランザクション内で呼び出す）"""
+        self._index_version = max(self._index_version, minimum) + 1
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('index_version', ?)", (self._index_version,)
+        )
+
+    @property
+    def index_version(self) -> int:
+        """ドキュメントの追加・削除のたびに増えるバージョン（キャッシュの無効化に使用）"""
+        return self._index_version
+
+    def bump_index_version(self) -> None:
+        """
+        バージョンを進める
+        add_document / remove_document の後、BM25インデックスまで更新し終えてから呼び出す
+        （更新途中の検索結果が新しいバージョンでキャッシュされないようにするため）
+        """
+        with self._lock, self._conn:
+            self._bump_version()
+
+    def advance_index_version(self, after: int) -> None:
+        """
+        バージョンを指定値より大きくする
+        カタログを作り直した場合に、以前のバージョンと重複しないようにするために使用
+
+        Args:
+            after: 以前のカタログのバージョン
+        """
+        with self._lock, self._conn:
+            self._bump_version(after)
+
+    def get_meta(self, key: str) -> Optional[int]:
+        """
+        カタログに記録した設定値を取得（移行処理の完了フラグなど）
+
+        Args:
+            key: キー
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: int) -> None:
+        """
+        カタログに設定値を記録
+
+        Args:
+            key: キー
+            value: 値
+        """
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def close(self) -> None:
+        """接続を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+    def add_document(self, filename: str, chunk_ids: List[str], pages: List[Optional[int]],
+                     tags: List[str] = None, size: int = None, content_hash: str = None,
+                     ingested_at: float = None) -> None:
+        """
+        ファイルのチャンクを登録（同じファイル名が登録済みの場合はチャンクとタグを置き換える）
+
+        Args:
+            filename: ファイル名
+            chunk_ids: チャンクID
+            pages: chunk_ids と同じ順序のページ番号（ページのない形式はNone）
+            tags: タグのリスト
+            size: ファイルサイズ（バイト）
+            content_hash: ファイル内容のSHA-256
+            ingested_at: 登録日時（UNIX時刻、省略時は現在時刻）
+        """
+        ingested_at = ingested_at if ingested_at is not None else time.time()
+        with self._lock:
+            with self._conn:
+                row = self._conn.execute(
+                    "SELECT chunk_count FROM documents WHERE filename = ?", (filename,)
+                ).fetchone()
+                old_tags = [tag for tag, in self._conn.execute(
+                    "SELECT tag FROM document_tags WHERE filename = ?", (filename,)
+                )]
+                self._conn.execute(
+                    "INSERT INTO documents (filename, content_sha256, size, ingested_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (filename) DO UPDATE SET "
+                    "content_sha256 = COALESCE(excluded.content_sha256, content_sha256), "
+                    "size = COALESCE(excluded.size, size), "
+                    "ingested_at = COALESCE(excluded.ingested_at, ingested_at)",
+                    (filename, content_hash, size, ingested_at)
+                )
+                self._conn.execute("DELETE FROM chunks WHERE filename = ?", (filename,))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO chunks (chunk_id, filename, page) VALUES (?, ?, ?)",
+                    [(chunk_id, filename, page) for chunk_id, page in zip(chunk_ids, pages)]
+                )
+                new_tags = list(dict.fromkeys(tags or []))
+                self._conn.execute("DELETE FROM document_tags WHERE filename = ?", (filename,))
+                self._conn.executemany(
+                    "INSERT INTO document_tags (filename, tag) VALUES (?, ?)", [(filename, tag) for tag in new_tags]
+                )
+                self._refresh_counts(filename)
+                chunk_count = self._conn.execute(
+                    "SELECT chunk_count FROM documents WHERE filename = ?", (filename,)
+                ).fetchone()[0]
+
+            # コミットに成功した場合のみカウンタへ反映
+            self._document_count += 0 if row else 1
+            self._chunk_count += chunk_count - (row[0] if row else 0)
+            self._tag_files.subtract(old_tags)
+            self._tag_files.update(new_tags)
+            self._tag_files += Counter()  # 0件になったタグを除く
+
+    def _refresh_counts(self, filename: str) -> None:
+        """ファイルのチャンク数・ページ数を更新（ファイル内のチャンク数に比例する処理）"""
+        self._conn.execute(
+            "UPDATE documents SET "
+            "chunk_count = (SELECT COUNT(*) FROM chunks WHERE filename = ?), "
+            "page_count = (SELECT NULLIF(COUNT(DISTINCT page), 0) FROM chunks WHERE filename = ?) "
+            "WHERE filename = ?",
+            (filename, filename, filename)
+        )
+
+    def remove_document(self, filename: str) -> int:
+        """
+        ファイルとそのチャンク・タグを削除
+
+        Args:
+            filename: ファイル名
+
+        Returns:
+            削除したチャンク数
+        """
+        with self._lock:
+            with self._conn:
+                tags = [tag for tag, in self._conn.execute(
+                    "SELECT tag FROM document_tags WHERE filename = ?", (filename,)
+                )]
+                removed = self._conn.execute("DELETE FROM chunks WHERE filename = ?", (filename,)).rowcount
+                self._conn.execute("DELETE FROM document_tags WHERE filename = ?", (filename,))
+                existed = self._conn.execute("DELETE FROM documents WHERE filename = ?", (filename,)).rowcount
+            self._document_count -= existed
+            self._chunk_count -= removed
+            self._tag_files.subtract(tags)
+            self._tag_files += Counter()  # 0件になったタグを除く
+        return removed
+
+    def replace_all(self, chunks: Iterable[Tuple[str, dict]]) -> None:
+        """
+        カタログ全体を作り直す（既存のベクトルストアからの初期構築用）
+
+        Args:
+            chunks: (チャンクID, メタデータ) のタプル
+        """
+        documents: Dict[str, dict] = {}
+        chunk_rows = []
+        for chunk_id, metadata in chunks:
+            filename = (metadata or {}).get("source_file")
+            if not filename:
+                continue
+            doc = documents.setdefault(filename, {"content_sha256": None, "tags": set()})
+            doc["content_sha256"] = doc["content_sha256"] or metadata.get("content_sha256")
+            tags_str = metadata.get("tags", "")
+            doc["tags"].update(t.strip() for t in tags_str.split(",") if t.strip())
+            chunk_rows.append((chunk_id, filename, metadata.get("page")))
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM chunks")
+                self._conn.execute("DELETE FROM document_tags")
+                self._conn.execute("DELETE FROM documents")
+                self._conn.executemany(
+                    "INSERT INTO documents (filename, content_sha256) VALUES (?, ?)",
+                    [(filename, doc["content_sha256"]) for filename, doc in documents.items()]
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO chunks (chunk_id, filename, page) VALUES (?, ?, ?)", chunk_rows
+                )
+                self._conn.executemany(
+                    "INSERT INTO document_tags (filename, tag) VALUES (?, ?)",
+                    [(filename, tag) for filename, doc in documents.items() for tag in doc["tags"]]
+                )
+                for filename in documents:
+                    self._refresh_counts(filename)
+                self._bump_version()
+            self._load_counters()
+
+    def clear(self) -> None:
+        """すべての記録を削除"""
+        self.replace_all([])
+
+    def chunk_count(self) -> int:
+        """登録されているチャンクの総数"""
+        return self._chunk_count
+
+    def chunk_ids(self, filename: str) -> List[str]:
+        """
+        ファイルのチャンクIDを取得
+
+        Args:
+            filename: ファイル名
+
+        Returns:
+            チャンクIDのリスト（ページ番号順、同じページ内は登録順）
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id FROM chunks WHERE filename = ? ORDER BY COALESCE(page, 0), rowid",
+                (filename,)
+            ).fetchall()
+        return [chunk_id for chunk_id, in rows]
+
+    @staticmethod
+    def _document_filter(tags: List[str] = None, query: str = None) -> Tuple[str, list]:
+        """タグ（いずれかに一致）とファイル名の部分一致のWHERE句を作成"""
+        clauses = []
+        params: list = []
+        if tags:
+            placeholders = ",".join("?" * len(tags))
+            clauses.append(f"filename IN (SELECT filename FROM document_tags WHERE tag IN ({placeholders}))")
+            params.extend(tags)
+        if query:
+            clauses.append("instr(lower(filename), lower(?)) > 0")
+            params.append(query)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def count_documents(self, tags: List[str] = None, query: str = None) -> int:
+        """
+        条件に一致するファイル数を取得
+
+        Args:
+            tags: いずれかを持つファイルに絞り込むタグ
+            query: ファイル名の部分一致（大文字小文字を区別しない）
+        """
+        where, params = self._document_filter(tags, query)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM documents{where}", params).fetchone()[0]
+
+    def list_documents(self, tags: List[str] = None, query: str = None,
+                       limit: int = None, offset: int = 0) -> List[dict]:
+        """
+        ファイルの一覧を取得（ファイル名順）
+
+        Args:
+            tags: いずれかを持つファイルに絞り込むタグ
+            query: ファイル名の部分一致（大文字小文字を区別しない）
+            limit: 取得する件数（Noneの場合はすべて）
+            offset: 読み飛ばす件数
+
+        Returns:
+            ファイル情報（filename, tags, chunk_count, page_count, size, content_sha256, ingested_at）のリスト
+        """
+        where, params = self._document_filter(tags, query)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT filename, chunk_count, page_count, size, content_sha256, ingested_at "
+                f"FROM documents{where} ORDER BY filename LIMIT ? OFFSET ?",
+                [*params, -1 if limit is None else limit, offset]
+            ).fetchall()
+
+            # 取得したページ分のタグだけを問い合わせる
+            tags_by_file: Dict[str, List[str]] = {row[0]: [] for row in rows}
+            filenames = list(tags_by_file)
+            for start in range(0, len(filenames), _QUERY_BATCH_SIZE):
+                batch = filenames[start:start + _QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                for filename, tag in self._conn.execute(
+                    f"SELECT filename, tag FROM document_tags WHERE filename IN ({placeholders}) ORDER BY tag",
+                    batch
+                ):
+                    tags_by_file[filename].append(tag)
+
+        return [
+            {
+                "filename": filename,
+                "tags": tags_by_file[filename],
+                "chunk_count": chunk_count,
+                "page_count": page_count,
+                "size": size,
+                "content_sha256": content_sha256,
+                "ingested_at": ingested_at,
+            }
+            for filename, chunk_count, page_count, size, content_sha256, ingested_at in rows
+        ]
+
+    def list_tags(self, query: str = None, limit: int = None, offset: int = 0) -> List[str]:
+        """
+        タグの一覧を取得（重複なし、ソート済み）
+
+        Args:
+            query: タグの部分一致（大文字小文字を区別しない）
+            limit: 取得する件数（Noneの場合はすべて）
+            offset: 読み飛ばす件数
+        """
+        where = " WHERE instr(lower(tag), lower(?)) > 0" if query else ""
+        params = [query] if query else []
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT DISTINCT tag FROM document_tags{where} ORDER BY tag LIMIT ? OFFSET ?",
+                [*params, -1 if limit is None else limit, offset]
+            ).fetchall()
+        return [tag for tag, in rows]
+
+    def stats(self) -> Dict[str, int]:
+        """コーパスの統計（ファイル数・チャンク数・タグ数・インデックスのバージョン）を取得"""
+        with self._lock:
+            return {
+                "documents": self._document_count,
+                "chunks": self._chunk_count,
+                "tags": len(self._tag_files),
+                "index_version": self._index_version,
+            }
@@ -0,0 +1,54 @@
+"""
+ドキュメント読み込み - ファイルの解析とチャンク分割
+プロセスプールから呼び出せるよう、モジュールレベルの関数として定義する
+"""
+import os
+from typing import List
+
+from langchain_community.document_loaders import (
+    PyPDFLoader,
+    TextLoader,
+    CSVLoader,
+    UnstructuredMarkdownLoader
+)
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+
+def load_and_split_document(file_path: str, chunk_size: int, chunk_overlap: int) -> List[Document]:
+    """
+    ファイルを読み込んでチャンクに分割
+    対応フォーマット: PDF, TXT, MD, CSV
+
+    Args:
+        file_path: ファイルのパス
+        chunk_size: チャンクサイズ（文字数）
+        chunk_overlap: チャンク間の重なり（文字数）
+
+    Returns:
+        分割されたドキュメントのリスト
+    """
+    # ファイル拡張子に応じてローダーを選択
+    file_extension = os.path.splitext(file_path)[1].lower()
+
+    if file_extension == '.pdf':
+        loader = PyPDFLoader(file_path)
+    elif file_extension == '.txt':
+        loader = TextLoader(file_path, encoding='utf-8')
+    elif file_extension == '.md':
+        loader = UnstructuredMarkdownLoader(file_path)
+    elif file_extension == '.csv':
+        loader = CSVLoader(file_path, encoding='utf-8')
+    else:
+        raise ValueError(f"サポートされていないファイル形式です: {file_extension}")
+
+    # ドキュメントの読み込み
+    documents = loader.load()
+
+    # テキストの分割（より大きなチャンクでコンテキストを保持）
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len
+    )
+    return text_splitter.split_documents(documents)
@@ -0,0 +1,184 @@
+"""
+埋め込みキャッシュ - (埋め込みモデル名, 正規化したチャンクのハッシュ) をキーにベクトルをSQLiteへ保存する
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from typing import Dict, List, Optional
+
+from config import RAGConfig
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# SQLiteのプレースホルダ数の上限を超えないよう分割して問い合わせる
+_QUERY_BATCH_SIZE = 500
+
+
+class EmbeddingCache:
+    """サイズ上限付き（LRU）のディスク永続化埋め込みキャッシュ"""
+
+    def __init__(self, path: str = None, max_entries: int = None):
+        """
+        Args:
+            path: SQLiteファイルのパス
+            max_entries: 保持するベクトル数の上限（超えた分は最終参照が古いものから削除）
+        """
+        self.path = path or RAGConfig.EMBEDDING_CACHE_PATH
+        self.max_entries = max_entries or RAGConfig.EMBEDDING_CACHE_MAX_ENTRIES
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)"
+        )
+        self._conn.commit()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        """
+        チャンクのテキストを正規化してハッシュ化
+        Unicode正規化（NFC）と空白の連続を1つにまとめる処理のみ行う
+
+        Args:
+            text: チャンクのテキスト
+
+        Returns:
+            SHA-256の16進文字列
+        """
+        normalized = re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        複数のテキストのベクトルをキャッシュから取得
+
+        Args:
+            model: 埋め込みモデル名
+            texts: テキストのリスト
+
+        Returns:
+            入力と同じ順序のリスト（キャッシュにないものはNone）
+        """
+        hashes = [self.text_hash(text) for text in texts]
+        found: Dict[str, List[float]] = {}
+        now = time.time()
+
+        with self._lock:
+            unique_hashes = list(dict.fromkeys(hashes))
+            for start in range(0, len(unique_hashes), _QUERY_BATCH_SIZE):
+                batch = unique_hashes[start:start + _QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch]
+                ).fetchall()
+                for text_hash, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[text_hash] = vector.tolist()
+
+            # 参照時刻を更新（LRU）
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, text_hash) for text_hash in found]
+                )
+                self._conn.commit()
+
+            results = [found.get(text_hash) for text_hash in hashes]
+            hit_count = sum(1 for vector in results if vector is not None)
+            self._hits += hit_count
+            self._misses += len(results) - hit_count
+
+        return results
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]) -> None:
+        """
+        複数のテキストのベクトルをキャッシュに保存
+
+        Args:
+            model: 埋め込みモデル名
+            texts: テキストのリスト
+            vectors: texts と同じ順序のベクトルのリスト
+        """
+        now = time.time()
+        rows = [
+            (model, self.text_hash(text), array("f", vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_access) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self) -> None:
+        """上限を超えた分を最終参照が古いものから削除"""
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+            (overflow,)
+        )
+        self._evictions += overflow
+        logger.debug("Evicted %d embeddings from cache", overflow)
+
+    def stats(self) -> Dict[str, float]:
+        """キャッシュのメトリクスを取得"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self._hits + self._misses
+            return {
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0,
+                "evictions": self._evictions,
+            }
+
+
+def create_embedding_cache() -> Optional[EmbeddingCache]:
+    """
+    設定に従って埋め込みキャッシュを作成
+    無効化されている場合や開けない場合はNoneを返す（キャッシュなしで動作）
+    """
+    if not RAGConfig.EMBEDDING_CACHE_ENABLED:
+        return None
+    try:
+        return EmbeddingCache()
+    except Exception as e:
+        logger.warning("Embedding cache disabled: %s", e)
+        return None
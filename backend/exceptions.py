@@ -55,6 +55,39 @@ class UnsupportedFileTypeError(RAGException):
         super().__init__(message)
 
 
+class FileTooLargeError(RAGException):
+    """アップロードされたファイルがサイズ上限を超えた場合の例外"""
+    def __init__(self, filename: str, max_size: int):
+        self.filename = filename
+        self.max_size = max_size
+        message = f"{filename} exceeds the maximum file size of {max_size // (1024 * 1024)}MB"
+        super().__init__(message)
+
+
 class QueryError(RAGException):
     """クエリ実行に失敗した場合の例外"""
     pass
+
+
+class IngestionQueueFullError(RAGException):
+    """取り込みジョブキューに空きがない場合の例外"""
+    pass
+
+
+class IngestionUnavailableError(RAGException):
+    """起動時の初期化に失敗し、取り込みを行えない場合の例外"""
+    pass
+
+
+class GenerationQueueFullError(RAGException):
+    """生成の待ち行列に空きがない場合の例外"""
+    def __init__(self, model: str, retry_after: int):
+        self.model = model
+        self.retry_after = retry_after
+        message = f"Too many pending generation requests for model '{model}'. Retry after {retry_after}s"
+        super().__init__(message)
+
+
+class GenerationQueueTimeoutError(RAGException):
+    """生成の待ち行列で順番が来なかった場合の例外"""
+    pass
@@ -0,0 +1,220 @@
+"""
+実行レイヤー - ブロッキング処理をasyncioイベントループの外で実行する
+"""
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from config import RAGConfig
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class WorkerPool:
+    """上限付きスレッドプール（キュー深度のメトリクス付き）"""
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        """
+        Args:
+            name: プール名（メトリクスとスレッド名に使用）
+            max_workers: 同時に実行するスレッド数
+            max_queue: 実行待ちとして受け付けるタスク数の上限
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix=f"rag-{name}"
+        )
+        # 実行中 + キュー待ちの合計を制限（超えた分はイベントループ上で待機）
+        self._slots = None
+        self._lock = threading.Lock()
+        self._waiting = 0      # スロット空き待ち
+        self._queued = 0       # プールのキューで実行待ち
+        self._running = 0      # 実行中
+        self._completed = 0
+        self._failed = 0
+        self._cancelled = 0
+        self._peak_queued = 0
+        self._total_wait_time = 0.0
+        self._total_run_time = 0.0
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        関数をプールで実行し、結果を待つ
+
+        Args:
+            func: 実行する同期関数
+            *args, **kwargs: 関数に渡す引数
+
+        Returns:
+            関数の戻り値
+        """
+        loop = asyncio.get_running_loop()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers + self.max_queue)
+        slots = self._slots
+
+        with self._lock:
+            self._waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+        submitted_at = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+            self._peak_queued = max(self._peak_queued, self._queued)
+
+        future = self._executor.submit(self._run_tracked, func, submitted_at, *args, **kwargs)
+
+        def _on_done(f):
+            if f.cancelled():
+                # 実行前にキャンセルされた場合はキュー待ちから外す
+                with self._lock:
+                    self._queued -= 1
+                    self._cancelled += 1
+            loop.call_soon_threadsafe(slots.release)
+
+        future.add_done_callback(_on_done)
+        return await asyncio.wrap_future(future)
+
+    def _run_tracked(self, func: Callable, submitted_at: float, *args, **kwargs) -> Any:
+        """ワーカースレッド上で関数を実行し、統計を記録する"""
+        started_at = time.perf_counter()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._total_wait_time += started_at - submitted_at
+        try:
+            result = func(*args, **kwargs)
+            with self._lock:
+                self._completed += 1
+            return result
+        except Exception:
+            with self._lock:
+                self._failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._total_run_time += time.perf_counter() - started_at
+
+    def stats(self) -> Dict[str, Any]:
+        """プールのメトリクスを取得"""
+        with self._lock:
+            finished = self._completed + self._failed
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._queued,
+                "waiting": self._waiting,
+                "peak_queued": self._peak_queued,
+                "completed": self._completed,
+                "failed": self._failed,
+                "cancelled": self._cancelled,
+                "avg_wait_ms": round(self._total_wait_time / finished * 1000, 2) if finished else 0.0,
+                "avg_run_ms": round(self._total_run_time / finished * 1000, 2) if finished else 0.0,
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ExecutionLayer:
+    """ブロッキング処理の実行先をまとめて管理するクラス"""
+
+    def __init__(self):
+        # Chroma、Ollama呼び出しなどのI/O待ちが中心の処理
+        self.io = WorkerPool(
+            "io",
+            max_workers=RAGConfig.EXECUTOR_MAX_WORKERS,
+            max_queue=RAGConfig.EXECUTOR_MAX_QUEUE
+        )
+        # 検索専用（拡張クエリごとのベクトル検索・BM25を並行して実行する。ioプールの混雑に影響されないよう分離）
+        self.search = WorkerPool(
+            "search",
+            max_workers=RAGConfig.SEARCH_WORKERS,
+            max_queue=RAGConfig.EXECUTOR_MAX_QUEUE
+        )
+        # ファイル取り込み専用（チャット処理のスレッドを占有しないよう分離）
+        self.ingest = WorkerPool(
+            "ingest",
+            max_workers=RAGConfig.INGESTION_WORKERS,
+            max_queue=RAGConfig.INGESTION_QUEUE_SIZE
+        )
+        # PDF解析などCPUを使う処理（必要になるまでプロセスは起動しない）
+        self.parser_workers = RAGConfig.PARSER_PROCESS_WORKERS
+        self._process_pool = None
+        self._process_lock = threading.Lock()
+        self._parsing = 0
+        self._parsed = 0
+
+    def _get_process_pool(self) -> ProcessPoolExecutor:
+        with self._process_lock:
+            if self._process_pool is None:
+                # スレッドを持つ親プロセスからのforkを避けるためspawnを使用
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.parser_workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+                logger.info("Started parser process pool with %d workers", self.parser_workers)
+            return self._process_pool
+
+    def run_cpu_bound(self, func: Callable, *args) -> Any:
+        """
+        CPU負荷の高い処理をプロセスプールで実行する（同期呼び出し）
+        ワーカースレッドから呼び出すことを想定している
+
+        Args:
+            func: モジュールレベルの関数（pickle可能であること）
+            *args: 関数に渡す引数
+
+        Returns:
+            関数の戻り値
+        """
+        with self._process_lock:
+            self._parsing += 1
+        try:
+            if self.parser_workers <= 0:
+                return func(*args)
+            return self._get_process_pool().submit(func, *args).result()
+        finally:
+            with self._process_lock:
+                self._parsing -= 1
+                self._parsed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """実行レイヤー全体のメトリクスを取得"""
+        return {
+            "io": self.io.stats(),
+            "search": self.search.stats(),
+            "ingest": self.ingest.stats(),
+            "parser": {
+                "processes": self.parser_workers,
+                "in_flight": self._parsing,
+                "completed": self._parsed,
+            },
+        }
+
+    def shutdown(self) -> None:
+        """すべてのプールを停止"""
+        self.io.shutdown()
+        self.search.shutdown()
+        self.ingest.shutdown()
+        with self._process_lock:
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=False, cancel_futures=True)
+                self._process_pool = None
+
+
+# アプリケーション全体で共有する実行レイヤー
+execution_layer = ExecutionLayer()
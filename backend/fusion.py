@@ -0,0 +1,126 @@
+"""
+スコア統合 - ハイブリッド検索の候補をNumPy配列上で統合し、上位k件を選択する
+"""
+from typing import Any, List, Tuple
+
+import numpy as np
+
+
+def top_k_indices(scores: np.ndarray, k: int, descending: bool = True) -> np.ndarray:
+    """
+    スコアの上位k件のインデックスを順位順に取得
+    全件をソートせず、argpartitionで上位k件を選んでからその中だけをソートする
+
+    Args:
+        scores: スコアの配列
+        k: 取得する件数
+        descending: Trueの場合は大きいほど上位、Falseの場合は小さいほど上位
+
+    Returns:
+        上位k件のインデックス（同点の場合は元の順序が先のものを上位とする）
+    """
+    keys = -scores if descending else scores
+    if k <= 0 or len(keys) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(keys):
+        indices = np.argpartition(keys, k - 1)[:k]
+    else:
+        indices = np.arange(len(keys))
+    return indices[np.lexsort((indices, keys[indices]))]
+
+
+def select_top_k(items: List[Tuple[Any, float]], k: int, descending: bool = True) -> List[Tuple[Any, float]]:
+    """
+    (要素, スコア)のリストから上位k件を順位順に取得
+
+    Args:
+        items: (要素, スコア)のタプルのリスト
+        k: 取得する件数
+        descending: Trueの場合は大きいほど上位、Falseの場合は小さいほど上位
+
+    Returns:
+        上位k件の(要素, スコア)のタプルのリスト
+    """
+    scores = np.fromiter((score for _, score in items), dtype=np.float64, count=len(items))
+    return [items[i] for i in top_k_indices(scores, k, descending)]
+
+
+def _min_max(values: np.ndarray) -> np.ndarray:
+    """0-1に正規化（すべて同じ値の場合は0）"""
+    low = values.min()
+    value_range = values.max() - low
+    return (values - low) / value_range if value_range > 0 else np.zeros_like(values)
+
+
+def weighted_min_max_fusion(vector_keys: np.ndarray, vector_distances: np.ndarray,
+                            bm25_keys: np.ndarray, bm25_scores: np.ndarray,
+                            vector_weight: float, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    ベクトル検索とBM25の候補を、それぞれ0-1に正規化した重み付き和で統合
+
+    Args:
+        vector_keys: ベクトル検索の候補の識別子
+        vector_distances: ベクトル検索の距離（小さいほど良い）
+        bm25_keys: BM25の候補の識別子
+        bm25_scores: BM25スコア（大きいほど良い）
+        vector_weight: ベクトル検索の重み (0.0-1.0)、BM25の重みは (1 - vector_weight)
+        k: 取得する件数
+
+    Returns:
+        (候補の位置, 統合スコア) の配列のタプル（統合スコアの降順）
+        候補の位置はベクトル検索の候補、BM25の候補の順に連結したリスト上での位置
+        （同じ識別子が両方にある場合は最初に現れた位置）
+    """
+    vector_count = len(vector_keys)
+    keys = np.concatenate([vector_keys, bm25_keys])
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    unique_keys, first_positions, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    vector_part = np.zeros(len(unique_keys))
+    bm25_part = np.zeros(len(unique_keys))
+    if vector_count:
+        # 距離は小さいほど良いため反転する（すべて同じ距離の場合は1）
+        vector_part[inverse[:vector_count]] = 1 - _min_max(vector_distances.astype(np.float64))
+    if len(bm25_keys):
+        bm25_part[inverse[vector_count:]] = _min_max(bm25_scores.astype(np.float64))
+    fused = vector_part * vector_weight + bm25_part * (1 - vector_weight)
+
+    # 同点の場合に候補の出現順を保つよう、出現順に並べ替えてから上位を選ぶ
+    order = np.argsort(first_positions, kind="stable")
+    top = order[top_k_indices(fused[order], k)]
+    return first_positions[top], fused[top]
+
+
+def reciprocal_rank_fusion(vector_keys: np.ndarray, bm25_keys: np.ndarray, vector_weight: float,
+                           k: int, rrf_k: int = 60) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    ベクトル検索とBM25の候補を、順位の逆数の重み付き和（Reciprocal Rank Fusion）で統合
+    スコアの尺度に依存せず、それぞれの順位だけを使う
+
+    Args:
+        vector_keys: ベクトル検索の候補の識別子（順位順）
+        bm25_keys: BM25の候補の識別子（順位順）
+        vector_weight: ベクトル検索の重み (0.0-1.0)、BM25の重みは (1 - vector_weight)
+        k: 取得する件数
+        rrf_k: 順位に加える定数（大きいほど下位の候補との差が小さくなる）
+
+    Returns:
+        (候補の位置, 統合スコア) の配列のタプル（統合スコアの降順）
+        候補の位置は weighted_min_max_fusion と同じく、連結したリスト上で最初に現れた位置
+    """
+    vector_count = len(vector_keys)
+    keys = np.concatenate([vector_keys, bm25_keys])
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    unique_keys, first_positions, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    contributions = np.concatenate([
+        vector_weight / (rrf_k + np.arange(1, vector_count + 1)),
+        (1 - vector_weight) / (rrf_k + np.arange(1, len(bm25_keys) + 1)),
+    ])
+    fused = np.bincount(inverse, weights=contributions, minlength=len(unique_keys))
+
+    order = np.argsort(first_positions, kind="stable")
+    top = order[top_k_indices(fused[order], k)]
+    return first_positions[top], fused[top]
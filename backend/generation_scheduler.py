@@ -0,0 +1,259 @@
+"""
+生成スケジューラ - Ollamaへの生成リクエストの同時実行数をモデルごとに制限し、待ち行列をクライアント間で公平に処理する
+"""
+import asyncio
+import math
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Set
+
+from config import RAGConfig
+from exceptions import GenerationQueueFullError, GenerationQueueTimeoutError
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class _ModelQueue:
+    """1つのモデルの実行状況と待ち行列"""
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        self.reserved = 0  # 受け付け済みで、まだ待ち行列に入っていないチケット
+        # クライアントID -> そのクライアントの待ちチケット（先頭のクライアントから順に1件ずつ実行する）
+        self.clients: "OrderedDict[str, Deque[GenerationTicket]]" = OrderedDict()
+        self.queued = 0
+        self.pending: Counter = Counter()  # クライアントごとの実行前（受け付け済み + 待ち行列）のチケット数
+        self.changed = asyncio.Event()  # 待ち行列が変化したときにセットし、新しいものに差し替える
+        self.avg_duration: Optional[float] = None  # 生成1件の所要時間の移動平均（秒）
+
+    def notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def release_pending(self, client_id: str) -> None:
+        self.pending[client_id] -= 1
+        if self.pending[client_id] <= 0:
+            del self.pending[client_id]
+
+
+class GenerationTicket:
+    """
+    1件の生成の実行権
+    wait() で順番を待ち、生成が終わったら（または生成しなかった場合も）release() で返す
+    """
+
+    def __init__(self, scheduler: "GenerationScheduler", model: str, client_id: str):
+        self.model = model
+        self.client_id = client_id
+        self._scheduler = scheduler
+        self._granted = asyncio.Event()
+        self._state = "reserved"  # reserved -> queued -> running -> released
+        self._started_at: Optional[float] = None
+
+    @property
+    def granted(self) -> bool:
+        return self._granted.is_set()
+
+    async def wait(self) -> AsyncIterator[int]:
+        """
+        実行の順番を待つ（すぐに実行できる場合は何も返さずに終わる）
+
+        Yields:
+            待ち行列での順番（1が次に実行されるもの、変化したときだけ返す）
+
+        Raises:
+            GenerationQueueTimeoutError: GENERATION_QUEUE_TIMEOUT 秒以内に順番が来なかった場合
+        """
+        scheduler = self._scheduler
+        if self._state == "reserved":
+            scheduler._enqueue(self)
+        queue = scheduler._queue(self.model)
+        deadline = time.monotonic() + scheduler.queue_timeout
+        last_position = None
+        while not self.granted:
+            changed = queue.changed
+            position = scheduler._position(self)
+            if position != last_position:
+                last_position = position
+                yield position
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                scheduler._timeouts += 1
+                self.release()
+                raise GenerationQueueTimeoutError(
+                    f"Generation for model '{self.model}' did not start within {scheduler.queue_timeout:.0f}s"
+                )
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def acquire(self) -> None:
+        """順番が来るまで待つ（順番の通知が不要な場合）"""
+        async for _position in self.wait():
+            pass
+
+    def release(self) -> None:
+        """実行権を返す（何度呼んでもよい）"""
+        self._scheduler._release(self)
+
+    async def arelease(self) -> None:
+        """release の非同期版（イベントループ上で実行させたいコールバック用）"""
+        self.release()
+
+
+class GenerationScheduler:
+    """モデルごとの同時生成数の上限と、上限付きの公平な待ち行列"""
+
+    def __init__(self, concurrency: int = None, max_queue: int = None, max_queue_per_client: int = None,
+                 queue_timeout: float = None):
+        """
+        Args:
+            concurrency: モデルごとの同時生成数
+            max_queue: モデルごとに待たせるリクエスト数の上限（超えた場合は受け付けない）
+            max_queue_per_client: 1クライアントが同時に待たせられるリクエスト数の上限
+            queue_timeout: 待ち行列で待つ時間の上限（秒）
+        """
+        self.concurrency = concurrency or RAGConfig.GENERATION_CONCURRENCY
+        self.max_queue = max_queue if max_queue is not None else RAGConfig.GENERATION_MAX_QUEUE
+        self.max_queue_per_client = max_queue_per_client or RAGConfig.GENERATION_MAX_QUEUE_PER_CLIENT
+        self.queue_timeout = queue_timeout or RAGConfig.GENERATION_QUEUE_TIMEOUT
+        self._queues: Dict[str, _ModelQueue] = {}
+        self._admitted = 0
+        self._rejected = 0
+        self._timeouts = 0
+
+    def _queue(self, model: str) -> _ModelQueue:
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = _ModelQueue(self.concurrency)
+        return queue
+
+    def admit(self, model: str, client_id: str) -> GenerationTicket:
+        """
+        生成リクエストを受け付ける（イベントループ上で呼ぶ）
+
+        Args:
+            model: モデル名
+            client_id: クライアントの識別子（公平性の単位）
+
+        Returns:
+            実行権のチケット
+
+        Raises:
+            GenerationQueueFullError: 待ち行列に空きがない場合（retry_after に再試行までの目安の秒数）
+        """
+        queue = self._queue(model)
+        free_slots = max(queue.concurrency - queue.running, 0)
+        waiting = queue.reserved + queue.queued
+        if waiting - free_slots >= self.max_queue or queue.pending[client_id] >= self.max_queue_per_client:
+            self._rejected += 1
+            raise GenerationQueueFullError(model, self._retry_after(queue))
+        queue.reserved += 1
+        queue.pending[client_id] += 1
+        self._admitted += 1
+        return GenerationTicket(self, model, client_id)
+
+    def _retry_after(self, queue: _ModelQueue) -> int:
+        """待ち行列が1件分進むまでの目安の秒数"""
+        average = queue.avg_duration or RAGConfig.GENERATION_DEFAULT_DURATION
+        waiting = queue.reserved + queue.queued
+        return max(1, min(math.ceil(average * (waiting + 1) / queue.concurrency), 300))
+
+    def _enqueue(self, ticket: GenerationTicket) -> None:
+        queue = self._queue(ticket.model)
+        queue.reserved -= 1
+        ticket._state = "queued"
+        queue.clients.setdefault(ticket.client_id, deque()).append(ticket)
+        queue.queued += 1
+        self._dispatch(queue)
+        queue.notify()
+
+    def _dispatch(self, queue: _ModelQueue) -> None:
+        """空いている枠に、クライアントを順番に回りながら1件ずつ割り当てる（通知は呼び出し側で行う）"""
+        while queue.running < queue.concurrency and queue.clients:
+            client_id, tickets = next(iter(queue.clients.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                queue.clients.move_to_end(client_id)
+            else:
+                del queue.clients[client_id]
+            queue.queued -= 1
+            queue.release_pending(client_id)
+            queue.running += 1
+            ticket._state = "running"
+            ticket._started_at = time.monotonic()
+            ticket._granted.set()
+
+    def _position(self, ticket: GenerationTicket) -> int:
+        """待ち行列での順番（クライアントを順番に回る順序での位置、1始まり）"""
+        queue = self._queue(ticket.model)
+        tickets = queue.clients.get(ticket.client_id)
+        if not tickets or ticket not in tickets:
+            return 0
+        rounds = tickets.index(ticket)
+        position = 1
+        ahead = True
+        for client_id, client_tickets in queue.clients.items():
+            if client_id == ticket.client_id:
+                # 同じクライアントの前のチケットは、それぞれ前の周回で実行される
+                position += rounds
+                ahead = False
+            else:
+                # 前にいるクライアントは同じ周回でも先に実行される
+                position += min(len(client_tickets), rounds + 1 if ahead else rounds)
+        return position
+
+    def _release(self, ticket: GenerationTicket) -> None:
+        queue = self._queue(ticket.model)
+        state = ticket._state
+        ticket._state = "released"
+        if state == "reserved":
+            queue.reserved -= 1
+            queue.release_pending(ticket.client_id)
+        elif state == "queued":
+            tickets = queue.clients[ticket.client_id]
+            tickets.remove(ticket)
+            if not tickets:
+                del queue.clients[ticket.client_id]
+            queue.queued -= 1
+            queue.release_pending(ticket.client_id)
+            queue.notify()
+        elif state == "running":
+            queue.running -= 1
+            duration = time.monotonic() - ticket._started_at
+            queue.avg_duration = duration if queue.avg_duration is None else queue.avg_duration * 0.8 + duration * 0.2
+            self._dispatch(queue)
+            queue.notify()
+
+    def busy_models(self) -> Set[str]:
+        """生成中または順番待ちのリクエストがあるモデル"""
+        return {model for model, queue in self._queues.items() if queue.running or queue.queued or queue.reserved}
+
+    def stats(self) -> Dict[str, Any]:
+        """スケジューラのメトリクスを取得"""
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "max_queue_per_client": self.max_queue_per_client,
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+            "timeouts": self._timeouts,
+            "models": {
+                model: {
+                    "running": queue.running,
+                    "queued": queue.queued,
+                    "reserved": queue.reserved,
+                    "clients_waiting": len(queue.clients),
+                    "avg_duration_s": round(queue.avg_duration, 3) if queue.avg_duration is not None else None,
+                }
+                for model, queue in self._queues.items()
+            },
+        }
+
+
+# アプリケーション全体で共有する生成スケジューラ
+generation_scheduler = GenerationScheduler()
@@ -0,0 +1,270 @@
+"""
+取り込みジョブキュー - アップロードされたファイルをバックグラウンドでベクトルストアに登録する
+"""
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from config import RAGConfig
+from exceptions import IngestionQueueFullError, IngestionUnavailableError
+from executor import execution_layer
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class IngestionJobQueue:
+    """取り込みジョブを管理し、ワーカーで非同期に処理するクラス"""
+
+    def __init__(self, max_workers: int = None, max_pending: int = None, history_limit: int = None):
+        """
+        Args:
+            max_workers: 同時に取り込むファイル数
+            max_pending: 処理待ちとして受け付けるファイル数の上限
+            history_limit: 保持するジョブ履歴の件数
+        """
+        self.max_workers = max_workers or RAGConfig.INGESTION_WORKERS
+        self.max_pending = max_pending or RAGConfig.INGESTION_QUEUE_SIZE
+        self.history_limit = history_limit or RAGConfig.INGESTION_JOB_HISTORY
+
+        self._jobs: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()  # ワーカースレッドからも進捗を更新するため
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._ingest_func: Optional[Callable] = None
+        self._ready: Optional[asyncio.Event] = None
+        self._error: Optional[str] = None  # 起動時の初期化に失敗した場合のエラー
+
+    async def start(self, ingest_func: Callable, ready: asyncio.Event = None) -> None:
+        """
+        ワーカーを起動
+
+        Args:
+            ingest_func: ファイル1件を取り込む同期関数
+                         (file_path, tags=..., content_hash=..., progress=...) を受け取る
+            ready: 指定した場合、セットされるまで取り込みを始めない（ジョブの登録は先に受け付ける）
+        """
+        self._ingest_func = ingest_func
+        self._ready = ready
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._workers = [
+            asyncio.create_task(self._worker(i)) for i in range(self.max_workers)
+        ]
+        logger.info("Ingestion queue started with %d workers", self.max_workers)
+
+    async def stop(self) -> None:
+        """ワーカーを停止"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, files: List[dict], tags: List[str] = None) -> dict:
+        """
+        取り込みジョブを登録
+
+        Args:
+            files: {"filename", "path", "size", "sha256"} を持つ辞書のリスト
+            tags: ファイルに付与するタグ
+
+        Returns:
+            登録されたジョブ情報
+
+        Raises:
+            IngestionQueueFullError: 処理待ちキューに空きがない場合
+            IngestionUnavailableError: 起動時の初期化に失敗している場合
+        """
+        if self._queue is None:
+            raise RuntimeError("Ingestion queue is not started")
+        if self._error is not None:
+            raise IngestionUnavailableError(f"Ingestion is unavailable: {self._error}")
+        if self._queue.qsize() + len(files) > self.max_pending:
+            raise IngestionQueueFullError(
+                f"Ingestion queue is full ({self._queue.qsize()}/{self.max_pending} files pending)"
+            )
+
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "tags": tags or [],
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "finished_at": None,
+            "total_chunks": 0,
+            "files": [
+                {
+                    "filename": f["filename"],
+                    "size": f.get("size"),
+                    "sha256": f.get("sha256"),
+                    "stage": "queued",
+                    "chunks": 0,
+                    "elapsed_sec": 0.0,
+                    "chunks_per_sec": 0.0,
+                    "embedding_chunks_per_sec": 0.0,
+                    "error": None,
+                }
+                for f in files
+            ],
+        }
+
+        with self._lock:
+            self._jobs[job_id] = job
+            # 古い完了済みジョブから履歴を削除
+            while len(self._jobs) > self.history_limit:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if oldest["status"] in ("queued", "running"):
+                    break
+                del self._jobs[oldest_id]
+
+        for index, f in enumerate(files):
+            self._queue.put_nowait((job_id, index, f["path"], f.get("sha256")))
+
+        logger.info("Ingestion job %s queued with %d files", job_id, len(files))
+        return self.get_job(job_id)
+
+    def fail(self, error: Exception) -> None:
+        """
+        起動時の初期化に失敗したことを記録し、取り込みを待っているファイルをエラーにする
+        （以降のジョブの登録は IngestionUnavailableError で拒否する）
+
+        Args:
+            error: 初期化で発生した例外
+        """
+        self._error = str(error)
+        job_ids = set()
+        while self._queue is not None and not self._queue.empty():
+            job_id, index, _path, _content_hash = self._queue.get_nowait()
+            self._queue.task_done()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    continue
+                file_info = job["files"][index]
+                file_info["stage"] = "error"
+                file_info["error"] = f"Ingestion is unavailable: {self._error}"
+            job_ids.add(job_id)
+        for job_id in job_ids:
+            self._update_job_status(job_id)
+        logger.error("Ingestion queue failed, %d pending jobs marked as failed", len(job_ids))
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        """
+        ジョブ情報を取得
+
+        Args:
+            job_id: ジョブID
+
+        Returns:
+            ジョブ情報（存在しない場合はNone）
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {**job, "files": [dict(f) for f in job["files"]]}
+
+    def list_jobs(self) -> List[dict]:
+        """新しい順にジョブの概要を取得"""
+        with self._lock:
+            return [
+                {
+                    "job_id": job["job_id"],
+                    "status": job["status"],
+                    "created_at": job["created_at"],
+                    "finished_at": job["finished_at"],
+                    "file_count": len(job["files"]),
+                    "total_chunks": job["total_chunks"],
+                }
+                for job in reversed(self._jobs.values())
+            ]
+
+    def stats(self) -> Dict[str, int]:
+        """キューのメトリクスを取得"""
+        with self._lock:
+            statuses = [job["status"] for job in self._jobs.values()]
+        return {
+            "workers": self.max_workers,
+            "pending_files": self._queue.qsize() if self._queue else 0,
+            "max_pending": self.max_pending,
+            "queued_jobs": statuses.count("queued"),
+            "running_jobs": statuses.count("running"),
+        }
+
+    async def _worker(self, worker_id: int) -> None:
+        """キューからファイルを取り出して取り込む"""
+        if self._ready is not None:
+            await self._ready.wait()
+        while True:
+            job_id, index, path, content_hash = await self._queue.get()
+            try:
+                await self._process_file(job_id, index, path, content_hash)
+            except Exception as e:
+                logger.error("Ingestion worker %d failed: %s", worker_id, e, exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def _process_file(self, job_id: str, index: int, path: str, content_hash: str = None) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job["status"] = "running"
+            tags = job["tags"]
+            file_info = job["files"][index]
+        started_at = time.perf_counter()
+
+        def progress(stage: str, chunks: int = None, embedding_chunks_per_sec: float = None) -> None:
+            # ワーカースレッドから呼ばれる
+            with self._lock:
+                file_info["stage"] = stage
+                if chunks is not None:
+                    file_info["chunks"] = chunks
+                if embedding_chunks_per_sec is not None:
+                    file_info["embedding_chunks_per_sec"] = embedding_chunks_per_sec
+                file_info["elapsed_sec"] = round(time.perf_counter() - started_at, 3)
+
+        try:
+            chunk_count = await execution_layer.ingest.run(
+                self._ingest_func, path, tags=tags, content_hash=content_hash, progress=progress
+            )
+            elapsed = time.perf_counter() - started_at
+            with self._lock:
+                file_info["stage"] = "done"
+                file_info["chunks"] = chunk_count
+                file_info["elapsed_sec"] = round(elapsed, 3)
+                file_info["chunks_per_sec"] = round(chunk_count / elapsed, 2) if elapsed > 0 else 0.0
+                job["total_chunks"] += chunk_count
+            logger.info("Ingested %s: %d chunks in %.2fs", file_info["filename"], chunk_count, elapsed)
+        except Exception as e:
+            logger.error("Error ingesting %s: %s", file_info["filename"], e, exc_info=True)
+            with self._lock:
+                file_info["stage"] = "error"
+                file_info["error"] = str(e)
+                file_info["elapsed_sec"] = round(time.perf_counter() - started_at, 3)
+        finally:
+            self._update_job_status(job_id)
+
+    def _update_job_status(self, job_id: str) -> None:
+        """全ファイルの状態からジョブの状態を更新"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            stages = [f["stage"] for f in job["files"]]
+            if any(stage not in ("done", "error") for stage in stages):
+                return
+            if all(stage == "done" for stage in stages):
+                job["status"] = "completed"
+            elif all(stage == "error" for stage in stages):
+                job["status"] = "failed"
+            else:
+                job["status"] = "partial"
+            job["finished_at"] = datetime.now().isoformat(timespec="seconds")
+
+
+# アプリケーション全体で共有する取り込みキュー
+ingestion_queue = IngestionJobQueue()
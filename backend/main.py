@@ -1,13 +1,107 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import Depends, FastAPI, UploadFile, File, HTTPException, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import List, Literal, Optional, Dict
+from contextlib import asynccontextmanager
+import asyncio
 import os
+from config import RAGConfig
+from exceptions import (
+    FileTooLargeError, GenerationQueueFullError, GenerationQueueTimeoutError, IngestionQueueFullError,
+    IngestionUnavailableError
+)
+from executor import execution_layer
+from generation_scheduler import generation_scheduler
+from ingestion import ingestion_queue
+from logger import setup_logger
+from model_manager import model_manager
+from ollama_client import ollama_client
 from rag_service import RAGService
+from readiness import readiness
+from upload_storage import discard_uploads, save_upload_stream
+
+logger = setup_logger(__name__)
+
+# RAGサービスのインスタンス（起動後にバックグラウンドで初期化）
+rag_service: RAGService = None
+# RAGサービスの初期化の完了（検索・一覧などを受け付けられる）と、BM25インデックスの読み込みの完了（取り込みを始められる）
+rag_service_ready = asyncio.Event()
+ingestion_ready = asyncio.Event()
+startup_error: Optional[Exception] = None
+
+
+def ingest_document(*args, **kwargs) -> int:
+    """取り込みワーカーから呼ぶ取り込み処理（初期化の完了後に呼ばれる）"""
+    return rag_service.add_documents(*args, **kwargs)
+
+
+async def initialize_services() -> None:
+    """
+    RAGサービスを初期化（サーバーはその間もリクエストを受け付け、初期化が終わるまで待たせる）
+    ベクトルストアとカタログを開いた時点で検索を受け付け、BM25インデックスはその後に読み込む
+    """
+    global rag_service, startup_error
+    try:
+        # ファイル解析用のspawnプロセスがこのモジュールを再インポートしても初期化されないよう、
+        # モジュールのトップレベルではなくここで生成する（ブロッキング処理のためワーカースレッドで実行）
+        rag_service = await execution_layer.io.run(RAGService)
+        rag_service_ready.set()
+        # 既定のモデルの読み込みと、使用中のモデルの keep_alive の延長
+        model_manager.start(rag_service.model_name, pinned=[rag_service.embedding_model])
+        await execution_layer.io.run(rag_service.load_bm25_index)
+        ingestion_ready.set()
+        readiness.ready("ingestion")
+    except Exception as e:
+        startup_error = e
+        logger.error("Failed to initialize RAG service: %s", e, exc_info=True)
+        # 取り込みは始められないため、待っているジョブをエラーにし、以降のアップロードは503で拒否する
+        ingestion_queue.fail(e)
 
-app = FastAPI(title="Local LLM RAG System")
+
+async def require_rag_service() -> None:
+    """
+    RAGサービスを使うエンドポイントの依存関係
+    初期化中は STARTUP_WAIT_TIMEOUT 秒まで待ち、それでも終わらない場合や初期化に失敗した場合は503を返す
+    """
+    if rag_service_ready.is_set():
+        return
+    if startup_error is None:
+        try:
+            await asyncio.wait_for(rag_service_ready.wait(), RAGConfig.STARTUP_WAIT_TIMEOUT)
+            return
+        except asyncio.TimeoutError:
+            pass
+    detail = f"Service failed to start: {startup_error}" if startup_error else "Service is starting up"
+    raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """アプリケーションの起動・終了処理"""
+    # Ollamaへの接続プール（生成・埋め込み・ヘルスチェックで共有）
+    ollama_client.start()
+    # RAGサービスはバックグラウンドで初期化し、その間もリクエストを受け付ける（状態は /ready で確認できる）
+    readiness.register("vectorstore", "document_catalog", "bm25_index", "ingestion")
+    startup_task = asyncio.create_task(initialize_services())
+    # 取り込みワーカーを起動（ジョブはすぐに受け付け、取り込みは初期化の完了後に始める）
+    await ingestion_queue.start(ingest_document, ready=ingestion_ready)
+    yield
+    startup_task.cancel()
+    await asyncio.gather(startup_task, return_exceptions=True)
+    await model_manager.stop()
+    # ワーカースレッド・プロセスを停止
+    await ingestion_queue.stop()
+    # 次回起動時に再構築せずに済むようBM25インデックスを保存
+    if rag_service is not None:
+        await execution_layer.io.run(rag_service.save_bm25_index)
+    execution_layer.shutdown()
+    await ollama_client.aclose()
+
+
+app = FastAPI(title="Local LLM RAG System", lifespan=lifespan)
 
 # CORS設定
 app.add_middleware(
@@ -22,10 +116,6 @@ app.add_middleware(
 app.mount("/css", StaticFiles(directory="../frontend/css"), name="css")
 app.mount("/js", StaticFiles(directory="../frontend/js"), name="js")
 
-# RAGサービスのインスタンス化
-rag_service = RAGService()
-
-
 class Message(BaseModel):
     role: str  # "user" or "assistant"
     content: str
@@ -37,9 +127,11 @@ class QueryRequest(BaseModel):
     use_rag: bool = True  # RAG使用のON/OFF
     query_expansion: bool = False
     use_hybrid_search: bool = True  # ハイブリッド検索のON/OFF
+    fusion_strategy: Optional[Literal["weighted", "rrf"]] = None  # ハイブリッド検索のスコア統合方式（Noneの場合は設定値）
     chat_history: Optional[List[Message]] = None  # 会話履歴
     system_prompt: Optional[str] = None  # システムプロンプト（キャラクター設定）
     tags: Optional[List[str]] = None  # タグフィルタ
+    semantic_cache: bool = True  # 言い換えた質問にもキャッシュした回答を使うか（Falseで無効）
     # 主要パラメータ (★)
     temperature: Optional[float] = None
     document_count: Optional[int] = None
@@ -80,6 +172,7 @@ class QueryResponse(BaseModel):
 class ModelListResponse(BaseModel):
     models: List[str]
     default_model: str
+    loaded_models: List[str] = []  # Ollamaのメモリに読み込まれているモデル（切り替えても読み込み待ちがない）
 
 
 @app.get("/")
@@ -88,66 +181,111 @@ async def read_root():
     return FileResponse("../frontend/index.html")
 
 
-@app.post("/upload")
+@app.post("/upload", status_code=202)
 async def upload_documents(
     files: List[UploadFile] = File(...),
     tags: Optional[str] = Form(None)  # カンマ区切りのタグ文字列
 ):
     """
-    ファイルをアップロードしてベクトルストアに追加
+    ファイルをアップロードし、ベクトルストアへの取り込みジョブを登録
     対応フォーマット: PDF, TXT, MD, CSV
     タグを指定することで、ドキュメントを分類できます
+    取り込みはバックグラウンドで行われ、進捗は /jobs/{job_id} で確認できます
     """
     try:
-        # サポートされている拡張子
-        SUPPORTED_EXTENSIONS = {'.pdf', '.txt', '.md', '.csv'}
-
         # タグをリストに変換
         tag_list = []
         if tags:
             tag_list = [tag.strip() for tag in tags.split(',') if tag.strip()]
 
-        uploaded_files = []
+        # 拡張子チェック（保存前にすべてのファイルを確認）
         for file in files:
-            # 拡張子チェック
             file_extension = os.path.splitext(file.filename)[1].lower()
-            if file_extension not in SUPPORTED_EXTENSIONS:
+            if file_extension not in RAGConfig.SUPPORTED_EXTENSIONS:
                 raise HTTPException(
                     status_code=400,
                     detail=f"{file.filename} はサポートされていないファイル形式です。対応: PDF, TXT, MD, CSV"
                 )
 
-            # ファイルを一時保存
-            file_path = f"../uploads/{file.filename}"
-            os.makedirs("../uploads", exist_ok=True)
-
-            with open(file_path, "wb") as f:
-                content = await file.read()
-                f.write(content)
-
-            # ベクトルストアに追加（タグ付き）
-            rag_service.add_documents(file_path, tags=tag_list)
-            uploaded_files.append(file.filename)
+        uploaded_files = []
+        try:
+            for file in files:
+                # チャンク単位でディスクに保存（サイズ上限の確認とハッシュ計算を同時に行う）
+                uploaded_files.append(await save_upload_stream(file))
+        except FileTooLargeError as e:
+            # 同じリクエストで保存済みのファイルは取り込まないため削除
+            discard_uploads(uploaded_files)
+            raise HTTPException(status_code=413, detail=str(e))
+
+        # 取り込みジョブを登録（ベクトル化はバックグラウンドで実行）
+        try:
+            job = ingestion_queue.submit(uploaded_files, tags=tag_list)
+        except (IngestionQueueFullError, IngestionUnavailableError):
+            # 受け付けなかったファイルは取り込まないため削除
+            discard_uploads(uploaded_files)
+            raise
 
         return {
-            "message": "Documents uploaded successfully",
-            "files": uploaded_files,
+            "message": "Documents accepted for ingestion",
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "files": [f["filename"] for f in uploaded_files],
             "tags": tag_list
         }
+    except HTTPException:
+        raise
+    except IngestionQueueFullError as e:
+        return JSONResponse(status_code=503, content={"detail": str(e)}, headers={"Retry-After": "30"})
+    except IngestionUnavailableError as e:
+        return JSONResponse(status_code=503, content={"detail": str(e)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest):
+@app.get("/jobs")
+async def list_jobs():
+    """
+    取り込みジョブの一覧を取得（新しい順）
+    """
+    return {"jobs": ingestion_queue.list_jobs()}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    取り込みジョブの進捗を取得
+    ファイルごとの処理段階、チャンク数、処理速度、エラーを返す
+    """
+    job = ingestion_queue.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+def get_client_id(http_request: Request) -> str:
+    """生成の待ち行列で公平に扱う単位（X-Client-ID ヘッダー、なければ接続元のアドレス）"""
+    client_id = http_request.headers.get("X-Client-ID")
+    if client_id:
+        return client_id
+    return http_request.client.host if http_request.client else "unknown"
+
+
+def queue_full_response(e: GenerationQueueFullError) -> JSONResponse:
+    """生成の待ち行列に空きがない場合の応答（429、再試行までの目安を Retry-After で返す）"""
+    return JSONResponse(status_code=429, content={"detail": str(e)}, headers={"Retry-After": str(e.retry_after)})
+
+
+@app.post("/query", response_model=QueryResponse, dependencies=[Depends(require_rag_service)])
+async def query(request: QueryRequest, http_request: Request):
     """
     質問に対してRAGで回答を生成（非ストリーミング）
+    生成は生成スケジューラの枠が空くまで待ち、待ち行列に空きがない場合は429を返す（キャッシュした回答は待たずに返す）
     """
     try:
         # 会話履歴を辞書形式に変換
         chat_history = [{"role": msg.role, "content": msg.content} for msg in request.chat_history] if request.chat_history is not None else []
 
-        answer, sources, source_scores = rag_service.query(
+        answer, sources, source_scores = await rag_service.query(
             request.question,
             model_name=request.model,
             use_rag=request.use_rag,
@@ -155,6 +293,7 @@ async def query(request: QueryRequest):
             chat_history=chat_history,
             temperature=request.temperature,
             k=request.document_count,
+            search_multiplier=request.search_multiplier,
             top_p=request.top_p,
             repeat_penalty=request.repeat_penalty,
             num_predict=request.num_predict,
@@ -173,106 +312,152 @@ async def query(request: QueryRequest):
             num_thread=request.num_thread,
             num_gpu=request.num_gpu,
             typical_p=request.typical_p,
-            penalize_newline=request.penalize_newline
+            penalize_newline=request.penalize_newline,
+            tags=request.tags,
+            use_semantic_cache=request.semantic_cache,
+            client_id=get_client_id(http_request)
         )
         return QueryResponse(answer=answer, sources=sources, source_scores=source_scores)
+    except GenerationQueueFullError as e:
+        return queue_full_response(e)
+    except GenerationQueueTimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/query/stream")
-async def query_stream(request: QueryRequest):
+@app.post("/query/stream", dependencies=[Depends(require_rag_service)])
+async def query_stream(request: QueryRequest, http_request: Request):
     """
     質問に対してRAGで回答を生成（ストリーミング）
+    生成の順番を待っている間は "__QUEUE__:{json}" のイベントで待ち行列での順番を通知し、
+    待ち行列に空きがない場合はストリームを開始せずに429を返す（キャッシュした回答は待たずに返す）
     """
     try:
         # 会話履歴を辞書形式に変換
         chat_history = [{"role": msg.role, "content": msg.content} for msg in request.chat_history] if request.chat_history is not None else []
 
-        async def generate():
-            async for chunk in rag_service.query_stream(
-                request.question,
-                model_name=request.model,
-                use_rag=request.use_rag,
-                enable_query_expansion=request.query_expansion,
-                use_hybrid_search=request.use_hybrid_search,
-                chat_history=chat_history,
-                system_prompt=request.system_prompt,
-                tags=request.tags,  # タグフィルタを追加
-                temperature=request.temperature,
-                k=request.document_count,
-                search_multiplier=request.search_multiplier,
-                top_p=request.top_p,
-                repeat_penalty=request.repeat_penalty,
-                num_predict=request.num_predict,
-                top_k=request.top_k,
-                num_ctx=request.num_ctx,
-                seed=request.seed,
-                mirostat=request.mirostat,
-                mirostat_tau=request.mirostat_tau,
-                mirostat_eta=request.mirostat_eta,
-                tfs_z=request.tfs_z,
-                stop=request.stop,
-                presence_penalty=request.presence_penalty,
-                frequency_penalty=request.frequency_penalty,
-                min_p=request.min_p,
-                repeat_last_n=request.repeat_last_n,
-                num_thread=request.num_thread,
-                num_gpu=request.num_gpu,
-                typical_p=request.typical_p,
-                penalize_newline=request.penalize_newline
-            ):
-                # チャンクの先頭の改行を削除してから送信
-                yield f"data: {chunk.lstrip()}\n\n"
-
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        stream = rag_service.query_stream(
+            request.question,
+            model_name=request.model,
+            use_rag=request.use_rag,
+            enable_query_expansion=request.query_expansion,
+            use_hybrid_search=request.use_hybrid_search,
+            chat_history=chat_history,
+            system_prompt=request.system_prompt,
+            tags=request.tags,  # タグフィルタを追加
+            fusion_strategy=request.fusion_strategy,
+            temperature=request.temperature,
+            k=request.document_count,
+            search_multiplier=request.search_multiplier,
+            top_p=request.top_p,
+            repeat_penalty=request.repeat_penalty,
+            num_predict=request.num_predict,
+            top_k=request.top_k,
+            num_ctx=request.num_ctx,
+            seed=request.seed,
+            mirostat=request.mirostat,
+            mirostat_tau=request.mirostat_tau,
+            mirostat_eta=request.mirostat_eta,
+            tfs_z=request.tfs_z,
+            stop=request.stop,
+            presence_penalty=request.presence_penalty,
+            frequency_penalty=request.frequency_penalty,
+            min_p=request.min_p,
+            repeat_last_n=request.repeat_last_n,
+            num_thread=request.num_thread,
+            num_gpu=request.num_gpu,
+            typical_p=request.typical_p,
+            penalize_newline=request.penalize_newline,
+            use_semantic_cache=request.semantic_cache,
+            client_id=get_client_id(http_request)
+        )
+        # 回答のキャッシュの確認と生成の受け付けは最初のチャンクの前に行われるため、
+        # 最初のチャンクを取得してからストリームを開始する（待ち行列に空きがない場合は429を返せる）
+        first_chunk = await anext(stream, None)
+    except GenerationQueueFullError as e:
+        return queue_full_response(e)
+    except GenerationQueueTimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-
-@app.get("/documents")
-async def list_documents():
+    async def generate():
+        if first_chunk is None:
+            return
+        # チャンクの先頭の改行を削除してから送信
+        yield f"data: {first_chunk.lstrip()}\n\n"
+        async for chunk in stream:
+            yield f"data: {chunk.lstrip()}\n\n"
+
+    # ストリームが最後まで送信されずに終わった場合も、生成の枠を返すよう閉じる（閉じ済みの場合は何もしない）
+    return StreamingResponse(generate(), media_type="text/event-stream",
+                             background=BackgroundTask(stream.aclose))
+
+
+@app.get("/documents", dependencies=[Depends(require_rag_service)])
+async def list_documents(
+    tags: Optional[List[str]] = Query(None),  # いずれかのタグを持つドキュメントに絞り込む
+    q: Optional[str] = None,  # ファイル名の部分一致
+    limit: Optional[int] = Query(None, ge=1),
+    offset: int = Query(0, ge=0)
+):
     """
     登録されているドキュメントの一覧を取得
     """
     try:
-        docs = rag_service.list_documents()
-        return {"documents": docs}
+        docs = await execution_layer.io.run(
+            rag_service.list_documents, tags=tags, query=q, limit=limit, offset=offset
+        )
+        total = await execution_layer.io.run(rag_service.count_documents, tags=tags, query=q)
+        return {"documents": docs, "total": total}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/tags")
-async def list_tags():
+@app.get("/tags", dependencies=[Depends(require_rag_service)])
+async def list_tags(
+    q: Optional[str] = None,  # タグの部分一致
+    limit: Optional[int] = Query(None, ge=1),
+    offset: int = Query(0, ge=0)
+):
     """
     登録されているタグの一覧を取得
     """
     try:
-        tags = rag_service.list_tags()
+        tags = await execution_layer.io.run(rag_service.list_tags, query=q, limit=limit, offset=offset)
         return {"tags": tags}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/documents/details")
-async def list_documents_with_tags():
+@app.get("/documents/details", dependencies=[Depends(require_rag_service)])
+async def list_documents_with_tags(
+    tags: Optional[List[str]] = Query(None),  # いずれかのタグを持つドキュメントに絞り込む
+    q: Optional[str] = None,  # ファイル名の部分一致
+    limit: Optional[int] = Query(None, ge=1),
+    offset: int = Query(0, ge=0)
+):
     """
     登録されているドキュメントとそのタグの詳細情報を取得
     """
     try:
-        docs = rag_service.list_documents_with_tags()
-        return {"documents": docs}
+        docs = await execution_layer.io.run(
+            rag_service.list_documents_with_tags, tags=tags, query=q, limit=limit, offset=offset
+        )
+        total = await execution_layer.io.run(rag_service.count_documents, tags=tags, query=q)
+        return {"documents": docs, "total": total}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.delete("/documents/{filename}")
+@app.delete("/documents/{filename}", dependencies=[Depends(require_rag_service)])
 async def delete_document(filename: str):
     """
     特定のドキュメントを削除
     """
     try:
-        success = rag_service.delete_document(filename)
+        success = await execution_layer.io.run(rag_service.delete_document, filename)
         if success:
             return {"message": f"{filename} deleted successfully"}
         else:
@@ -283,13 +468,13 @@ async def delete_document(filename: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/document/content/{filename}")
+@app.get("/document/content/{filename}", dependencies=[Depends(require_rag_service)])
 async def get_document_content(filename: str):
     """
     ドキュメントの内容を取得（プレビュー用）
     """
     try:
-        content = rag_service.get_document_content(filename)
+        content = await execution_layer.io.run(rag_service.get_document_content, filename)
         if content:
             return {"content": content, "filename": filename}
         else:
@@ -300,26 +485,28 @@ async def get_document_content(filename: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.delete("/documents")
+@app.delete("/documents", dependencies=[Depends(require_rag_service)])
 async def clear_documents():
     """
     すべてのドキュメントをクリア
     """
     try:
-        rag_service.clear_documents()
+        await execution_layer.io.run(rag_service.clear_documents)
         return {"message": "All documents cleared"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/models", response_model=ModelListResponse)
+@app.get("/models", response_model=ModelListResponse, dependencies=[Depends(require_rag_service)])
 async def list_models():
     """
     利用可能なOllamaモデルの一覧を取得
     """
     try:
-        models = rag_service.get_available_models()
-        return ModelListResponse(models=models, default_model=rag_service.model_name)
+        models = await rag_service.get_available_models()
+        await model_manager.refresh()
+        return ModelListResponse(models=models, default_model=rag_service.model_name,
+                                 loaded_models=model_manager.resident_models)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -331,10 +518,60 @@ async def health_check():
     """
     return {
         "status": "healthy",
-        "ollama_available": rag_service.check_ollama_connection()
+        "ready": readiness.is_ready(),
+        "ollama_available": await ollama_client.is_available()
+    }
+
+
+@app.get("/ready")
+async def readiness_check():
+    """
+    起動状態（コンポーネントごと）を取得
+    すべてのコンポーネントの準備ができていれば200、初期化中または失敗した場合は503を返す
+    accepting_queries は検索・質問を受け付けられるか（BM25インデックスの読み込み中はベクトル検索のみ）
+    """
+    components = readiness.stats()
+    components["ollama"] = {"status": "ready" if await ollama_client.is_available() else "unavailable"}
+    if model_manager.default_model is not None:
+        components["default_model"] = {
+            "status": "ready" if model_manager.is_resident(model_manager.default_model) else "loading",
+            "model": model_manager.default_model
+        }
+    ready = readiness.is_ready()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "accepting_queries": rag_service_ready.is_set(),
+            "error": str(startup_error) if startup_error else None,
+            "components": components
+        }
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    実行レイヤー、取り込みキュー、RAGサービスのメトリクス（キュー深度、キャッシュ等）を取得
+    """
+    return {
+        "executor": execution_layer.stats(),
+        "ingestion": ingestion_queue.stats(),
+        "generation": generation_scheduler.stats(),
+        "models": model_manager.stats(),
+        "readiness": readiness.stats(),
+        "rag": rag_service.get_metrics() if rag_service is not None else None
     }
 
 
+@app.get("/stats", dependencies=[Depends(require_rag_service)])
+async def get_stats():
+    """
+    コーパスの統計（ファイル数・チャンク数・タグ数・インデックスのバージョン）を取得
+    """
+    return rag_service.get_stats()
+
+
 if __name__ == "__main__":
     import uvicorn
     # host="0.0.0.0" で全てのネットワークインターフェースからのアクセスを許可
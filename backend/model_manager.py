@@ -0,0 +1,192 @@
+"""
+モデル常駐管理 - Ollamaのモデルを読み込み済みに保ち、初回の質問やモデル切り替え時の読み込み待ちを減らす
+"""
+import asyncio
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from config import RAGConfig
+from exceptions import RAGException
+from generation_scheduler import generation_scheduler
+from logger import setup_logger
+from ollama_client import ollama_client
+
+logger = setup_logger(__name__)
+
+
+def _model_key(model: str) -> str:
+    """モデル名の表記をそろえる（タグのない名前は ":latest" として扱う）"""
+    return model if ":" in model else f"{model}:latest"
+
+
+class ModelManager:
+    """
+    Ollamaに読み込まれているモデル（/api/ps）を追跡し、次のことを行う
+    - 起動時に既定のモデルを読み込む
+    - 使用中のモデルに定期的に keep_alive を送り、アイドル中に解放されないようにする
+    - 生成リクエストが待ち行列に入った時点で、検索と並行してモデルを読み込む
+    読み込むと OLLAMA_MAX_LOADED_MODELS を超える場合は、使われていないモデルを古い順に解放する
+    """
+
+    def __init__(self, max_loaded: int = None, interval: float = None):
+        """
+        Args:
+            max_loaded: 同時にメモリに置くモデル数の上限
+            interval: 常駐モデルの確認と keep_alive の延長の間隔（秒）
+        """
+        self.max_loaded = max_loaded or RAGConfig.OLLAMA_MAX_LOADED_MODELS
+        self.interval = interval or RAGConfig.MODEL_KEEPALIVE_INTERVAL
+        self.default_model: Optional[str] = None
+        self._pinned: Set[str] = set()  # 解放しないモデル（既定のモデル・埋め込みモデル）
+        self._resident: Dict[str, Optional[str]] = {}  # 読み込み済みのモデル -> 解放予定時刻（Ollamaの expires_at）
+        self._last_used: Dict[str, float] = {}
+        self._warming: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._loads = 0
+        self._load_failures = 0
+        self._warm_hits = 0
+        self._pings = 0
+        self._unloads = 0
+
+    def start(self, default_model: str, pinned: Iterable[str] = ()) -> None:
+        """
+        既定のモデルの読み込みと定期的な keep_alive の延長を始める（イベントループ上で呼ぶ）
+
+        Args:
+            default_model: 既定のモデル
+            pinned: ほかに解放しないモデル（埋め込みモデルなど）
+        """
+        self.default_model = _model_key(default_model)
+        self._pinned = {self.default_model, *(_model_key(model) for model in pinned)}
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """バックグラウンドの処理を止める（モデルの解放はOllamaの keep_alive に任せる）"""
+        tasks = [task for task in (self._task, *self._warming.values()) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    @property
+    def resident_models(self) -> List[str]:
+        """読み込み済みのモデル（直近の確認時点）"""
+        return sorted(self._resident)
+
+    def is_resident(self, model: str) -> bool:
+        return _model_key(model) in self._resident
+
+    def warm(self, model: str) -> Optional[asyncio.Task]:
+        """
+        モデルを使う予定を知らせる（生成リクエストを受け付けた時点で呼ぶ）
+        読み込まれていなければ読み込みを始める（完了は待たず、同じモデルの読み込みは共有する）
+
+        Args:
+            model: モデル名
+
+        Returns:
+            読み込みのタスク（読み込み済みの場合はNone）
+        """
+        key = _model_key(model)
+        self._last_used[key] = time.monotonic()
+        if key in self._resident:
+            self._warm_hits += 1
+            return None
+        task = self._warming.get(key)
+        if task is None:
+            task = self._warming[key] = asyncio.create_task(self._load(key))
+            task.add_done_callback(lambda _task: self._warming.pop(key, None))
+        return task
+
+    async def refresh(self) -> None:
+        """Ollamaに読み込まれているモデルの一覧を取得し直す（取得できない場合はそのまま）"""
+        running = await ollama_client.list_running()
+        if running is not None:
+            self._resident = {_model_key(model["name"]): model.get("expires_at") for model in running}
+
+    async def _load(self, model: str) -> None:
+        await self._make_room(model)
+        started_at = time.perf_counter()
+        try:
+            # 空のプロンプトで生成を呼ぶと、モデルの読み込みだけを行う
+            await ollama_client.generate(model, "", keep_alive=RAGConfig.OLLAMA_KEEP_ALIVE)
+        except RAGException as e:
+            self._load_failures += 1
+            logger.warning("Failed to load model %s: %s", model, e)
+            return
+        self._loads += 1
+        self._resident[model] = None
+        logger.info("Model %s loaded in %.1fs", model, time.perf_counter() - started_at)
+
+    async def _make_room(self, model: str) -> None:
+        """読み込むと上限を超える場合は、使われていない常駐モデルを最後に使った時刻の古い順に解放する"""
+        await self.refresh()
+        resident = [key for key in self._resident if key != model]
+        excess = len(resident) + 1 - self.max_loaded
+        if excess <= 0:
+            return
+        busy = {_model_key(key) for key in generation_scheduler.busy_models()}
+        candidates = sorted(
+            (key for key in resident if key not in self._pinned and key not in busy),
+            key=lambda key: self._last_used.get(key, 0.0)
+        )
+        for key in candidates[:excess]:
+            await self._unload(key)
+
+    async def _unload(self, model: str) -> None:
+        try:
+            await ollama_client.generate(model, "", keep_alive=0)
+        except RAGException as e:
+            logger.warning("Failed to unload model %s: %s", model, e)
+            return
+        self._unloads += 1
+        self._resident.pop(model, None)
+        logger.info("Model %s unloaded to stay within %d loaded models", model, self.max_loaded)
+
+    async def _keep_alive(self) -> None:
+        """使用中の常駐モデルの keep_alive を延長し、既定のモデルが解放されていて空きがあれば読み込み直す"""
+        await self.refresh()
+        now = time.monotonic()
+        for model in list(self._resident):
+            last_used = self._last_used.get(model)
+            in_use = last_used is not None and now - last_used <= RAGConfig.MODEL_IN_USE_WINDOW
+            if model != self.default_model and not in_use:
+                continue
+            try:
+                await ollama_client.generate(model, "", keep_alive=RAGConfig.OLLAMA_KEEP_ALIVE)
+                self._pings += 1
+            except RAGException as e:
+                logger.debug("Keep-alive for model %s failed: %s", model, e)
+        if self.default_model not in self._resident and len(self._resident) < self.max_loaded:
+            self.warm(self.default_model)
+
+    async def _run(self) -> None:
+        await self.refresh()
+        if RAGConfig.MODEL_PRELOAD_ENABLED:
+            task = self.warm(self.default_model)
+            if task is not None:
+                await task
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._keep_alive()
+            except Exception as e:
+                logger.warning("Model keep-alive failed: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        """モデル常駐のメトリクスを取得"""
+        return {
+            "default_model": self.default_model,
+            "max_loaded": self.max_loaded,
+            "resident": self.resident_models,
+            "warming": sorted(self._warming),
+            "loads": self._loads,
+            "load_failures": self._load_failures,
+            "warm_hits": self._warm_hits,
+            "keepalive_pings": self._pings,
+            "unloads": self._unloads,
+        }
+
+
+# アプリケーション全体で共有するモデル常駐管理
+model_manager = ModelManager()
@@ -0,0 +1,278 @@
+"""
+Ollamaクライアント - すべてのOllama API呼び出しで接続プールを共有する
+"""
+import json
+import threading
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from config import RAGConfig
+from exceptions import ModelNotFoundError, OllamaConnectionError
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class OllamaClient:
+    """
+    Ollama APIのクライアント
+    イベントループ用の非同期クライアントとワーカースレッド用の同期クライアントを1つずつ持ち、
+    生成・埋め込み・モデル一覧・ヘルスチェックのすべてで接続（keep-alive）を再利用する
+    """
+
+    def __init__(self, base_url: str = None):
+        """
+        Args:
+            base_url: OllamaのベースURL（Noneの場合は設定値）
+        """
+        self.base_url = (base_url or RAGConfig.OLLAMA_BASE_URL).rstrip("/")
+        self._client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+
+    def _client_options(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "timeout": httpx.Timeout(RAGConfig.OLLAMA_TIMEOUT, connect=RAGConfig.OLLAMA_CONNECT_TIMEOUT),
+            "limits": httpx.Limits(
+                max_connections=RAGConfig.OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=RAGConfig.OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=RAGConfig.OLLAMA_KEEPALIVE_EXPIRY
+            ),
+        }
+
+    @property
+    def client(self) -> httpx.Client:
+        """同期クライアント（初回アクセス時に生成）"""
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(**self._client_options())
+            return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """非同期クライアント（初回アクセス時に生成、イベントループ上でのみ使用する）"""
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(**self._client_options())
+        return self._async_client
+
+    def start(self) -> None:
+        """接続プールを用意（アプリケーションの起動時に呼ぶ）"""
+        self.client
+        self.async_client
+        logger.info("Ollama client ready: %s", self.base_url)
+
+    async def aclose(self) -> None:
+        """接続プールを閉じる（アプリケーションの終了時に呼ぶ）"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def _count(self, failed: bool = False) -> None:
+        with self._lock:
+            self._requests += 1
+            if failed:
+                self._errors += 1
+
+    def _raise_for_status(self, response: httpx.Response, model: str = None) -> None:
+        """エラー応答を例外に変換（モデルが見つからない場合は ModelNotFoundError）"""
+        if response.status_code < 400:
+            return
+        message = response.text
+        try:
+            message = response.json().get("error", message)
+        except ValueError:
+            pass
+        if response.status_code == 404 and model and "not found" in message:
+            raise ModelNotFoundError(f"Model '{model}' not found: {message}")
+        raise OllamaConnectionError(f"Ollama returned {response.status_code}: {message}")
+
+    def post(self, path: str, payload: Dict[str, Any], timeout: float = None) -> httpx.Response:
+        """
+        同期クライアントでPOST（ワーカースレッドから呼ぶ。ステータスの確認は呼び出し側で行う）
+
+        Args:
+            path: APIのパス（例: "/api/embed"）
+            payload: リクエストボディ
+            timeout: タイムアウト（秒、Noneの場合はクライアントの設定値）
+
+        Returns:
+            レスポンス
+        """
+        try:
+            if timeout is None:
+                response = self.client.post(path, json=payload)
+            else:
+                response = self.client.post(path, json=payload, timeout=timeout)
+        except httpx.HTTPError as e:
+            self._count(failed=True)
+            raise OllamaConnectionError(f"Failed to connect to Ollama at {self.base_url}: {e}") from e
+        self._count(failed=response.status_code >= 400)
+        return response
+
+    async def generate(self, model: str, prompt: str, options: Dict[str, Any] = None, **fields) -> Dict[str, Any]:
+        """
+        テキストを生成（ストリーミングなし）
+
+        Args:
+            model: モデル名
+            prompt: プロンプト
+            options: 生成パラメータ（temperature など）
+            **fields: その他のリクエストフィールド（system, keep_alive など。keep_alive の既定値は OLLAMA_KEEP_ALIVE）
+
+        Returns:
+            Ollamaの応答（"response" に生成したテキスト）
+        """
+        payload = {"model": model, "prompt": prompt, "stream": False, "options": options or {},
+                   "keep_alive": RAGConfig.OLLAMA_KEEP_ALIVE, **fields}
+        try:
+            response = await self.async_client.post("/api/generate", json=payload)
+        except httpx.HTTPError as e:
+            self._count(failed=True)
+            raise OllamaConnectionError(f"Failed to connect to Ollama at {self.base_url}: {e}") from e
+        self._count(failed=response.status_code >= 400)
+        self._raise_for_status(response, model)
+        return response.json()
+
+    async def stream(self, path: str, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        ストリーミングAPI（/api/generate, /api/chat）の応答を1行ずつ取得
+
+        Args:
+            path: APIのパス
+            payload: リクエストボディ（"stream" は True にする。keep_alive の既定値は OLLAMA_KEEP_ALIVE）
+
+        Yields:
+            応答の各行をJSONとして解析したもの
+        """
+        try:
+            payload = {"keep_alive": RAGConfig.OLLAMA_KEEP_ALIVE, **payload, "stream": True}
+            async with self.async_client.stream("POST", path, json=payload) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    self._count(failed=True)
+                    self._raise_for_status(response, payload.get("model"))
+                self._count()
+                async for line in response.aiter_lines():
+                    if line:
+                        try:
+                            yield json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+        except httpx.HTTPError as e:
+            self._count(failed=True)
+            raise OllamaConnectionError(f"Failed to connect to Ollama at {self.base_url}: {e}") from e
+
+    def list_models(self) -> List[str]:
+        """
+        利用可能なモデルの一覧を取得（同期、起動時の既定モデルの決定用）
+
+        Returns:
+            モデル名のリスト（取得できない場合は空）
+        """
+        try:
+            response = self.client.get("/api/tags", timeout=RAGConfig.OLLAMA_HEALTH_TIMEOUT)
+        except httpx.HTTPError as e:
+            self._count(failed=True)
+            logger.debug("Exception fetching models: %s", e)
+            return []
+        self._count(failed=response.status_code != 200)
+        if response.status_code != 200:
+            return []
+        return [model["name"] for model in response.json().get("models", [])]
+
+    async def alist_models(self) -> List[str]:
+        """
+        利用可能なモデルの一覧を取得
+
+        Returns:
+            モデル名のリスト（取得できない場合は空）
+        """
+        try:
+            response = await self.async_client.get("/api/tags", timeout=RAGConfig.OLLAMA_HEALTH_TIMEOUT)
+        except httpx.HTTPError as e:
+            self._count(failed=True)
+            logger.debug("Exception fetching models: %s", e)
+            return []
+        self._count(failed=response.status_code != 200)
+        if response.status_code != 200:
+            return []
+        return [model["name"] for model in response.json().get("models", [])]
+
+    async def list_running(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        メモリに読み込まれているモデルの一覧を取得（/api/ps）
+
+        Returns:
+            モデルの情報（name, expires_at など）のリスト（取得できない場合はNone）
+        """
+        try:
+            response = await self.async_client.get("/api/ps", timeout=RAGConfig.OLLAMA_HEALTH_TIMEOUT)
+        except httpx.HTTPError as e:
+            self._count(failed=True)
+            logger.debug("Exception fetching running models: %s", e)
+            return None
+        self._count(failed=response.status_code != 200)
+        if response.status_code != 200:
+            return None
+        return response.json().get("models", [])
+
+    async def show(self, model: str) -> Dict[str, Any]:
+        """
+        モデルの情報（Modelfileのパラメータなど）を取得
+
+        Args:
+            model: モデル名
+
+        Returns:
+            /api/show の応答（取得できない場合は空）
+        """
+        try:
+            response = await self.async_client.post("/api/show", json={"model": model},
+                                                    timeout=RAGConfig.OLLAMA_HEALTH_TIMEOUT)
+        except httpx.HTTPError as e:
+            self._count(failed=True)
+            logger.debug("Exception fetching model info for %s: %s", model, e)
+            return {}
+        self._count(failed=response.status_code != 200)
+        if response.status_code != 200:
+            return {}
+        return response.json()
+
+    async def is_available(self) -> bool:
+        """
+        Ollamaサーバーが応答するかを確認（モデルの有無に関わらず）
+
+        Returns:
+            接続が成功した場合True
+        """
+        try:
+            response = await self.async_client.get("/api/version", timeout=RAGConfig.OLLAMA_HEALTH_TIMEOUT)
+        except httpx.HTTPError as e:
+            self._count(failed=True)
+            logger.debug("Ollama connection check failed: %s", e)
+            return False
+        self._count(failed=response.status_code != 200)
+        return response.status_code == 200
+
+    def stats(self) -> Dict[str, Any]:
+        """クライアントのメトリクスを取得"""
+        with self._lock:
+            return {
+                "base_url": self.base_url,
+                "max_connections": RAGConfig.OLLAMA_MAX_CONNECTIONS,
+                "max_keepalive_connections": RAGConfig.OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+                "requests": self._requests,
+                "errors": self._errors,
+            }
+
+
+# アプリケーション全体で共有するOllamaクライアント
+ollama_client = OllamaClient()
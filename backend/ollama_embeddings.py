@@ -0,0 +1,175 @@
+"""
+Ollama埋め込み - バッチAPIを使ってチャンクをまとめてベクトル化する
+"""
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from config import RAGConfig
+from embedding_cache import EmbeddingCache
+from logger import setup_logger
+from ollama_client import OllamaClient, ollama_client
+
+logger = setup_logger(__name__)
+
+# 保存・検索に使うベクトルの形式（コレクションのメタデータと埋め込みキャッシュのキーに記録する）
+# /api/embed はL2正規化したベクトルを返すため、1件ずつのAPI（/api/embeddings）の結果も正規化してそろえる
+EMBEDDING_FORMAT = "l2-normalized"
+
+
+def _l2_normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else vector
+
+
+class OllamaBatchEmbeddings(Embeddings):
+    """
+    Ollamaのバッチ埋め込みAPI（/api/embed）を使う埋め込みクラス
+    チャンクをバッチに分け、同時実行数を制限しながら並行して送信する
+    """
+
+    def __init__(self, model: str, client: OllamaClient = None, batch_size: int = None,
+                 max_inflight: int = None, timeout: float = None,
+                 cache: Optional[EmbeddingCache] = None):
+        """
+        Args:
+            model: 埋め込みモデル名
+            client: Ollamaクライアント（Noneの場合はアプリケーション全体で共有するもの）
+            batch_size: 1リクエストあたりのチャンク数
+            max_inflight: 同時に送信するバッチ数の上限
+            timeout: 1リクエストあたりのタイムアウト（秒）
+            cache: 埋め込みキャッシュ（Noneの場合はキャッシュしない）
+        """
+        self.model = model
+        self.cache = cache
+        # ベクトルの形式が異なるもの（正規化していない旧APIの結果など）をキャッシュから返さないよう、キーに形式を含める
+        self._cache_key = f"{model}@{EMBEDDING_FORMAT}"
+        self.batch_size = batch_size or RAGConfig.EMBEDDING_BATCH_SIZE
+        self.max_inflight = max_inflight or RAGConfig.EMBEDDING_MAX_INFLIGHT
+        self.timeout = timeout or RAGConfig.EMBEDDING_TIMEOUT
+
+        # 接続は生成・ヘルスチェックと共有の接続プールから使う
+        self._client = client or ollama_client
+        # 全取り込みジョブで共有し、Ollamaへの同時バッチ数を制限する
+        self._pool = ThreadPoolExecutor(max_workers=self.max_inflight, thread_name_prefix="rag-embed")
+        # 古いOllama（/api/embed 未対応）の場合は1件ずつのAPIにフォールバック
+        self._batch_api_available = True
+
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._texts = 0
+        self._errors = 0
+        self._total_time = 0.0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        複数のテキストをベクトル化
+
+        Args:
+            texts: ベクトル化するテキストのリスト
+
+        Returns:
+            入力と同じ順序のベクトルのリスト
+        """
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._embed_uncached(texts)
+
+        # キャッシュにないチャンクだけをOllamaに送る
+        vectors = self.cache.get_many(self._cache_key, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            new_vectors = self._embed_uncached(missing_texts)
+            self.cache.put_many(self._cache_key, missing_texts, new_vectors)
+            for i, vector in zip(missing, new_vectors):
+                vectors[i] = vector
+        logger.debug("Embedding cache: %d hits, %d misses", len(texts) - len(missing), len(missing))
+        return vectors
+
+    def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        """バッチに分けてOllamaでベクトル化"""
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            return self._embed_batch(batches[0])
+
+        # map は入力順に結果を返す
+        results = self._pool.map(self._embed_batch, batches)
+        return [vector for batch in results for vector in batch]
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        検索クエリをベクトル化
+
+        Args:
+            text: クエリ文字列
+
+        Returns:
+            ベクトル
+        """
+        return self._embed_batch([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        複数の検索クエリを1回のリクエストでベクトル化（埋め込みキャッシュは使わない）
+
+        Args:
+            texts: クエリ文字列のリスト
+
+        Returns:
+            入力と同じ順序のベクトルのリスト
+        """
+        return self._embed_batch(texts) if texts else []
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """1バッチ分のテキストをOllamaでベクトル化"""
+        started_at = time.perf_counter()
+        try:
+            if self._batch_api_available:
+                response = self._client.post("/api/embed", {"model": self.model, "input": texts},
+                                             timeout=self.timeout)
+                if response.status_code == 404 and "model" not in response.text:
+                    logger.warning("Ollama batch embedding API is not available, falling back to /api/embeddings")
+                    self._batch_api_available = False
+                else:
+                    response.raise_for_status()
+                    vectors = response.json()["embeddings"]
+                    self._record(len(texts), started_at)
+                    return vectors
+
+            vectors = []
+            for text in texts:
+                response = self._client.post("/api/embeddings", {"model": self.model, "prompt": text},
+                                             timeout=self.timeout)
+                response.raise_for_status()
+                vectors.append(_l2_normalize(response.json()["embedding"]))
+            self._record(len(texts), started_at)
+            return vectors
+        except Exception:
+            with self._lock:
+                self._errors += 1
+            raise
+
+    def _record(self, count: int, started_at: float) -> None:
+        with self._lock:
+            self._batches += 1
+            self._texts += count
+            self._total_time += time.perf_counter() - started_at
+
+    def stats(self) -> Dict[str, float]:
+        """埋め込み処理のメトリクスを取得"""
+        with self._lock:
+            return {
+                "batch_size": self.batch_size,
+                "max_inflight": self.max_inflight,
+                "batches": self._batches,
+                "texts": self._texts,
+                "errors": self._errors,
+                "avg_batch_ms": round(self._total_time / self._batches * 1000, 2) if self._batches else 0.0,
+                "cache": self.cache.stats() if self.cache else None,
+            }
@@ -1,28 +1,46 @@
 import os
-from typing import List, Tuple
-from langchain_community.document_loaders import (
-    PyPDFLoader,
-    TextLoader,
-    CSVLoader,
-    UnstructuredMarkdownLoader
-)
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import OllamaEmbeddings
+from typing import Callable, Iterable, List, Optional, Tuple
 from langchain_community.vectorstores import Chroma
-from langchain_community.llms import Ollama
+from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
-import httpx
+import asyncio
+import hashlib
 import json
-from rank_bm25 import BM25Okapi
+import math
 import re
+import threading
+import time
+import unicodedata
+import uuid
 
+import numpy as np
+
+from bm25_index import BM25Index
 from config import RAGConfig, PromptTemplates
+from context_packer import TOKEN_COUNT_METADATA_KEY, ContextPacker, PackedContext, estimate_tokens
+from document_catalog import DocumentCatalog
+from document_loader import load_and_split_document
+from embedding_cache import create_embedding_cache
+from exceptions import VectorStoreError
+from executor import execution_layer
+from generation_scheduler import GenerationTicket, generation_scheduler
+from fusion import reciprocal_rank_fusion, select_top_k, weighted_min_max_fusion
 from logger import setup_logger
+from lru_cache import LRUCache
+from model_manager import model_manager
+from ollama_client import ollama_client
+from ollama_embeddings import EMBEDDING_FORMAT, OllamaBatchEmbeddings
+from readiness import readiness
+from semantic_cache import SemanticCache
+from timings import StageTimings
 
 logger = setup_logger(__name__)
 
+# ストリーミングで生成の待ち行列での順番を通知するチャンクの接頭辞（"__QUEUE__:{json}"）
+QUEUE_MARKER = "__QUEUE__:"
+
 
 class RAGService:
     def __init__(
@@ -56,31 +74,52 @@ class RAGService:
 
         self.model_name = model_name
 
-        # Embeddings
-        self.embeddings = OllamaEmbeddings(
+        # Embeddings（バッチAPIでまとめてベクトル化、計算済みのベクトルはキャッシュから再利用）
+        self.embeddings = OllamaBatchEmbeddings(
             model=self.embedding_model,
-            base_url=RAGConfig.OLLAMA_BASE_URL
+            cache=create_embedding_cache()
         )
 
+        # 直近のクエリのベクトル（同じ質問や追加質問で埋め込みを再計算しない）
+        self._query_embedding_cache = LRUCache(RAGConfig.QUERY_EMBEDDING_CACHE_SIZE)
+        # 拡張クエリ（正規化した質問ごと）と、生成中の拡張（同じ質問の同時リクエストで共有）
+        self._query_expansion_cache = LRUCache(RAGConfig.QUERY_EXPANSION_CACHE_SIZE,
+                                               ttl=RAGConfig.QUERY_EXPANSION_CACHE_TTL)
+        self._pending_expansions = {}
+        # 検索結果（同じ質問・検索条件・インデックスのバージョンでは埋め込みと検索を省く）
+        self._retrieval_cache = LRUCache(RAGConfig.RETRIEVAL_CACHE_SIZE, ttl=RAGConfig.RETRIEVAL_CACHE_TTL)
+        # 回答（同じ質問・条件・インデックスのバージョンでの再質問は生成せずに返す）
+        self._answer_cache = LRUCache(RAGConfig.ANSWER_CACHE_SIZE, ttl=RAGConfig.ANSWER_CACHE_TTL)
+        # 質問ベクトルが類似した（言い換えた）質問の回答
+        self._semantic_answer_cache = SemanticCache(RAGConfig.SEMANTIC_CACHE_SIZE,
+                                                    threshold=RAGConfig.SEMANTIC_CACHE_THRESHOLD,
+                                                    ttl=RAGConfig.ANSWER_CACHE_TTL)
+        # 検索パイプラインの段階ごとの所要時間（/metrics で公開）
+        self.retrieval_timings = StageTimings()
+        # 参照ドキュメントと会話履歴をコンテキスト長に収める詰め込みと、モデルごとのコンテキスト長
+        self.context_packer = ContextPacker()
+        self._model_num_ctx = LRUCache(64, ttl=RAGConfig.MODEL_INFO_CACHE_TTL)
+        # 生成の段階ごとの所要時間とトークン数（Ollamaの応答の prompt_eval_count などを集計）
+        self.generation_timings = StageTimings()
+
         # Vector Store
-        self.vectorstore = Chroma(
-            persist_directory=self.persist_directory,
-            embedding_function=self.embeddings
-        )
+        with readiness.track("vectorstore"):
+            self.vectorstore = Chroma(
+                persist_directory=self.persist_directory,
+                embedding_function=self.embeddings,
+                collection_metadata=self._embedding_metadata()
+            )
+            self._ensure_embedding_format()
 
-        # LLM（temperature低めで高速化と一貫性向上）
-        self.llm = Ollama(
-            model=self.model_name,
-            base_url=RAGConfig.OLLAMA_BASE_URL,
-            temperature=RAGConfig.DEFAULT_TEMPERATURE
-        )
+        # クエリ拡張の生成パラメータ（キャッシュと相性の良い決定的な出力にし、生成長も短く抑える）
+        self.expansion_options = {
+            "temperature": 0.0,
+            "num_predict": RAGConfig.QUERY_EXPANSION_NUM_PREDICT,
+        }
 
-        # Text Splitter（より大きなチャンクでコンテキストを保持）
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=RAGConfig.DEFAULT_CHUNK_SIZE,
-            chunk_overlap=RAGConfig.DEFAULT_CHUNK_OVERLAP,
-            length_function=len
-        )
+        # チャンク分割設定（より大きなチャンクでコンテキストを保持）
+        self.chunk_size = RAGConfig.DEFAULT_CHUNK_SIZE
+        self.chunk_overlap = RAGConfig.DEFAULT_CHUNK_OVERLAP
 
         # プロンプトテンプレート（configから取得）
         self.prompt_template = PromptTemplates.BASE_RAG_TEMPLATE
@@ -90,11 +129,59 @@ class RAGService:
             input_variables=["context", "question"]
         )
 
-        # BM25用のドキュメントキャッシュ
-        self.bm25_corpus = []  # トークン化されたドキュメント
-        self.bm25_docs = []    # 元のドキュメントオブジェクト
-        self.bm25_index = None
-        self._rebuild_bm25_index()
+        # ドキュメントの書き込み（取り込み・削除・クリア）は、ベクトルストア・カタログ・BM25インデックスを
+        # まとめて更新するため1件ずつ行う（取り込みの読み込みとベクトル化はロックの外で並行して行う）
+        self._write_lock = threading.RLock()
+
+        # BM25インデックス（保存済みのものを読み込み、以降はチャンク単位で差分更新）
+        # 取り込みワーカー・削除が並行して更新しないようロックで保護
+        # 読み込み（再構築）には時間がかかるため、ここでは空のまま作り load_bm25_index() で読み込む
+        # （読み込むまでのハイブリッド検索はベクトル検索の結果だけを使う）
+        self.bm25_index_directory = os.path.join(self.persist_directory, RAGConfig.BM25_INDEX_DIRNAME)
+        self._bm25_lock = threading.Lock()
+        self.bm25_index = BM25Index()
+        self._bm25_loaded = False
+        self._bm25_saved_merge_count = None
+
+        # ドキュメントカタログ（一覧・削除・プレビューでコレクション全体を読み込まないための索引）
+        with readiness.track("document_catalog"):
+            self.catalog_path = os.path.join(self.persist_directory, RAGConfig.DOCUMENT_CATALOG_FILENAME)
+            self.catalog = DocumentCatalog(self.catalog_path)
+            self._load_document_catalog()
+            self._migrate_tag_metadata()
+
+    def _embedding_metadata(self) -> dict:
+        """コレクションのメタデータに記録する、ベクトルを作った埋め込みモデルと形式"""
+        return {"embedding_model": self.embedding_model, "embedding_format": EMBEDDING_FORMAT}
+
+    def _ensure_embedding_format(self):
+        """
+        コレクションのベクトルが現在の埋め込みモデル・形式で作られているかをメタデータで確認する
+        異なる場合（正規化していない旧APIで登録したチャンクや、埋め込みモデルの変更）は全チャンクを埋め込み直す
+        （尺度の異なるベクトルが混在すると、L2距離による順位が正しくならないため）
+        """
+        collection = self.vectorstore._collection
+        expected = self._embedding_metadata()
+        metadata = collection.metadata or {}
+        if all(metadata.get(key) == value for key, value in expected.items()):
+            return
+        total = collection.count()
+        if total:
+            logger.warning("Collection was embedded with %s (%s), re-embedding %d chunks with %s (%s)",
+                           metadata.get("embedding_model", "unknown"), metadata.get("embedding_format", "unknown"),
+                           total, self.embedding_model, EMBEDDING_FORMAT)
+            try:
+                batch_size = RAGConfig.CHROMA_WRITE_BATCH_SIZE
+                for offset in range(0, total, batch_size):
+                    data = collection.get(include=["documents"], limit=batch_size, offset=offset)
+                    if data['ids']:
+                        collection.update(ids=data['ids'],
+                                          embeddings=self.embeddings.embed_documents(data['documents']))
+            except Exception as e:
+                # 形式の混在したまま検索しないよう、起動を失敗させる（次回の起動時に最初からやり直す）
+                raise VectorStoreError(f"Failed to re-embed the collection: {e}") from e
+            logger.info("Re-embedded %d chunks", total)
+        collection.modify(metadata={**metadata, **expected})
 
     def _tokenize_japanese(self, text: str) -> List[str]:
         """
@@ -110,54 +197,198 @@ class RAGService:
         tokens = re.findall(RAGConfig.TOKENIZE_PATTERN, text.lower())
         return tokens
 
+    @staticmethod
+    def _split_tags(tags_str: str) -> List[str]:
+        """メタデータのカンマ区切りのタグ文字列をリストに変換"""
+        return [t.strip() for t in tags_str.split(",") if t.strip()] if tags_str else []
+
+    @staticmethod
+    def _tag_metadata(tags: Iterable[str]) -> dict:
+        """
+        タグ絞り込み用のメタデータ（タグごとに "tag:<タグ名>": True）
+        ChromaDBのメタデータはリストを扱えないため、タグごとのキーにしてwhere句で絞り込めるようにする
+        """
+        return {f"{RAGConfig.TAG_METADATA_PREFIX}{tag}": True for tag in tags}
+
+    @staticmethod
+    def _tag_where(tags: List[str] = None) -> Optional[dict]:
+        """
+        いずれかのタグを持つチャンクに絞り込むChromaDBのwhere句
+
+        Args:
+            tags: タグのリスト
+
+        Returns:
+            where句（タグの指定がない場合はNone）
+        """
+        if not tags:
+            return None
+        conditions = [{f"{RAGConfig.TAG_METADATA_PREFIX}{tag}": True} for tag in dict.fromkeys(tags)]
+        return conditions[0] if len(conditions) == 1 else {"$or": conditions}
+
+    def load_bm25_index(self):
+        """
+        BM25インデックスを読み込む（起動後にバックグラウンドで1回呼ぶ）
+        読み込む前の検索結果はBM25を含まないため、読み込んだ後はキャッシュした検索結果と回答を破棄する
+        """
+        with readiness.track("bm25_index"), self._write_lock:
+            self._load_bm25_index()
+        self._retrieval_cache.clear()
+        self._answer_cache.clear()
+        self._semantic_answer_cache.clear()
+
+    def _load_bm25_index(self):
+        """
+        保存済みのBM25インデックスを読み込む
+        コレクションのチャンクIDの集合と一致しない場合のみ、ベクトルストアから再構築して保存する
+        """
+        with self._bm25_lock:
+            # 以降の保存を許可する（ロックを持っているため、読み込み途中のインデックスは保存されない）
+            self._bm25_loaded = True
+            try:
+                bm25_index = BM25Index.load(self.bm25_index_directory)
+                if bm25_index is not None:
+                    chunk_ids = self.vectorstore._collection.get(include=[])['ids']
+                    if bm25_index.version == BM25Index.version_of(chunk_ids):
+                        self.bm25_index = bm25_index
+                        self._bm25_saved_merge_count = bm25_index.merge_count
+                        logger.info("BM25 index loaded with %d documents", len(bm25_index))
+                        return
+                    logger.info("BM25 index is out of date, rebuilding")
+            except Exception as e:
+                logger.warning("Failed to load BM25 index, rebuilding: %s", e)
+
+            self._rebuild_bm25_index_locked()
+            self._save_bm25_index_locked()
+
     def _rebuild_bm25_index(self):
         """
         現在のベクトルストアからBM25インデックスを再構築
         """
+        with self._bm25_lock:
+            self._rebuild_bm25_index_locked()
+
+    def _rebuild_bm25_index_locked(self):
         try:
             collection = self.vectorstore._collection
-            all_data = collection.get()
+            all_data = collection.get(include=["documents", "metadatas"])
+
+            # 検索中のリクエストが不整合な状態を参照しないよう、新しいインデックスを構築してから差し替える
+            bm25_index = BM25Index()
+            bm25_index.add(
+                all_data['ids'],
+                [self._tokenize_japanese(text) for text in all_data['documents']],
+                [self._split_tags((metadata or {}).get("tags", "")) for metadata in all_data['metadatas']]
+            )
+            logger.info("BM25 index built with %d documents", len(bm25_index))
+            self.bm25_index = bm25_index
 
-            if not all_data['ids']:
-                logger.debug("No documents in vectorstore, BM25 index is empty")
-                self.bm25_corpus = []
-                self.bm25_docs = []
-                self.bm25_index = None
-                return
+        except Exception as e:
+            logger.error("Error building BM25 index: %s", e, exc_info=True)
+            self.bm25_index = BM25Index()
 
-            # ドキュメントを取得してトークン化
-            self.bm25_corpus = []
-            self.bm25_docs = []
+    def save_bm25_index(self):
+        """
+        BM25インデックスを保存（シャットダウン時に呼び出す）
+        """
+        with self._bm25_lock:
+            self._save_bm25_index_locked()
 
-            for i, doc_id in enumerate(all_data['ids']):
-                text = all_data['documents'][i]
-                metadata = all_data['metadatas'][i] if all_data['metadatas'] else {}
+    def _save_bm25_index_locked(self):
+        if not self._bm25_loaded:
+            # 読み込む前の空のインデックスで保存済みのものを上書きしない
+            return
+        try:
+            self.bm25_index.save(self.bm25_index_directory)
+            self._bm25_saved_merge_count = self.bm25_index.merge_count
+        except Exception as e:
+            logger.error("Error saving BM25 index: %s", e, exc_info=True)
 
-                # Documentオブジェクトを再構築
-                from langchain_core.documents import Document
-                doc = Document(page_content=text, metadata=metadata)
+    def _save_bm25_index_if_merged_locked(self):
+        """
+        ポスティングのマージが発生した場合のみ保存
+        保存はインデックス全体の書き出しになるため、小さな更新のたびには行わない
+        （保存されていない更新は、次回起動時にバージョン不一致として再構築される）
+        """
+        if self.bm25_index.merge_count != self._bm25_saved_merge_count:
+            self._save_bm25_index_locked()
 
-                # トークン化
-                tokens = self._tokenize_japanese(text)
+    def _load_document_catalog(self):
+        """
+        カタログとコレクションのチャンク数が一致しない場合のみ、ベクトルストアのメタデータから作り直す
+        （カタログ導入前に登録されたドキュメントの取り込みや、書き込み途中で停止した場合の復旧）
+        """
+        try:
+            collection = self.vectorstore._collection
+            total = collection.count()
+            if self.catalog.chunk_count() == total:
+                return
+            logger.info("Document catalog is out of date, rebuilding from %d chunks", total)
 
-                self.bm25_corpus.append(tokens)
-                self.bm25_docs.append(doc)
+            def iter_chunks():
+                batch_size = RAGConfig.CHROMA_WRITE_BATCH_SIZE
+                for offset in range(0, total, batch_size):
+                    data = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+                    yield from zip(data['ids'], data['metadatas'])
 
-            # BM25インデックスを構築
-            if self.bm25_corpus:
-                self.bm25_index = BM25Okapi(self.bm25_corpus)
-                logger.debug("BM25 index built with %d documents", len(self.bm25_corpus))
-            else:
-                self.bm25_index = None
-                logger.debug("BM25 corpus is empty")
+            self.catalog.replace_all(iter_chunks())
+        except Exception as e:
+            logger.error("Error building document catalog: %s", e, exc_info=True)
 
+    def _migrate_tag_metadata(self):
+        """
+        タグ絞り込み用のメタデータキーがないチャンク（導入前に登録されたもの）にキーを追加する
+        完了したらカタログに記録し、次回以降は何もしない
+        """
+        if self.catalog.get_meta("tag_metadata_format"):
+            return
+        try:
+            collection = self.vectorstore._collection
+            total = collection.count()
+            batch_size = RAGConfig.CHROMA_WRITE_BATCH_SIZE
+            updated = 0
+            for offset in range(0, total, batch_size):
+                data = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+                ids, metadatas = [], []
+                for chunk_id, metadata in zip(data['ids'], data['metadatas']):
+                    metadata = metadata or {}
+                    tag_metadata = self._tag_metadata(self._split_tags(metadata.get("tags", "")))
+                    if any(key not in metadata for key in tag_metadata):
+                        ids.append(chunk_id)
+                        metadatas.append({**metadata, **tag_metadata})
+                if ids:
+                    collection.update(ids=ids, metadatas=metadatas)
+                    updated += len(ids)
+            if updated:
+                logger.info("Added tag filter metadata to %d chunks", updated)
+            self.catalog.set_meta("tag_metadata_format", 1)
         except Exception as e:
-            logger.error("Error building BM25 index: %s", e, exc_info=True)
-            self.bm25_corpus = []
-            self.bm25_docs = []
-            self.bm25_index = None
+            logger.error("Error migrating tag metadata: %s", e, exc_info=True)
+
+    def _get_chunks_by_id(self, scored_ids: List[Tuple[str, float]]) -> List[Tuple]:
+        """
+        チャンクIDとスコアのリストから、(Document, スコア)のリストを取得
+
+        Args:
+            scored_ids: (チャンクID, スコア)のタプルのリスト
+
+        Returns:
+            (Document, スコア)のタプルのリスト（入力と同じ順序）
+        """
+        if not scored_ids:
+            return []
+        data = self.vectorstore._collection.get(
+            ids=[chunk_id for chunk_id, _ in scored_ids],
+            include=["documents", "metadatas"]
+        )
+        docs = {
+            chunk_id: Document(page_content=text, metadata=metadata or {}, id=chunk_id)
+            for chunk_id, text, metadata in zip(data['ids'], data['documents'], data['metadatas'])
+        }
+        return [(docs[chunk_id], score) for chunk_id, score in scored_ids if chunk_id in docs]
 
-    def add_documents(self, file_path: str, tags: List[str] = None) -> None:
+    def add_documents(self, file_path: str, tags: List[str] = None, content_hash: str = None,
+                      progress: Callable[..., None] = None) -> int:
         """
         ファイルを読み込んでベクトルストアに追加
         対応フォーマット: PDF, TXT, MD, CSV
@@ -165,57 +396,151 @@ class RAGService:
         Args:
             file_path: ファイルのパス
             tags: タグのリスト（例: ["商品A", "仕様書"]）
-        """
-        # ファイル拡張子に応じてローダーを選択
-        file_extension = os.path.splitext(file_path)[1].lower()
-
-        if file_extension == '.pdf':
-            loader = PyPDFLoader(file_path)
-        elif file_extension == '.txt':
-            loader = TextLoader(file_path, encoding='utf-8')
-        elif file_extension == '.md':
-            loader = UnstructuredMarkdownLoader(file_path)
-        elif file_extension == '.csv':
-            loader = CSVLoader(file_path, encoding='utf-8')
-        else:
-            raise ValueError(f"サポートされていないファイル形式です: {file_extension}")
-
-        # ドキュメントの読み込み
-        documents = loader.load()
+            content_hash: ファイル内容のSHA-256（重複判定用にメタデータへ保存）
+            progress: 進捗通知用コールバック（stage, chunks=... を受け取る）
 
-        # テキストの分割
-        splits = self.text_splitter.split_documents(documents)
+        Returns:
+            追加したチャンク数
+        """
+        def report(stage: str, **info) -> None:
+            if progress:
+                progress(stage, **info)
+
+        # ドキュメントの読み込みと分割（CPU負荷が高いためプロセスプールで実行）
+        report("loading")
+        splits = execution_layer.run_cpu_bound(
+            load_and_split_document, file_path, self.chunk_size, self.chunk_overlap
+        )
 
         # メタデータにファイル名とタグを追加
         for split in splits:
             split.metadata["source_file"] = os.path.basename(file_path)
+            # 質問のたびに数えないよう、トークン数の見積もりを保存しておく
+            split.metadata[TOKEN_COUNT_METADATA_KEY] = estimate_tokens(split.page_content)
+            if content_hash:
+                split.metadata["content_sha256"] = content_hash
             if tags:
                 # ChromaDBはリストを直接サポートしないため、カンマ区切り文字列に変換
                 split.metadata["tags"] = ",".join(tags)  # 文字列形式で保存
+                # 検索時にwhere句で絞り込めるよう、タグごとのキーも追加
+                split.metadata.update(self._tag_metadata(tags))
                 logger.debug("Added tags %s to document chunk", tags)
 
-        # ベクトルストアに追加
+        # バッチでベクトル化
+        report("embedding", chunks=len(splits))
+        texts = [split.page_content for split in splits]
+        started_at = time.perf_counter()
+        embeddings = self.embeddings.embed_documents(texts)
+        elapsed = time.perf_counter() - started_at
+        chunks_per_sec = len(texts) / elapsed if elapsed > 0 else 0.0
+        logger.info("Embedded %d chunks in %.2fs (%.1f chunks/sec)", len(texts), elapsed, chunks_per_sec)
+
+        # ベクトルストアに追加（計算済みのベクトルをまとめて書き込む）
+        report("persisting", chunks=len(splits), embedding_chunks_per_sec=round(chunks_per_sec, 2))
         logger.info("Adding %d document chunks to vector store with tags: %s", len(splits), tags)
-        self.vectorstore.add_documents(splits)
+        filename = os.path.basename(file_path)
+        ids = self._chunk_ids(filename, content_hash, len(splits))
+        # 登録済みチャンクの確認からBM25インデックスへの反映までを、ほかの取り込み・削除・クリアと同時に行わない
+        # （同じファイルの取り込みが重なると、互いのチャンクを削除してストア間で不整合になるため）
+        with self._write_lock:
+            # 同じファイル名で登録済みのチャンクは置き換える
+            # 内容を変えて再登録した場合はIDが変わり、同じIDでもChromaのupsertはメタデータ（タグ）をマージするため、
+            # 書き込む前にすべて削除する（BM25インデックスは同じIDを置き換えるため、IDが変わったものだけ除く）
+            old_ids = self.catalog.chunk_ids(filename)
+            if old_ids:
+                self.vectorstore._collection.delete(ids=old_ids)
+                logger.info("Replacing %d chunks of the previous version of %s", len(old_ids), filename)
+            new_ids = set(ids)
+            stale_ids = [chunk_id for chunk_id in old_ids if chunk_id not in new_ids]
+            self._write_chunks(ids, texts, embeddings, [split.metadata for split in splits])
 
-        # 永続化
-        try:
-            self.vectorstore.persist()
-            logger.debug("Documents persisted successfully")
-        except Exception as e:
-            logger.error("Error persisting documents: %s", e)
+            # 永続化
+            try:
+                self.vectorstore.persist()
+                logger.debug("Documents persisted successfully")
+            except Exception as e:
+                logger.error("Error persisting documents: %s", e)
 
-        # 追加後のドキュメント数を確認
-        try:
-            total_docs = len(self.vectorstore.get()['ids'])
-            logger.info("Total documents in store: %d", total_docs)
-        except Exception as e:
-            logger.error("Error counting documents: %s", e)
+            # 追加後のドキュメント数を確認
+            try:
+                total_docs = self.vectorstore._collection.count()
+                logger.info("Total documents in store: %d", total_docs)
+            except Exception as e:
+                logger.error("Error counting documents: %s", e)
+
+            # カタログに記録（一覧・削除・プレビュー用）
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = None
+            self.catalog.add_document(
+                filename, ids, [split.metadata.get("page") for split in splits],
+                tags=tags, size=size, content_hash=content_hash
+            )
+
+            # 追加・置き換えたチャンクだけをBM25インデックスに反映
+            report("indexing", chunks=len(splits))
+            with self._bm25_lock:
+                if stale_ids:
+                    self.bm25_index.remove(stale_ids)
+                self.bm25_index.add(ids, [self._tokenize_japanese(text) for text in texts], [tags or []] * len(ids))
+                self._save_bm25_index_if_merged_locked()
+
+            # すべてのインデックスを更新し終えてからバージョンを進める
+            # （更新途中に検索した結果は古いバージョンのキーでキャッシュされ、以降は参照されない）
+            self.catalog.bump_index_version()
 
-        # BM25インデックスを再構築
-        self._rebuild_bm25_index()
+        return len(splits)
 
-    def _expand_query(self, question: str) -> List[str]:
+    @staticmethod
+    def _chunk_ids(filename: str, content_hash: str, count: int) -> List[str]:
+        """
+        チャンクIDを作成
+        ファイル名・内容のハッシュ・チャンクの順番から決まるため、同じ内容のファイルを再登録した場合は
+        ベクトルストア・BM25インデックス・カタログのいずれでも同じチャンクが置き換えられる
+        （内容が変わった場合はIDも変わるため、古いチャンクは add_documents で削除する）
+
+        Args:
+            filename: ファイル名
+            content_hash: ファイル内容のSHA-256（Noneの場合はランダムなIDを使用）
+            count: チャンク数
+
+        Returns:
+            チャンクIDのリスト
+        """
+        if not content_hash:
+            return [str(uuid.uuid4()) for _ in range(count)]
+        prefix = hashlib.blake2b(f"{filename}\0{content_hash}".encode("utf-8"), digest_size=12).hexdigest()
+        return [f"{prefix}-{i:06d}" for i in range(count)]
+
+    def _write_chunks(self, ids: List[str], texts: List[str], embeddings: List[List[float]],
+                      metadatas: List[dict]) -> None:
+        """
+        ベクトル化済みのチャンクをChromaにバッチで書き込む
+
+        Args:
+            ids: チャンクID
+            texts: チャンクのテキスト
+            embeddings: チャンクのベクトル
+            metadatas: チャンクのメタデータ
+        """
+        collection = self.vectorstore._collection
+        batch_size = RAGConfig.CHROMA_WRITE_BATCH_SIZE
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            collection.upsert(
+                ids=ids[start:end],
+                documents=texts[start:end],
+                embeddings=embeddings[start:end],
+                metadatas=metadatas[start:end]
+            )
+
+    @staticmethod
+    def _normalize_question(question: str) -> str:
+        """キャッシュのキー用に質問を正規化（全角・半角の統一、空白の圧縮、大文字小文字の同一視）"""
+        return " ".join(unicodedata.normalize("NFKC", question).split()).casefold()
+
+    async def _expand_query(self, question: str) -> List[str]:
         """
         クエリを拡張して関連するキーワードを生成
 
@@ -223,31 +548,130 @@ class RAGService:
             question: 元の質問
 
         Returns:
-            拡張されたクエリのリスト
+            拡張されたクエリのリスト（元の質問は含まない、最大3つ）
+
+        Raises:
+            Exception: LLMの呼び出しに失敗した場合
         """
         expansion_prompt = PromptTemplates.build_query_expansion_prompt(question)
 
+        logger.debug("Expanding query...")
+        result = await ollama_client.generate(self.model_name, expansion_prompt, self.expansion_options)
+        expanded = result.get("response", "")
+        # 改行で分割してクリーンアップ
+        keywords = [line.strip() for line in expanded.split('\n') if line.strip() and not line.strip().startswith('#')]
+        # 元の質問と同じものは除く
+        keywords = [keyword for keyword in dict.fromkeys(keywords) if keyword != question]
+        logger.debug("Expanded queries: %s", keywords)
+        return keywords[:3]  # 最大3つまで(元の質問と合わせて4つ)
+
+    async def _get_query_expansion(self, question: str) -> List[str]:
+        """
+        拡張クエリを取得（キャッシュになければ生成し、同じ質問の生成中の拡張があれば結果を共有）
+
+        Args:
+            question: 元の質問
+
+        Returns:
+            拡張されたクエリのリスト（元の質問は含まない。失敗した場合は空）
+        """
+        key = (self.model_name, self._normalize_question(question))
+        cached = self._query_expansion_cache.get(key)
+        if cached is not None:
+            return cached
+
+        task = self._pending_expansions.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate_query_expansion(key, question))
+            self._pending_expansions[key] = task
+            task.add_done_callback(
+                lambda done: self._pending_expansions.pop(key) if self._pending_expansions.get(key) is done else None
+            )
+        # 待ち手が締め切りで打ち切られても生成は続け、結果をキャッシュに残す
+        return await asyncio.shield(task)
+
+    async def _generate_query_expansion(self, key: tuple, question: str) -> List[str]:
+        """拡張クエリを生成してキャッシュに保存（失敗した場合はキャッシュせず空を返す）"""
+        started_at = time.perf_counter()
         try:
-            logger.debug("Expanding query...")
-            expanded = self.llm.invoke(expansion_prompt)
-            # 改行で分割してクリーンアップ
-            keywords = [line.strip() for line in expanded.split('\n') if line.strip() and not line.strip().startswith('#')]
-            # 元の質問を先頭に追加
-            keywords.insert(0, question)
-            logger.debug("Expanded queries: %s", keywords)
-            return keywords[:4]  # 最大4つまで(元の質問+3つ)
+            keywords = await self._expand_query(question)
         except Exception as e:
             logger.warning("Query expansion failed: %s, using original question only", e)
-            return [question]
+            return []
+        self.retrieval_timings.record("query_expansion", time.perf_counter() - started_at, len(keywords))
+        self._query_expansion_cache.set(key, keywords)
+        return keywords
+
+    def _embed_query(self, query: str) -> List[float]:
+        """
+        クエリをベクトル化（直近のクエリはキャッシュから再利用）
 
-    def _hybrid_search(self, question: str, k: int = 5, vector_weight: float = 0.5) -> List[Tuple]:
+        Args:
+            query: 検索クエリ
+
+        Returns:
+            クエリのベクトル
+        """
+        return self._embed_queries([query])[0]
+
+    def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """
+        複数のクエリをまとめてベクトル化（キャッシュにないものだけを1回のリクエストで計算）
+
+        Args:
+            queries: 検索クエリのリスト
+
+        Returns:
+            入力と同じ順序のベクトルのリスト
+        """
+        vectors = [self._query_embedding_cache.get((self.embedding_model, query)) for query in queries]
+        missing = list(dict.fromkeys(query for query, vector in zip(queries, vectors) if vector is None))
+        if missing:
+            computed = dict(zip(missing, self.embeddings.embed_queries(missing)))
+            for query, vector in computed.items():
+                self._query_embedding_cache.set((self.embedding_model, query), vector)
+            vectors = [computed[query] if vector is None else vector for query, vector in zip(queries, vectors)]
+        return vectors
+
+    def _vector_search(self, query_vector: List[float], k: int, tags: List[str] = None) -> List[Tuple]:
+        """
+        計算済みのクエリベクトルでベクトル検索
+
+        Args:
+            query_vector: クエリのベクトル
+            k: 取得するドキュメント数
+            tags: 指定した場合、いずれかのタグを持つチャンクだけを検索
+
+        Returns:
+            (Document, L2距離)のタプルのリスト（距離が小さいほど類似、Document.id はチャンクID）
+        """
+        result = self.vectorstore._collection.query(
+            query_embeddings=[query_vector],
+            n_results=k,
+            where=self._tag_where(tags),
+            include=["documents", "metadatas", "distances"]
+        )
+        return [
+            (Document(page_content=text, metadata=metadata or {}, id=chunk_id), distance)
+            for chunk_id, text, metadata, distance in zip(
+                result['ids'][0], result['documents'][0], result['metadatas'][0], result['distances'][0]
+            )
+        ]
+
+    def _hybrid_search(self, question: str, k: int = 5, vector_weight: float = 0.5,
+                       query_vector: List[float] = None, tags: List[str] = None,
+                       fusion_strategy: str = None) -> List[Tuple]:
         """
         BM25とベクトル検索を組み合わせたハイブリッド検索
+        両方の検索結果はチャンクIDで突き合わせるため、同じチャンクは1つの候補に統合される
 
         Args:
             question: 検索クエリ
             k: 取得するドキュメント数
             vector_weight: ベクトル検索の重み (0.0-1.0)、BM25の重みは (1 - vector_weight)
+            query_vector: 計算済みのクエリベクトル（Noneの場合はここで計算）
+            tags: 指定した場合、いずれかのタグを持つチャンクだけを検索
+            fusion_strategy: スコア統合の方式（"weighted" または "rrf"、Noneの場合は設定値）
 
         Returns:
             (Document, スコア)のタプルのリスト
@@ -257,30 +681,29 @@ class RAGService:
         # 1. ベクトル検索
         vector_results = []
         try:
+            if query_vector is None:
+                with self.retrieval_timings.measure("embed_query"):
+                    query_vector = self._embed_query(question)
             # より多くの候補を取得
-            vector_docs = self.vectorstore.similarity_search_with_score(question, k=k*3)
-            vector_results = vector_docs
+            with self.retrieval_timings.measure("vector_search"):
+                vector_results = self._vector_search(query_vector, k=k*3, tags=tags)
             logger.debug("Vector search returned %d results", len(vector_results))
         except Exception as e:
             logger.error("Vector search error: %s", e)
 
         # 2. BM25検索
         bm25_results = []
-        if self.bm25_index and self.bm25_docs:
+        if len(self.bm25_index):
             try:
                 # クエリをトークン化
                 query_tokens = self._tokenize_japanese(question)
                 logger.debug("Query tokens: %s", query_tokens)
 
-                # BM25スコアを取得
-                bm25_scores = self.bm25_index.get_scores(query_tokens)
-
-                # スコア順でソート
-                doc_score_pairs = list(zip(self.bm25_docs, bm25_scores))
-                doc_score_pairs.sort(key=lambda x: x[1], reverse=True)
-
-                # 上位k*3件を取得
-                bm25_results = doc_score_pairs[:k*3]
+                # クエリ語を含むチャンクのみスコアリングし、上位k*3件を取得
+                with self.retrieval_timings.measure("bm25_search"):
+                    bm25_hits = self.bm25_index.search(query_tokens, k*3, tags=tags)
+                with self.retrieval_timings.measure("bm25_fetch", items=len(bm25_hits)):
+                    bm25_results = self._get_chunks_by_id(bm25_hits)
                 logger.debug("BM25 search returned %d results", len(bm25_results))
                 if bm25_results:
                     logger.debug("BM25 top 5 scores: %s", [score for _, score in bm25_results[:5]])
@@ -289,140 +712,199 @@ class RAGService:
         else:
             logger.debug("BM25 index not available")
 
-        # 3. スコアの正規化と統合
-        combined_scores = {}
-
-        # ベクトル検索結果を正規化 (L2距離: 小さいほど良い)
-        if vector_results:
-            vector_scores_only = [score for _, score in vector_results]
-            min_vec = min(vector_scores_only)
-            max_vec = max(vector_scores_only)
-            vec_range = max_vec - min_vec if max_vec != min_vec else 1
-
-            for doc, score in vector_results:
-                # L2距離を0-1のスコアに変換（小さいほど高スコア）
-                normalized = 1 - ((score - min_vec) / vec_range)
-                doc_id = id(doc)
-                if doc_id not in combined_scores:
-                    combined_scores[doc_id] = {"doc": doc, "vector": 0, "bm25": 0}
-                combined_scores[doc_id]["vector"] = normalized
-
-        # BM25結果を正規化 (大きいほど良い)
-        if bm25_results:
-            bm25_scores_only = [score for _, score in bm25_results]
-            min_bm25 = min(bm25_scores_only)
-            max_bm25 = max(bm25_scores_only)
-            bm25_range = max_bm25 - min_bm25 if max_bm25 != min_bm25 else 1
-
-            for doc, score in bm25_results:
-                # BM25スコアを0-1に正規化
-                normalized = (score - min_bm25) / bm25_range if bm25_range > 0 else 0
-                doc_id = id(doc)
-                if doc_id not in combined_scores:
-                    combined_scores[doc_id] = {"doc": doc, "vector": 0, "bm25": 0}
-                combined_scores[doc_id]["bm25"] = normalized
-
-        # 4. 重み付けして最終スコアを計算
-        final_results = []
-        bm25_weight = 1 - vector_weight
-
-        for doc_id, scores in combined_scores.items():
-            final_score = (scores["vector"] * vector_weight) + (scores["bm25"] * bm25_weight)
-            final_results.append((scores["doc"], final_score))
-            logger.debug("Doc (vec=%.3f, bm25=%.3f) -> final=%.3f",
-                        scores['vector'], scores['bm25'], final_score)
-
-        # スコア順でソート（高い方が良い）
-        final_results.sort(key=lambda x: x[1], reverse=True)
-
-        # 上位k件を返す
-        top_results = final_results[:k]
-        logger.debug("Hybrid search returning top %d results", len(top_results))
+        # 3. スコアの統合（チャンクIDとスコアの配列上で計算し、上位k件だけを選ぶ）
+        strategy = fusion_strategy or RAGConfig.HYBRID_FUSION_STRATEGY
+        candidates = vector_results + bm25_results
+        with self.retrieval_timings.measure("fusion", items=len(candidates)):
+            vector_ids = np.array([doc.id for doc, _ in vector_results], dtype=object)
+            bm25_ids = np.array([doc.id for doc, _ in bm25_results], dtype=object)
+            if strategy == "rrf":
+                positions, fused_scores = reciprocal_rank_fusion(
+                    vector_ids, bm25_ids, vector_weight, k, rrf_k=RAGConfig.RRF_K
+                )
+            else:
+                positions, fused_scores = weighted_min_max_fusion(
+                    vector_ids,
+                    np.fromiter((score for _, score in vector_results), dtype=np.float64, count=len(vector_results)),
+                    bm25_ids,
+                    np.fromiter((score for _, score in bm25_results), dtype=np.float64, count=len(bm25_results)),
+                    vector_weight, k
+                )
+            top_results = [(candidates[position][0], float(score))
+                           for position, score in zip(positions, fused_scores)]
+
+        logger.debug("Hybrid search (%s) returning top %d of %d candidates", strategy, len(top_results), len(candidates))
 
         return top_results
 
-    def _create_ollama_instance(self, model_name: str = None, **kwargs):
-        """Ollamaインスタンスを作成するヘルパーメソッド"""
-        # デフォルト値を設定
-        params = {
-            "model": model_name or self.model_name,
-            "base_url": RAGConfig.OLLAMA_BASE_URL,
-            "temperature": kwargs.get("temperature", RAGConfig.DEFAULT_TEMPERATURE),
-            "top_p": kwargs.get("top_p", RAGConfig.DEFAULT_TOP_P),
-            "repeat_penalty": kwargs.get("repeat_penalty", RAGConfig.DEFAULT_REPEAT_PENALTY),
+    @staticmethod
+    def _ollama_options(**llm_params) -> dict:
+        """生成パラメータからOllamaの options を作成（Noneのものは含めず、Ollama側の既定値を使う）"""
+        return {
+            key: llm_params[key]
+            for key in ("temperature", "top_p", "top_k", "repeat_penalty", "num_predict", "num_ctx",
+                        "seed", "mirostat", "mirostat_tau", "mirostat_eta", "tfs_z")
+            if llm_params.get(key) is not None
         }
 
-        # オプショナルパラメータを追加（Noneでない場合のみ）
-        optional_params = ["num_predict", "top_k", "num_ctx", "seed",
-                          "mirostat", "mirostat_tau", "mirostat_eta", "tfs_z"]
-        for param in optional_params:
-            if param in kwargs and kwargs[param] is not None:
-                params[param] = kwargs[param]
+    async def _context_window(self, model_name: Optional[str], llm_params: dict) -> int:
+        """
+        生成に使うコンテキスト長（num_ctx）
+        指定がない場合はモデルの設定（Modelfileの num_ctx）、それもない場合はOllamaの既定値
+        """
+        if llm_params.get("num_ctx"):
+            return llm_params["num_ctx"]
+        model = model_name or self.model_name
+        num_ctx = self._model_num_ctx.get(model)
+        if num_ctx is None:
+            info = await ollama_client.show(model)
+            num_ctx = RAGConfig.DEFAULT_NUM_CTX
+            for line in (info.get("parameters") or "").splitlines():
+                name, _, value = line.strip().partition(" ")
+                if name == "num_ctx" and value.strip().isdigit():
+                    num_ctx = int(value.strip())
+            if info:
+                self._model_num_ctx.set(model, num_ctx)
+        return num_ctx
+
+    async def _pack_context(self, fixed_prompt: str, documents: List[Document], model_name: Optional[str],
+                            llm_params: dict, history: List[str] = ()) -> PackedContext:
+        """
+        プロンプトがコンテキスト長に収まるよう、参照ドキュメント（順位の低いものから）と会話履歴（古いものから）を減らす
+
+        Args:
+            fixed_prompt: 参照ドキュメントと会話履歴を空にしたプロンプト（指示・質問などの固定部分）
+            documents: 参照ドキュメント（順位順）
+            model_name: モデル名
+            llm_params: 生成パラメータ（num_ctx, num_predict を参照）
+            history: 会話履歴の行（古い順）
+
+        Returns:
+            詰め込みの結果
+        """
+        fixed_tokens = estimate_tokens(fixed_prompt)
+        num_ctx = await self._context_window(model_name, llm_params)
+        packed = self.context_packer.pack(documents, fixed_tokens, num_ctx, llm_params.get("num_predict"), history)
+        logger.info("Packed prompt: ~%d tokens (num_ctx %d, %d/%d documents, %d trimmed, %d history dropped)",
+                    packed.prompt_tokens, num_ctx, len(packed.documents), len(documents),
+                    packed.trimmed_documents, packed.dropped_history)
+        return packed
+
+    def _answer_cache_key(self, kind: str, question: str, model_name: Optional[str], llm_params: dict,
+                          chat_history: Optional[list], tags: Optional[list], **options) -> Optional[tuple]:
+        """
+        回答キャッシュのキーを作成
+        インデックスのバージョンを含めるため、取り込み・削除の後は古い回答が使われない
+
+        Args:
+            kind: 呼び出し元（"query" または "stream"、応答の形式が異なるため区別する）
+            question: 質問文
+            model_name: 使用するモデル名
+            llm_params: 生成パラメータ
+            chat_history: 会話履歴
+            tags: タグフィルタ
+            **options: 回答に影響するその他の条件（k、検索方式など）
+
+        Returns:
+            (スコープ, 正規化した質問) のタプル（キャッシュしない場合はNone）
+            スコープは質問以外の条件で、意味的な回答キャッシュはスコープが同じ回答だけを再利用する
+        """
+        # 会話の途中の質問は履歴によって回答が変わるためキャッシュしない
+        if not RAGConfig.ANSWER_CACHE_ENABLED or chat_history:
+            return None
+        params = tuple(sorted(
+            (key, tuple(value) if isinstance(value, list) else value)
+            for key, value in llm_params.items() if value is not None
+        ))
+        scope = (
+            kind,
+            model_name or self.model_name,
+            params,
+            tuple(sorted(set(tags))) if tags else (),
+            tuple(sorted(options.items())),
+            self.catalog.index_version,
+        )
+        return scope, self._normalize_question(question)
+
+    async def _get_cached_answer(self, cache_key: Optional[tuple], question: str,
+                                 use_semantic_cache: bool) -> Tuple[Optional[object], Optional[List[float]]]:
+        """
+        キャッシュから回答を取得（完全一致の質問、なければ質問ベクトルが類似した質問）
+
+        Args:
+            cache_key: _answer_cache_key で作成したキー
+            question: 質問文
+            use_semantic_cache: 意味的な回答キャッシュを使用するか
+
+        Returns:
+            (キャッシュされた値, 質問のベクトル) のタプル
+            値が見つからない場合はNone、ベクトルは計算しなかった場合はNone
+            （ベクトルはクエリベクトルのキャッシュにも残るため、続く検索で再計算しない）
+        """
+        if cache_key is None:
+            return None, None
+        cached = self._answer_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Answer cache hit: %s", question)
+            return cached, None
+        if not use_semantic_cache or not RAGConfig.SEMANTIC_CACHE_ENABLED:
+            return None, None
 
-        return Ollama(**params)
+        try:
+            question_vector = (await execution_layer.search.run(self._embed_queries, [question]))[0]
+        except Exception as e:
+            logger.debug("Semantic answer cache lookup skipped: %s", e)
+            return None, None
+        hit = self._semantic_answer_cache.get(cache_key[0], question_vector)
+        if hit is None:
+            return None, question_vector
+        cached, similarity = hit
+        logger.debug("Semantic answer cache hit (similarity=%.3f): %s", similarity, question)
+        return cached, question_vector
+
+    def _store_answer(self, cache_key: Optional[tuple], value, answer: str,
+                      question_vector: Optional[List[float]] = None) -> None:
+        """回答をキャッシュに保存（空の回答と長すぎる回答は保存しない）"""
+        if cache_key is None or not answer.strip() or len(answer) > RAGConfig.ANSWER_CACHE_MAX_CHARS:
+            return
+        self._answer_cache.set(cache_key, value)
+        if question_vector is not None:
+            self._semantic_answer_cache.set(cache_key[0], question_vector, value)
 
-    def query(self, question: str, k: int = 5, search_multiplier: int = 10, model_name: str = None, use_rag: bool = True, enable_query_expansion: bool = False,
+    async def query(self, question: str, k: int = 5, search_multiplier: int = 10, model_name: str = None, use_rag: bool = True, enable_query_expansion: bool = False,
               chat_history: list = None, temperature: float = None, top_p: float = None, repeat_penalty: float = None,
               num_predict: int = None, top_k: int = None, num_ctx: int = None, seed: int = None,
               mirostat: int = None, mirostat_tau: float = None, mirostat_eta: float = None, tfs_z: float = None,
               stop: list = None, presence_penalty: float = None, frequency_penalty: float = None, min_p: float = None,
               repeat_last_n: int = None, num_thread: int = None, num_gpu: int = None, typical_p: float = None,
-              penalize_newline: bool = None) -> Tuple[str, List[str], List[dict]]:
+              penalize_newline: bool = None, tags: list = None,
+              use_semantic_cache: bool = True,
+              client_id: Optional[str] = None) -> Tuple[str, List[str], List[dict]]:
         """
         質問に対してRAGで回答を生成
 
         Args:
             question: 質問文
-            k: 最終的に使用する関連文書の数（デフォルト: 5）
+            k: 最終的に使用する関連文書の数（Noneの場合はデフォルト5）
+            search_multiplier: 検索範囲倍率（Noneの場合はデフォルト10）
             model_name: 使用するモデル名（Noneの場合はデフォルトモデルを使用）
             use_rag: RAGを使用するか（Falseの場合は直接LLMに質問）
             enable_query_expansion: クエリ拡張を有効にするか（デフォルト: False）
             temperature: LLMの温度パラメータ（Noneの場合はデフォルト0.3を使用）
             top_p: Nucleus samplingパラメータ（Noneの場合はデフォルト0.9を使用）
             repeat_penalty: 繰り返しペナルティ（Noneの場合はデフォルト1.1を使用）
+            tags: 指定した場合、いずれかのタグを持つドキュメントだけを検索
+            use_semantic_cache: 言い換えた質問にもキャッシュした回答を使うか
+            client_id: 生成スケジューラで公平に扱う単位（指定した場合は生成の順番を待つ。キャッシュした回答は待たずに返す）
 
         Returns:
             回答、参照元、スコア情報のタプル
-        """
-        logger.debug("Query received: %s", question)
-        logger.debug("Model: %s", model_name if model_name else f'default ({self.model_name})')
-        logger.debug("Use RAG: %s", use_rag)
-        logger.debug("Query expansion: %s", enable_query_expansion)
-
-        # ベクトルストアの内容を確認
-        try:
-            all_docs = self.vectorstore.get()
-            if all_docs and "metadatas" in all_docs:
-                unique_sources = set()
-                for metadata in all_docs["metadatas"]:
-                    if metadata and "source_file" in metadata:
-                        unique_sources.add(metadata["source_file"])
-                logger.debug("Documents in vectorstore: %s", sorted(unique_sources))
-                logger.debug("Total chunks: %s", len(all_docs['metadatas']))
-        except Exception as e:
-            logger.debug("Error checking vectorstore: %s", e)
-
-        # クエリ拡張
-        queries = self._expand_query(question) if enable_query_expansion else [question]
 
-        # 各クエリで検索を実行し、スコア付きでドキュメントを取得
-        # より多くのドキュメントを取得してフィルタリング
-        initial_k = k * search_multiplier  # 検索範囲倍率を適用
-        all_docs_with_scores = []
-        seen_content = set()  # 重複排除用
-
-        for query in queries:
-            try:
-                docs_with_scores = self.vectorstore.similarity_search_with_score(query, k=initial_k)
-
-                for doc, score in docs_with_scores:
-                    # 重複チェック(同じ内容のドキュメントを排除)
-                    content_hash = hash(doc.page_content[:200])  # 最初の200文字でハッシュ化
-                    if content_hash not in seen_content:
-                        seen_content.add(content_hash)
-                        all_docs_with_scores.append((doc, score))
-            except Exception as e:
-                logger.debug("Error searching with query '{query}': %s", e)
+        Raises:
+            GenerationQueueFullError: 生成の待ち行列に空きがない場合
+        """
+        k = k if k is not None else RAGConfig.DEFAULT_DOCUMENT_COUNT
+        search_multiplier = search_multiplier if search_multiplier is not None else RAGConfig.DEFAULT_SEARCH_MULTIPLIER
 
         # パラメータをまとめる
         llm_params = {
@@ -435,11 +917,57 @@ class RAGService:
             "num_gpu": num_gpu, "typical_p": typical_p, "penalize_newline": penalize_newline
         }
 
+        # 同じ質問・条件の回答がキャッシュにあれば、検索と生成を行わずに返す
+        cache_key = self._answer_cache_key(
+            "query", question, model_name, llm_params, chat_history, tags,
+            k=k, search_multiplier=search_multiplier, query_expansion=enable_query_expansion
+        )
+        cached, question_vector = await self._get_cached_answer(cache_key, question, use_semantic_cache)
+        if cached is not None:
+            return cached
+
+        ticket = self._admit_generation(model_name, client_id)
+        try:
+            result = await self._generate_answer(question, k, search_multiplier, model_name, use_rag,
+                                                 enable_query_expansion, chat_history, tags, llm_params, ticket)
+        finally:
+            if ticket is not None:
+                ticket.release()
+        self._store_answer(cache_key, result, result[0], question_vector)
+        return result
+
+    async def _generate_answer(self, question: str, k: int, search_multiplier: int, model_name: str,
+                               use_rag: bool, enable_query_expansion: bool, chat_history: Optional[list],
+                               tags: Optional[list], llm_params: dict,
+                               generation_ticket: Optional[GenerationTicket] = None) -> Tuple[str, List[str], List[dict]]:
+        """
+        検索と生成を行って回答を作成（引数は query と同じ、生成パラメータは llm_params にまとめたもの）
+
+        Returns:
+            回答、参照元、スコア情報のタプル
+        """
+        logger.debug("Query received: %s", question)
+        logger.debug("Model: %s", model_name if model_name else f'default ({self.model_name})')
+        logger.debug("Use RAG: %s", use_rag)
+        logger.debug("Query expansion: %s", enable_query_expansion)
+
+        # コーパスの統計（カウンタのみ参照し、コレクションは走査しない）
+        logger.debug("Corpus stats: %s", self.catalog.stats())
+
+        # 元の質問の検索とクエリ拡張を並行して実行し、重複を除いたスコア付きドキュメントを取得
+        # （k * 検索範囲倍率 件を取得してから上位k件を選ぶ。タグは検索時に絞り込む）
+        all_docs_with_scores = await self._retrieve_with_expansion(
+            question, k, search_multiplier, False, enable_query_expansion, tags=tags
+        )
+
+        if len(all_docs_with_scores) == 0 and tags:
+            # タグフィルターが指定されている場合は、情報がないことを明示的に伝える
+            tag_list = "、".join(tags)
+            return f"申し訳ございません。指定されたタグ「{tag_list}」に関連する情報が見つかりませんでした。\n\n別のタグを選択するか、タグフィルターを解除してお試しください。", [], []
+
         if len(all_docs_with_scores) == 0:
             logger.debug("No documents found in vector store. Responding without RAG context.")
             # ドキュメントがない場合は、RAGなしでLLMに直接質問
-            llm = self._create_ollama_instance(model_name, **llm_params)
-
             # RAGなしのプロンプト
             simple_prompt = f"""あなたは親切で知識豊富なアシスタントです。以下の質問に答えてください。
 
@@ -447,71 +975,43 @@ class RAGService:
 
 回答:"""
 
-            answer = llm.invoke(simple_prompt)
+            answer = await self._generate_text(simple_prompt, model_name, llm_params, generation_ticket)
             return answer, [], []
 
-        # スコアでソート(ChromaDBの場合、スコアが小さいほど類似度が高い)して上位k件を選択
-        all_docs_with_scores.sort(key=lambda x: x[1])
+        # スコア順(ChromaDBの場合、スコアが小さいほど類似度が高い)に上位k件を選択（全件はソートしない）
+        with self.retrieval_timings.measure("select_top_k", items=len(all_docs_with_scores)):
+            top_docs_with_scores = select_top_k(all_docs_with_scores, k, descending=False)
 
-        # デバッグ: 検索結果の上位20件を表示
-        logger.debug("Top 20 search results:")
-        for i, (doc, score) in enumerate(all_docs_with_scores[:20]):
+        # デバッグ: 検索結果の上位を表示
+        logger.debug("Top %d of %d search results:", len(top_docs_with_scores), len(all_docs_with_scores))
+        for i, (doc, score) in enumerate(top_docs_with_scores):
             source = doc.metadata.get("source_file", "Unknown")
             logger.debug("  %d. %s: %.2f", i+1, source, score)
 
-        # test_006がどこにあるか確認
-        for i, (doc, score) in enumerate(all_docs_with_scores):
-            source = doc.metadata.get("source_file", "Unknown")
-            if "test_006" in source:
-                logger.debug(">>> test_006_emc_test.txt found at position %d with score %.2f", i+1, score)
-                break
-        else:
-            logger.debug(">>> test_006_emc_test.txt NOT FOUND in search results!")
-
-        top_docs_with_scores = all_docs_with_scores[:k]
         top_docs = [doc for doc, _score in top_docs_with_scores]
 
-        # コンテキストの構築
-        context = "\n\n".join([doc.page_content for doc in top_docs])
-
-        # 会話履歴を含めたプロンプトの構築
-        if chat_history and len(chat_history) > 0:
-            # 会話履歴を文字列に変換
-            history_text = "\n".join([
-                f"{'ユーザー' if msg['role'] == 'user' else 'アシスタント'}: {msg['content']}"
-                for msg in chat_history[-10:]  # 最新10件のみ使用
-            ])
-
-            prompt_text = f"""あなたは親切で知識豊富なアシスタントです。
-
-以下は過去の会話履歴です：
-{history_text}
-
-参照ドキュメント:
-{context}
-
-質問: {question}
+        # 会話履歴（最新10件まで）を行に変換
+        history_lines = [
+            f"{'ユーザー' if msg['role'] == 'user' else 'アシスタント'}: {msg['content']}"
+            for msg in (chat_history or [])[-10:]
+        ]
 
-指示:
-- 上記の参照ドキュメントに含まれる情報を最大限活用して、質問に対して詳しく丁寧に答えてください
-- 会話の文脈を考慮し、自然な対話を心がけてください
-- 直接的な答えが見つからない場合でも、関連する情報や類似の内容があれば、それを基に推論して回答してください
-- ドキュメントに複数の関連情報がある場合は、それらを統合して包括的な回答を提供してください
-- ドキュメント内の具体的な情報（数値、固有名詞、事実など）を積極的に引用してください
-- どうしても関連する情報が全く見つからない場合のみ、その旨を伝えてください
-- 回答は読みやすいように、適切に段落分けや改行を入れてください
-- 複数の項目を説明する場合は、項目ごとに改行して見やすくしてください
+        # コンテキストの構築（コンテキスト長に収まるよう、順位の低いチャンクと古い会話履歴から減らす）
+        template = PromptTemplates.CHAT_HISTORY_TEMPLATE if history_lines else self.prompt_template
+        packed = await self._pack_context(template.format(context="", question=question, history=""),
+                                          top_docs, model_name, llm_params, history_lines)
 
-回答:"""
+        # 会話履歴を含めたプロンプトの構築
+        if packed.history:
+            prompt_text = PromptTemplates.build_prompt(packed.context, question, packed.history_text)
         else:
             # 会話履歴がない場合は従来通り
-            prompt_text = self.prompt.format(context=context, question=question)
-
-        # モデルの選択
-        llm = self._create_ollama_instance(model_name, **llm_params)
+            prompt_text = self.prompt.format(context=packed.context, question=question)
+        # 参照元はプロンプトに入れたチャンクだけにする
+        top_docs_with_scores = top_docs_with_scores[:len(packed.documents)]
 
         # 回答の生成
-        answer = llm.invoke(prompt_text)
+        answer = await self._generate_text(prompt_text, model_name, llm_params, generation_ticket)
 
         # 参照元の抽出とスコア情報の作成
         sources = []
@@ -543,9 +1043,97 @@ class RAGService:
 
         return answer, list(set(sources)), source_scores
 
-    async def _stream_ollama_chat(self, system_message: str, user_message: str, model_name: str = None, **llm_params):
+    def _record_generation(self, data: dict, stats: Optional[dict] = None) -> None:
+        """
+        Ollamaの最後の応答（done）から、プロンプトの評価と生成のトークン数・所要時間を記録
+        prompt_eval_count はKVキャッシュを再利用できなかった（新たに評価した）トークン数
+
+        Args:
+            data: Ollamaの応答
+            stats: 指定した場合、トークン数と所要時間（ナノ秒）を書き込む
+        """
+        fields = {key: data[key] for key in ("prompt_eval_count", "prompt_eval_duration", "eval_count",
+                                             "eval_duration", "load_duration") if key in data}
+        self.generation_timings.record("prompt_eval", fields.get("prompt_eval_duration", 0) / 1e9,
+                                       fields.get("prompt_eval_count", 0))
+        self.generation_timings.record("eval", fields.get("eval_duration", 0) / 1e9, fields.get("eval_count", 0))
+        logger.info("Generation: prompt_eval_count=%d (%.0fms), eval_count=%d",
+                    fields.get("prompt_eval_count", 0), fields.get("prompt_eval_duration", 0) / 1e6,
+                    fields.get("eval_count", 0))
+        if stats is not None:
+            stats.update(fields)
+
+    @staticmethod
+    def _conversation_window(chat_history: list) -> list:
+        """
+        会話モードでプロンプトに含める履歴（最新 CONVERSATION_HISTORY_MESSAGES 件まで）
+        1件ずつずらすと毎回プロンプトの先頭が変わりKVキャッシュが使えなくなるため、
+        上限を超えたら2往復単位でまとめて古いものを外す
+        """
+        limit = RAGConfig.CONVERSATION_HISTORY_MESSAGES
+        excess = len(chat_history) - limit
+        if excess <= 0:
+            return list(chat_history)
+        step = 4
+        return list(chat_history[math.ceil(excess / step) * step:])
+
+    def _admit_generation(self, model_name: Optional[str], client_id: Optional[str]) -> Optional[GenerationTicket]:
+        """
+        キャッシュにない質問の生成を生成スケジューラで受け付け、検索と並行してモデルを読み込んでおく
+
+        Args:
+            model_name: モデル名（Noneの場合は既定のモデル）
+            client_id: 公平に扱う単位（Noneの場合は順番を待たずに生成する）
+
+        Returns:
+            実行権のチケット（client_id がNoneの場合はNone）
+
+        Raises:
+            GenerationQueueFullError: 待ち行列に空きがない場合
+        """
+        if client_id is None:
+            return None
+        ticket = generation_scheduler.admit(model_name or self.model_name, client_id)
+        model_manager.warm(ticket.model)
+        return ticket
+
+    @staticmethod
+    async def _wait_for_turn(ticket: Optional[GenerationTicket]):
+        """
+        生成の順番を待ち、待ち行列での順番が変わるたびに通知用のチャンクを返す
+
+        Yields:
+            "__QUEUE__:{json}" 形式のチャンク（position: 待ち行列での順番、model: モデル名）
+        """
+        if ticket is None:
+            return
+        async for position in ticket.wait():
+            yield f"{QUEUE_MARKER}{json.dumps({'position': position, 'model': ticket.model})}"
+
+    async def _generate_text(self, prompt: str, model_name: Optional[str], llm_params: dict,
+                             ticket: Optional[GenerationTicket] = None) -> str:
+        """
+        テキストを生成（ストリーミングなし）
+        ticket を指定した場合は生成スケジューラで順番を待ってから生成する
+        """
+        try:
+            if ticket is not None:
+                await ticket.acquire()
+            result = await ollama_client.generate(model_name or self.model_name, prompt,
+                                                  self._ollama_options(**llm_params))
+        finally:
+            if ticket is not None:
+                ticket.release()
+        self._record_generation(result)
+        return result.get("response", "")
+
+    async def _stream_ollama_chat(self, system_message: str, user_message: str, model_name: str = None,
+                                  ticket: Optional[GenerationTicket] = None, history: list = None,
+                                  stats: dict = None, **llm_params):
         """
         Ollama Chat APIを使用してストリーミング（systemロールをサポート）
+        ticket を指定した場合は生成スケジューラで順番を待ち、待っている間は順番を通知する
+        history には過去のやり取り（role, content）を古い順に渡す。stats を指定した場合は prompt_eval_count などを書き込む
         """
         if model_name is None or model_name == '':
             model_name = self.model_name
@@ -554,29 +1142,13 @@ class RAGService:
         logger.info(f"[STREAM] Starting Ollama chat stream with model: {model_name}")
 
         # パラメータを準備
-        options = {}
-        param_mapping = {
-            'temperature': 'temperature',
-            'top_p': 'top_p',
-            'top_k': 'top_k',
-            'repeat_penalty': 'repeat_penalty',
-            'num_predict': 'num_predict',
-            'num_ctx': 'num_ctx',
-            'seed': 'seed',
-            'mirostat': 'mirostat',
-            'mirostat_tau': 'mirostat_tau',
-            'mirostat_eta': 'mirostat_eta',
-            'tfs_z': 'tfs_z'
-        }
-
-        for param_key, ollama_key in param_mapping.items():
-            if param_key in llm_params and llm_params[param_key] is not None:
-                options[ollama_key] = llm_params[param_key]
+        options = self._ollama_options(**llm_params)
 
         # Chat API用のメッセージ形式
         messages = []
         if system_message:
             messages.append({"role": "system", "content": system_message})
+        messages.extend({"role": msg["role"], "content": msg["content"]} for msg in history or [])
         messages.append({"role": "user", "content": user_message})
 
         payload = {
@@ -589,27 +1161,31 @@ class RAGService:
         logger.debug(f"[STREAM] Using chat API with system message")
 
         try:
-            async with httpx.AsyncClient(timeout=300.0) as client:
-                async with client.stream('POST', 'http://localhost:11434/api/chat', json=payload) as response:
-                    logger.info(f"[STREAM] Response status: {response.status_code}")
-                    chunk_count = 0
-                    async for line in response.aiter_lines():
-                        if line:
-                            try:
-                                data = json.loads(line)
-                                if 'message' in data and 'content' in data['message']:
-                                    chunk_count += 1
-                                    yield data['message']['content']
-                            except json.JSONDecodeError:
-                                continue
-                    logger.info(f"[STREAM] Completed. Total chunks: {chunk_count}")
+            async for event in self._wait_for_turn(ticket):
+                yield event
+            # 共有の接続プールを使い、リクエストごとの接続確立を省く
+            chunk_count = 0
+            async for data in ollama_client.stream('/api/chat', payload):
+                if 'message' in data and 'content' in data['message']:
+                    chunk_count += 1
+                    yield data['message']['content']
+                if data.get('done'):
+                    self._record_generation(data, stats)
+            logger.info(f"[STREAM] Completed. Total chunks: {chunk_count}")
         except Exception as e:
             logger.error(f"[STREAM] Error during streaming: {e}")
             raise
+        finally:
+            # 生成が終わったらすぐに次のリクエストに枠を渡す
+            if ticket is not None:
+                ticket.release()
 
-    async def _stream_ollama_direct(self, prompt: str, model_name: str = None, **llm_params):
+    async def _stream_ollama_direct(self, prompt: str, model_name: str = None,
+                                    ticket: Optional[GenerationTicket] = None, stats: dict = None, **llm_params):
         """
         Ollama APIを直接呼び出してリアルタイムストリーミング
+        ticket を指定した場合は生成スケジューラで順番を待ち、待っている間は順番を通知する
+        stats を指定した場合は prompt_eval_count などを書き込む
         """
         if model_name is None or model_name == '':
             model_name = self.model_name
@@ -619,24 +1195,7 @@ class RAGService:
         logger.debug(f"[STREAM] Prompt length: {len(prompt)} characters")
 
         # パラメータを準備（Noneでないもののみ）
-        options = {}
-        param_mapping = {
-            'temperature': 'temperature',
-            'top_p': 'top_p',
-            'top_k': 'top_k',
-            'repeat_penalty': 'repeat_penalty',
-            'num_predict': 'num_predict',
-            'num_ctx': 'num_ctx',
-            'seed': 'seed',
-            'mirostat': 'mirostat',
-            'mirostat_tau': 'mirostat_tau',
-            'mirostat_eta': 'mirostat_eta',
-            'tfs_z': 'tfs_z'
-        }
-
-        for param_key, ollama_key in param_mapping.items():
-            if param_key in llm_params and llm_params[param_key] is not None:
-                options[ollama_key] = llm_params[param_key]
+        options = self._ollama_options(**llm_params)
 
         payload = {
             "model": model_name,
@@ -648,25 +1207,196 @@ class RAGService:
         logger.debug(f"[STREAM] Payload options: {options}")
 
         try:
-            async with httpx.AsyncClient(timeout=300.0) as client:
-                async with client.stream('POST', 'http://localhost:11434/api/generate', json=payload) as response:
-                    logger.info(f"[STREAM] Response status: {response.status_code}")
-                    chunk_count = 0
-                    async for line in response.aiter_lines():
-                        if line:
-                            try:
-                                data = json.loads(line)
-                                if 'response' in data:
-                                    chunk_count += 1
-                                    if chunk_count % 10 == 0:  # 10チャンクごとにログ
-                                        logger.debug(f"[STREAM] Streamed {chunk_count} chunks so far")
-                                    yield data['response']
-                            except json.JSONDecodeError:
-                                continue
-                    logger.info(f"[STREAM] Completed. Total chunks: {chunk_count}")
+            async for event in self._wait_for_turn(ticket):
+                yield event
+            # 共有の接続プールを使い、リクエストごとの接続確立を省く
+            chunk_count = 0
+            async for data in ollama_client.stream('/api/generate', payload):
+                if 'response' in data:
+                    chunk_count += 1
+                    if chunk_count % 10 == 0:  # 10チャンクごとにログ
+                        logger.debug(f"[STREAM] Streamed {chunk_count} chunks so far")
+                    yield data['response']
+                if data.get('done'):
+                    self._record_generation(data, stats)
+            logger.info(f"[STREAM] Completed. Total chunks: {chunk_count}")
         except Exception as e:
             logger.error(f"[STREAM] Error during streaming: {e}")
             raise
+        finally:
+            # 生成が終わったらすぐに次のリクエストに枠を渡す
+            if ticket is not None:
+                ticket.release()
+
+    def _search_one(self, query: str, query_vector: Optional[List[float]], k: int, search_multiplier: int,
+                    use_hybrid_search: bool, tags: List[str] = None,
+                    fusion_strategy: str = None) -> List[Tuple]:
+        """
+        1つのクエリで検索を実行（検索プールのスレッドで並行して呼ばれる）
+
+        Args:
+            query: 検索クエリ
+            query_vector: 計算済みのクエリベクトル（計算に失敗した場合はNone）
+            k: 最終的に使用する関連文書の数
+            search_multiplier: 検索範囲倍率
+            use_hybrid_search: ハイブリッド検索（BM25 + ベクトル）を使用するか
+            tags: 指定した場合、いずれかのタグを持つチャンクだけを検索
+            fusion_strategy: ハイブリッド検索のスコア統合の方式（"weighted" または "rrf"）
+
+        Returns:
+            (Document, スコア)のタプルのリスト
+        """
+        if use_hybrid_search:
+            try:
+                return self._hybrid_search(query, k=k * search_multiplier,
+                                           vector_weight=RAGConfig.HYBRID_SEARCH_VECTOR_WEIGHT,
+                                           query_vector=query_vector, tags=tags,
+                                           fusion_strategy=fusion_strategy)
+            except Exception as e:
+                logger.debug("Hybrid search error with query '{query}': %s", e)
+                # フォールバック: ベクトル検索のみ
+                logger.debug("Falling back to vector search only")
+
+        try:
+            if query_vector is None:
+                with self.retrieval_timings.measure("embed_query"):
+                    query_vector = self._embed_query(query)
+            with self.retrieval_timings.measure("vector_search"):
+                return self._vector_search(query_vector, k=k * search_multiplier, tags=tags)
+        except Exception as e:
+            logger.debug("Error searching with query '{query}': %s", e)
+            return []
+
+    async def _retrieve(self, queries: List[str], k: int, search_multiplier: int,
+                        use_hybrid_search: bool, tags: List[str] = None,
+                        fusion_strategy: str = None) -> List[Tuple]:
+        """
+        すべてのクエリで検索を実行し、重複を除いたスコア付きドキュメントを取得
+        クエリのベクトル化は1回のリクエストにまとめ、クエリごとの検索は検索プールで並行して実行する
+        結果はクエリの順序で統合するため、実行順序によらず同じ結果になる
+
+        Args:
+            queries: 検索クエリのリスト
+            k: 最終的に使用する関連文書の数
+            search_multiplier: 検索範囲倍率
+            use_hybrid_search: ハイブリッド検索（BM25 + ベクトル）を使用するか
+            tags: 指定した場合、いずれかのタグを持つチャンクだけを検索
+            fusion_strategy: ハイブリッド検索のスコア統合の方式（"weighted" または "rrf"）
+
+        Returns:
+            (Document, スコア)のタプルのリスト
+        """
+        started_at = time.perf_counter()
+        logger.debug("Using %s for %d queries", "hybrid search (BM25 + Vector)" if use_hybrid_search else "vector search only",
+                     len(queries))
+
+        # クエリのベクトルはまとめて1回だけ計算し、フォールバック時にも再利用する
+        embed_started_at = time.perf_counter()
+        try:
+            query_vectors = await execution_layer.search.run(self._embed_queries, queries)
+            self.retrieval_timings.record("embed_query", time.perf_counter() - embed_started_at, len(queries))
+        except Exception as e:
+            # ベクトル化に失敗してもBM25の検索は行う（ベクトル検索は各クエリで再試行）
+            logger.error("Query embedding error: %s", e)
+            query_vectors = [None] * len(queries)
+
+        results = await asyncio.gather(*(
+            execution_layer.search.run(self._search_one, query, query_vector, k, search_multiplier,
+                                       use_hybrid_search, tags, fusion_strategy)
+            for query, query_vector in zip(queries, query_vectors)
+        ))
+
+        all_docs_with_scores = self._merge_results(results)
+        self.retrieval_timings.record("retrieval", time.perf_counter() - started_at, len(all_docs_with_scores))
+        return all_docs_with_scores
+
+    @staticmethod
+    def _merge_results(results: Iterable[List[Tuple]]) -> List[Tuple]:
+        """クエリごとの検索結果をクエリの順序で統合し、同じ内容のドキュメントを除く"""
+        all_docs_with_scores = []
+        seen_content = set()
+        for docs_with_scores in results:
+            for doc, score in docs_with_scores:
+                content_hash = hash(doc.page_content[:200])
+                if content_hash not in seen_content:
+                    seen_content.add(content_hash)
+                    all_docs_with_scores.append((doc, score))
+        return all_docs_with_scores
+
+    async def _retrieve_with_expansion(self, question: str, k: int, search_multiplier: int,
+                                       use_hybrid_search: bool, enable_query_expansion: bool,
+                                       tags: List[str] = None, fusion_strategy: str = None) -> List[Tuple]:
+        """
+        元の質問の検索とクエリ拡張を並行して実行し、拡張クエリの検索結果を統合
+        拡張クエリの生成と検索が締め切り（QUERY_EXPANSION_TIMEOUT）までに終わらない場合は
+        元の質問の結果だけを返す（拡張クエリの生成は続け、次回以降のためにキャッシュする）
+
+        Args:
+            question: 質問文
+            k: 最終的に使用する関連文書の数
+            search_multiplier: 検索範囲倍率
+            use_hybrid_search: ハイブリッド検索（BM25 + ベクトル）を使用するか
+            enable_query_expansion: クエリ拡張を有効にするか
+            tags: 指定した場合、いずれかのタグを持つチャンクだけを検索
+            fusion_strategy: ハイブリッド検索のスコア統合の方式（"weighted" または "rrf"）
+
+        Returns:
+            (Document, スコア)のタプルのリスト（元の質問の結果、拡張クエリの結果の順）
+        """
+        # 検索結果は生成パラメータやシステムプロンプトに依存しないため、検索条件とインデックスのバージョンで再利用する
+        cache_key = None
+        if RAGConfig.RETRIEVAL_CACHE_ENABLED:
+            cache_key = (
+                self._normalize_question(question), k, search_multiplier, use_hybrid_search,
+                enable_query_expansion, fusion_strategy or RAGConfig.HYBRID_FUSION_STRATEGY,
+                tuple(sorted(set(tags))) if tags else (), self.catalog.index_version,
+            )
+            cached = self._retrieval_cache.get(cache_key)
+            if cached is not None:
+                logger.debug("Retrieval cache hit: %s", question)
+                return list(cached)
+
+        if not enable_query_expansion:
+            results = await self._retrieve([question], k, search_multiplier, use_hybrid_search, tags, fusion_strategy)
+            if cache_key is not None:
+                self._retrieval_cache.set(cache_key, tuple(results))
+            return results
+
+        deadline = time.perf_counter() + RAGConfig.QUERY_EXPANSION_TIMEOUT
+
+        async def retrieve_expanded() -> List[Tuple]:
+            expanded_queries = await self._get_query_expansion(question)
+            if not expanded_queries:
+                return []
+            return await self._retrieve(expanded_queries, k, search_multiplier, use_hybrid_search, tags, fusion_strategy)
+
+        expanded_task = asyncio.ensure_future(retrieve_expanded())
+        try:
+            original_results = await self._retrieve([question], k, search_multiplier, use_hybrid_search,
+                                                    tags, fusion_strategy)
+        except BaseException:
+            expanded_task.cancel()
+            raise
+
+        complete = True
+        try:
+            expanded_results = await asyncio.wait_for(expanded_task, max(deadline - time.perf_counter(), 0))
+        except asyncio.TimeoutError:
+            logger.info("Query expansion did not finish within %.1fs, using original question only",
+                        RAGConfig.QUERY_EXPANSION_TIMEOUT)
+            self.retrieval_timings.record("query_expansion_dropped", RAGConfig.QUERY_EXPANSION_TIMEOUT)
+            expanded_results = []
+            complete = False
+        except Exception as e:
+            logger.warning("Expanded query retrieval failed: %s", e)
+            expanded_results = []
+            complete = False
+
+        results = self._merge_results([original_results, expanded_results])
+        # 拡張クエリの結果を統合できなかった場合は、次回に完全な結果を得られるようキャッシュしない
+        if cache_key is not None and complete:
+            self._retrieval_cache.set(cache_key, tuple(results))
+        return results
 
     async def query_stream(self, question: str, k: int = 5, search_multiplier: int = 10, model_name: str = None, use_rag: bool = True, enable_query_expansion: bool = False,
                           use_hybrid_search: bool = True, chat_history: list = None, system_prompt: str = None, tags: list = None, temperature: float = None, top_p: float = None, repeat_penalty: float = None,
@@ -674,48 +1404,37 @@ class RAGService:
                           mirostat: int = None, mirostat_tau: float = None, mirostat_eta: float = None, tfs_z: float = None,
                           stop: list = None, presence_penalty: float = None, frequency_penalty: float = None, min_p: float = None,
                           repeat_last_n: int = None, num_thread: int = None, num_gpu: int = None, typical_p: float = None,
-                          penalize_newline: bool = None):
+                          penalize_newline: bool = None, fusion_strategy: str = None,
+                          use_semantic_cache: bool = True,
+                          client_id: Optional[str] = None):
         """
         質問に対してRAGで回答を生成（ストリーミング）
 
         Args:
             question: 質問文
-            k: 取得する関連文書の数（デフォルト: 5）
+            k: 取得する関連文書の数（Noneの場合はデフォルト5）
+            search_multiplier: 検索範囲倍率（Noneの場合はデフォルト10）
             model_name: 使用するモデル名（Noneの場合はデフォルトモデルを使用）
             use_rag: RAGを使用するか（Falseの場合は直接LLMに質問）
             enable_query_expansion: クエリ拡張を有効にするか（デフォルト: False）
             use_hybrid_search: ハイブリッド検索（BM25 + ベクトル）を使用するか（デフォルト: True）
+            tags: 指定した場合、いずれかのタグを持つドキュメントだけを検索
+            fusion_strategy: ハイブリッド検索のスコア統合の方式（"weighted" または "rrf"、Noneの場合は設定値）
             temperature: LLMの温度パラメータ（Noneの場合はデフォルト0.3を使用）
             top_p: Nucleus samplingパラメータ（Noneの場合はデフォルト0.9を使用）
             repeat_penalty: 繰り返しペナルティ（Noneの場合はデフォルト1.1を使用）
+            use_semantic_cache: 言い換えた質問にもキャッシュした回答を使うか
+            client_id: 生成スケジューラで公平に扱う単位（指定した場合は生成の順番を待ち、待つ間 "__QUEUE__:{json}" のチャンクを返す。
+                キャッシュした回答は待たずに返す）
 
         Yields:
             回答のチャンク
-        """
-        logger.debug("Stream query received: %s", question)
-        logger.debug("Use RAG: %s", use_rag)
-        logger.debug("Query expansion: %s", enable_query_expansion)
-        logger.debug("Hybrid search: %s", use_hybrid_search)
 
-        # ベクトルストアの内容を確認
-        try:
-            all_docs = self.vectorstore.get()
-            if all_docs and "metadatas" in all_docs:
-                unique_sources = set()
-                for metadata in all_docs["metadatas"]:
-                    if metadata and "source_file" in metadata:
-                        unique_sources.add(metadata["source_file"])
-                logger.debug("Documents in vectorstore: %s", sorted(unique_sources))
-                logger.debug("Total chunks: %s", len(all_docs['metadatas']))
-
-                # test_006のチャンク内容を確認
-                for i, metadata in enumerate(all_docs["metadatas"]):
-                    if metadata and metadata.get("source_file") == "test_006_emc_test.txt":
-                        content = all_docs["documents"][i][:100]  # 最初の100文字
-                        logger.debug("test_006 chunk found: '%s...'", content)
-                        break
-        except Exception as e:
-            logger.debug("Error checking vectorstore: %s", e)
+        Raises:
+            GenerationQueueFullError: 生成の待ち行列に空きがない場合（最初のチャンクを返す前に送出する）
+        """
+        k = k if k is not None else RAGConfig.DEFAULT_DOCUMENT_COUNT
+        search_multiplier = search_multiplier if search_multiplier is not None else RAGConfig.DEFAULT_SEARCH_MULTIPLIER
 
         # パラメータをまとめる
         llm_params = {
@@ -728,6 +1447,55 @@ class RAGService:
             "num_gpu": num_gpu, "typical_p": typical_p, "penalize_newline": penalize_newline
         }
 
+        # 同じ質問・条件の回答がキャッシュにあれば、検索と生成を行わずに参照元情報まで一度に再送する
+        cache_key = self._answer_cache_key(
+            "stream", question, model_name, llm_params, chat_history, tags,
+            k=k, search_multiplier=search_multiplier, use_rag=use_rag, query_expansion=enable_query_expansion,
+            hybrid_search=use_hybrid_search, fusion_strategy=fusion_strategy or RAGConfig.HYBRID_FUSION_STRATEGY,
+            system_prompt=system_prompt
+        )
+        cached, question_vector = await self._get_cached_answer(cache_key, question, use_semantic_cache)
+        if cached is not None:
+            for chunk in cached:
+                yield chunk
+            return
+
+        # 送信したチャンク（参照元情報を含む）を記録し、最後まで送信できた場合だけキャッシュする
+        chunks = []
+        ticket = self._admit_generation(model_name, client_id)
+        try:
+            async for chunk in self._generate_answer_stream(
+                question, k, search_multiplier, model_name, use_rag, enable_query_expansion, use_hybrid_search,
+                chat_history, system_prompt, tags, fusion_strategy, llm_params, ticket
+            ):
+                # 待ち行列の通知はキャッシュしない
+                if not chunk.startswith(QUEUE_MARKER):
+                    chunks.append(chunk)
+                yield chunk
+        finally:
+            if ticket is not None:
+                ticket.release()
+        self._store_answer(cache_key, tuple(chunks), "".join(chunks), question_vector)
+
+    async def _generate_answer_stream(self, question: str, k: int, search_multiplier: int, model_name: str,
+                                      use_rag: bool, enable_query_expansion: bool, use_hybrid_search: bool,
+                                      chat_history: Optional[list], system_prompt: Optional[str],
+                                      tags: Optional[list], fusion_strategy: Optional[str], llm_params: dict,
+                                      generation_ticket: Optional[GenerationTicket] = None):
+        """
+        検索と生成を行って回答をストリーミング（引数は query_stream と同じ、生成パラメータは llm_params にまとめたもの）
+
+        Yields:
+            回答のチャンク（最後に参照元情報）
+        """
+        logger.debug("Stream query received: %s", question)
+        logger.debug("Use RAG: %s", use_rag)
+        logger.debug("Query expansion: %s", enable_query_expansion)
+        logger.debug("Hybrid search: %s", use_hybrid_search)
+
+        # コーパスの統計（カウンタのみ参照し、コレクションは走査しない）
+        logger.debug("Corpus stats: %s", self.catalog.stats())
+
         # RAG OFF の場合は直接LLMに質問
         if not use_rag:
             logger.debug("RAG is disabled. Querying LLM directly without document context.")
@@ -763,75 +1531,15 @@ class RAGService:
 
 回答（例と同じ口調で）:"""
 
-            async for chunk in self._stream_ollama_direct(simple_prompt, model_name, **llm_params):
+            async for chunk in self._stream_ollama_direct(simple_prompt, model_name, generation_ticket, **llm_params):
                 yield chunk
             return
 
-        # クエリ拡張
-        queries = self._expand_query(question) if enable_query_expansion else [question]
-
-        # 検索実行（ハイブリッドまたはベクトル検索）
-        all_docs_with_scores = []
-        seen_content = set()
-
-        if use_hybrid_search:
-            # ハイブリッド検索を使用
-            logger.debug("Using hybrid search (BM25 + Vector)")
-            for query in queries:
-                try:
-                    docs_with_scores = self._hybrid_search(query, k=k * search_multiplier, vector_weight=0.5)
-                    for doc, score in docs_with_scores:
-                        content_hash = hash(doc.page_content[:200])
-                        if content_hash not in seen_content:
-                            seen_content.add(content_hash)
-                            all_docs_with_scores.append((doc, score))
-                except Exception as e:
-                    logger.debug("Hybrid search error with query '{query}': %s", e)
-                    # フォールバック: ベクトル検索のみ
-                    logger.debug("Falling back to vector search only")
-                    docs_with_scores = self.vectorstore.similarity_search_with_score(query, k=k * search_multiplier)
-                    for doc, score in docs_with_scores:
-                        content_hash = hash(doc.page_content[:200])
-                        if content_hash not in seen_content:
-                            seen_content.add(content_hash)
-                            all_docs_with_scores.append((doc, score))
-        else:
-            # 従来のベクトル検索のみ
-            logger.debug("Using vector search only")
-            for query in queries:
-                try:
-                    docs_with_scores = self.vectorstore.similarity_search_with_score(query, k=k * search_multiplier)
-                    for doc, score in docs_with_scores:
-                        content_hash = hash(doc.page_content[:200])
-                        if content_hash not in seen_content:
-                            seen_content.add(content_hash)
-                            all_docs_with_scores.append((doc, score))
-                except Exception as e:
-                    logger.debug("Error searching with query '{query}': %s", e)
-
-        # タグフィルタリング
-        if tags and len(tags) > 0:
-            logger.info("=== Tag Filtering Start ===")
-            logger.info("Requested tags: %s", tags)
-            filtered_docs = []
-            for doc, score in all_docs_with_scores:
-                # タグはカンマ区切り文字列で保存されているため、分割してリストに変換
-                doc_tags_str = doc.metadata.get("tags", "")
-                doc_tags = [t.strip() for t in doc_tags_str.split(",") if t.strip()] if doc_tags_str else []
-
-                source = doc.metadata.get("source_file", "Unknown")
-                logger.info("  Document: %s, Tags: %s", source, doc_tags)
-
-                # ドキュメントが指定されたタグのいずれかを持っているかチェック
-                if any(tag in doc_tags for tag in tags):
-                    logger.info("    -> MATCHED (keeping)")
-                    filtered_docs.append((doc, score))
-                else:
-                    logger.info("    -> NOT MATCHED (filtering out)")
-
-            logger.info("Filtered from %d to %d documents", len(all_docs_with_scores), len(filtered_docs))
-            logger.info("=== Tag Filtering End ===")
-            all_docs_with_scores = filtered_docs
+        # 検索実行（ハイブリッドまたはベクトル検索、タグは検索時に絞り込む）
+        # クエリ拡張は元の質問の検索と並行して実行し、締め切りまでに得られた結果だけを統合する
+        all_docs_with_scores = await self._retrieve_with_expansion(
+            question, k, search_multiplier, use_hybrid_search, enable_query_expansion, tags, fusion_strategy
+        )
 
         # ドキュメントがない場合
         if len(all_docs_with_scores) == 0:
@@ -873,37 +1581,21 @@ class RAGService:
 質問: {question}
 
 回答（例と同じ口調で）:"""
-            async for chunk in self._stream_ollama_direct(simple_prompt, model_name, **llm_params):
+            async for chunk in self._stream_ollama_direct(simple_prompt, model_name, generation_ticket, **llm_params):
                 yield chunk
             return
 
-        # スコアでソートして上位を選択
+        # スコア順に上位k件を選択（全件はソートしない）
         # ハイブリッド検索の場合は降順（高いほど良い）、ベクトル検索の場合は昇順（低いほど良い）
-        if use_hybrid_search:
-            all_docs_with_scores.sort(key=lambda x: x[1], reverse=True)
-        else:
-            all_docs_with_scores.sort(key=lambda x: x[1])
+        with self.retrieval_timings.measure("select_top_k", items=len(all_docs_with_scores)):
+            top_docs_with_scores = select_top_k(all_docs_with_scores, k, descending=use_hybrid_search)
 
-        # デバッグ: 検索結果の上位20件を表示
-        logger.debug("Top 20 search results:")
-        for i, (doc, score) in enumerate(all_docs_with_scores[:20]):
+        # デバッグ: 検索結果の上位を表示
+        logger.debug("Top %d of %d search results:", len(top_docs_with_scores), len(all_docs_with_scores))
+        for i, (doc, score) in enumerate(top_docs_with_scores):
             source = doc.metadata.get("source_file", "Unknown")
             logger.debug("  %d. %s: %.2f", i+1, source, score)
 
-        # test_006がどこにあるか確認
-        for i, (doc, score) in enumerate(all_docs_with_scores):
-            source = doc.metadata.get("source_file", "Unknown")
-            if "test_006" in source:
-                logger.debug(">>> test_006_emc_test.txt found at position %d with score %.2f", i+1, score)
-                break
-        else:
-            logger.debug(">>> test_006_emc_test.txt NOT FOUND in search results!")
-
-        top_docs_with_scores = all_docs_with_scores[:k]
-
-        # コンテキストの構築
-        context = "\n\n".join([doc.page_content for doc, _score in top_docs_with_scores])
-
         # タグフィルター適用時の制約メッセージ
         tag_constraint = ""
         if tags and len(tags) > 0:
@@ -915,10 +1607,27 @@ class RAGService:
 他のタグの情報や一般知識で補完することは絶対に禁止です。
 """
 
-        # システムプロンプトがある場合はプロンプトをカスタマイズ
-        if system_prompt:
-            # カスタムプロンプトテンプレートを使用（キャラクター指示を参照情報の後に配置）
-            custom_prompt_template = f"""以下の参照情報を使って、質問に答えてください。
+        documents = [doc for doc, _score in top_docs_with_scores]
+        generation = {}  # Ollamaの応答のトークン数・所要時間（prompt_eval_count など）
+        if chat_history and RAGConfig.CONVERSATION_MODE_ENABLED:
+            # 会話モード: 会話の間は変わらない部分（指示・キャラクター設定・過去のやり取り）を先頭に置いてChat APIに送り、
+            # Ollamaのプロンプトキャッシュ（KVキャッシュ）で前回までに評価した部分を再利用させる
+            # 質問ごとに変わる参照情報は最後のユーザーメッセージにだけ入れる
+            system_message = PromptTemplates.build_conversation_system_prompt(system_prompt, tag_constraint)
+            history = self._conversation_window(chat_history)
+            packed = await self._pack_context(
+                system_message + PromptTemplates.build_conversation_user_message("", question),
+                documents, model_name, llm_params, [msg["content"] for msg in history]
+            )
+            history = history[len(history) - len(packed.history):]
+            user_message = PromptTemplates.build_conversation_user_message(packed.context, question)
+            stream = self._stream_ollama_chat(system_message, user_message, model_name, generation_ticket,
+                                              history=history, stats=generation, **llm_params)
+        else:
+            # システムプロンプトがある場合はプロンプトをカスタマイズ
+            if system_prompt:
+                # カスタムプロンプトテンプレートを使用（キャラクター指示を参照情報の後に配置）
+                custom_prompt_template = f"""以下の参照情報を使って、質問に答えてください。
 {tag_constraint}
 参照情報:
 {{context}}
@@ -930,11 +1639,11 @@ class RAGService:
 上記の指示に従って回答してください。
 
 回答:"""
-            prompt_text = custom_prompt_template.format(context=context, question=question)
-        else:
-            # デフォルトのプロンプトを使用
-            if tag_constraint:
-                default_prompt_with_constraint = f"""以下の参照情報を使って、質問に答えてください。
+                template = custom_prompt_template
+            else:
+                # デフォルトのプロンプトを使用
+                if tag_constraint:
+                    default_prompt_with_constraint = f"""以下の参照情報を使って、質問に答えてください。
 {tag_constraint}
 参照情報:
 {{context}}
@@ -942,16 +1651,25 @@ class RAGService:
 質問: {{question}}
 
 回答:"""
-                prompt_text = default_prompt_with_constraint.format(context=context, question=question)
-            else:
-                prompt_text = self.prompt.format(context=context, question=question)
+                    template = default_prompt_with_constraint
+                else:
+                    template = self.prompt_template
+
+            # コンテキストの構築（コンテキスト長に収まるよう、順位の低いチャンクから減らす）
+            packed = await self._pack_context(template.format(context="", question=question), documents,
+                                              model_name, llm_params)
+            prompt_text = template.format(context=packed.context, question=question)
+            logger.info(f"Final prompt being sent to LLM:\n{prompt_text[:500]}...")
+            stream = self._stream_ollama_direct(prompt_text, model_name, generation_ticket, stats=generation,
+                                                **llm_params)
 
-        logger.info(f"Final prompt being sent to LLM:\n{prompt_text[:500]}...")
-        async for chunk in self._stream_ollama_direct(prompt_text, model_name, **llm_params):
+        # 参照元はプロンプトに入れたチャンクだけにする
+        top_docs_with_scores = top_docs_with_scores[:len(packed.documents)]
+
+        async for chunk in stream:
             yield chunk
 
         # 参照元の抽出とスコア情報の作成（ストリーミング終了後に送信）
-        import json
         sources = []
         source_scores = []
 
@@ -1000,112 +1718,94 @@ class RAGService:
             "source_scores": source_scores,
             "quality_score": quality_score,  # 品質スコア追加（0-100）
             "document_count": len(top_docs_with_scores),  # ドキュメント数
-            "max_similarity": round(source_scores[0]["score"], 3) if source_scores else 0  # 最高類似度
+            "max_similarity": round(source_scores[0]["score"], 3) if source_scores else 0,  # 最高類似度
+            "prompt_tokens": packed.prompt_tokens,  # プロンプトのトークン数の見積もり
+            "context_tokens": packed.context_tokens,  # 参照ドキュメントのトークン数の見積もり
+            "prompt_eval_count": generation.get("prompt_eval_count"),  # 実際に評価したトークン数（KVキャッシュを再利用した分は含まない）
+            "prompt_eval_ms": round(generation["prompt_eval_duration"] / 1e6, 1) if "prompt_eval_duration" in generation else None
         }
         yield f"\n__SOURCES__:{json.dumps(source_data, ensure_ascii=False)}"
 
-    def list_tags(self) -> List[str]:
+    def list_tags(self, query: str = None, limit: int = None, offset: int = 0) -> List[str]:
         """
         登録されているタグの一覧を取得
 
+        Args:
+            query: タグの部分一致で絞り込む文字列
+            limit: 取得する件数（Noneの場合はすべて）
+            offset: 読み飛ばす件数
+
         Returns:
             タグのリスト（重複なし、ソート済み）
         """
         try:
-            collection = self.vectorstore.get()
-
-            if not collection or "metadatas" not in collection or not collection["metadatas"]:
-                return []
-
-            tags_set = set()
-            for metadata in collection["metadatas"]:
-                if metadata and "tags" in metadata:
-                    # タグはカンマ区切り文字列で保存されているため、分割して追加
-                    tags_str = metadata["tags"]
-                    tag_list = [t.strip() for t in tags_str.split(",") if t.strip()]
-                    for tag in tag_list:
-                        tags_set.add(tag)
-
-            logger.debug("Found tags: %s", list(tags_set))
-            return sorted(list(tags_set))
+            tags = self.catalog.list_tags(query=query, limit=limit, offset=offset)
+            logger.debug("Found tags: %s", tags)
+            return tags
         except Exception as e:
             logger.debug("Error in list_tags: %s", e)
             return []
 
-    def list_documents(self) -> List[str]:
+    def list_documents(self, tags: List[str] = None, query: str = None,
+                       limit: int = None, offset: int = 0) -> List[str]:
         """
         登録されているドキュメントの一覧を取得
 
+        Args:
+            tags: いずれかのタグを持つドキュメントに絞り込む
+            query: ファイル名の部分一致で絞り込む文字列
+            limit: 取得する件数（Noneの場合はすべて）
+            offset: 読み飛ばす件数
+
         Returns:
-            ドキュメント名のリスト
+            ドキュメント名のリスト（ソート済み）
         """
         try:
-            collection = self.vectorstore.get()
-            logger.debug("Collection data: %s", collection)  # デバッグ用
-
-            if not collection or "metadatas" not in collection or not collection["metadatas"]:
-                logger.debug("No documents in collection")
-                return []
-
-            sources = set()
-            for metadata in collection["metadatas"]:
-                if metadata and "source_file" in metadata:
-                    sources.add(metadata["source_file"])
-
-            logger.debug("Found documents: %s", list(sources))
-            return sorted(list(sources))
+            docs = self.catalog.list_documents(tags=tags, query=query, limit=limit, offset=offset)
+            sources = [doc["filename"] for doc in docs]
+            logger.debug("Found documents: %s", sources)
+            return sources
         except Exception as e:
             logger.debug("Error in list_documents: %s", e)
             return []
 
-    def list_documents_with_tags(self) -> List[dict]:
+    def list_documents_with_tags(self, tags: List[str] = None, query: str = None,
+                                 limit: int = None, offset: int = 0) -> List[dict]:
         """
         登録されているドキュメントとそのタグの一覧を取得
 
+        Args:
+            tags: いずれかのタグを持つドキュメントに絞り込む
+            query: ファイル名の部分一致で絞り込む文字列
+            limit: 取得する件数（Noneの場合はすべて）
+            offset: 読み飛ばす件数
+
         Returns:
-            ドキュメント情報のリスト（ファイル名とタグを含む）
+            ドキュメント情報のリスト（ファイル名、タグ、チャンク数、ページ数、サイズ、登録日時を含む）
         """
         try:
-            collection = self.vectorstore.get()
-
-            if not collection or "metadatas" not in collection or not collection["metadatas"]:
-                logger.debug("No documents in collection")
-                return []
-
-            # ファイル名ごとにタグを集約
-            docs_dict = {}
-            for metadata in collection["metadatas"]:
-                if metadata and "source_file" in metadata:
-                    filename = metadata["source_file"]
-                    tags_str = metadata.get("tags", "")
-                    tags = [t.strip() for t in tags_str.split(",") if t.strip()] if tags_str else []
-
-                    if filename not in docs_dict:
-                        docs_dict[filename] = set()
-
-                    # タグを追加（重複を避けるためset使用）
-                    for tag in tags:
-                        docs_dict[filename].add(tag)
-
-            # 辞書をリストに変換
-            result = [
-                {
-                    "filename": filename,
-                    "tags": sorted(list(tags))
-                }
-                for filename, tags in docs_dict.items()
-            ]
-
-            # ファイル名でソート
-            result.sort(key=lambda x: x["filename"])
-
-            logger.info("Documents with tags: %s", result)
+            result = self.catalog.list_documents(tags=tags, query=query, limit=limit, offset=offset)
+            logger.debug("Documents with tags: %s", result)
             return result
 
         except Exception as e:
             logger.error("Error in list_documents_with_tags: %s", e)
             return []
 
+    def count_documents(self, tags: List[str] = None, query: str = None) -> int:
+        """
+        条件に一致するドキュメント数を取得（ページングの総件数用）
+
+        Args:
+            tags: いずれかのタグを持つドキュメントに絞り込む
+            query: ファイル名の部分一致で絞り込む文字列
+        """
+        try:
+            return self.catalog.count_documents(tags=tags, query=query)
+        except Exception as e:
+            logger.error("Error in count_documents: %s", e)
+            return 0
+
     def delete_document(self, filename: str) -> bool:
         """
         特定のファイルをベクトルストアから削除
@@ -1116,40 +1816,42 @@ class RAGService:
         Returns:
             削除成功したかどうか
         """
-        try:
-            logger.debug("Deleting document: %s", filename)
-            collection = self.vectorstore._collection
-
-            # ファイル名に一致するIDを取得
-            all_data = collection.get()
-            ids_to_delete = []
-
-            for i, metadata in enumerate(all_data['metadatas']):
-                if metadata and metadata.get('source_file') == filename:
-                    ids_to_delete.append(all_data['ids'][i])
-
-            if ids_to_delete:
-                collection.delete(ids=ids_to_delete)
-                logger.debug("Deleted %d chunks from %s", len(ids_to_delete), filename)
-
-                # 永続化
-                try:
-                    self.vectorstore.persist()
-                    logger.debug("Document deletion persisted successfully")
-                except Exception as e:
-                    logger.error("Error persisting document deletion: %s", e)
+        # 取り込みの途中で削除が重ならないよう、ドキュメントの書き込みは1件ずつ行う
+        with self._write_lock:
+            try:
+                logger.debug("Deleting document: %s", filename)
+                collection = self.vectorstore._collection
+
+                # ファイル名に一致するIDをカタログから取得
+                ids_to_delete = self.catalog.chunk_ids(filename)
+
+                if ids_to_delete:
+                    collection.delete(ids=ids_to_delete)
+                    self.catalog.remove_document(filename)
+                    logger.debug("Deleted %d chunks from %s", len(ids_to_delete), filename)
+
+                    # 永続化
+                    try:
+                        self.vectorstore.persist()
+                        logger.debug("Document deletion persisted successfully")
+                    except Exception as e:
+                        logger.error("Error persisting document deletion: %s", e)
+
+                    # 削除したチャンクだけをBM25インデックスから除外
+                    with self._bm25_lock:
+                        self.bm25_index.remove(ids_to_delete)
+                        self._save_bm25_index_if_merged_locked()
+                    # BM25から除外し終えてからキャッシュを無効化する
+                    self.catalog.bump_index_version()
+                    return True
+                else:
+                    logger.debug("No chunks found for %s", filename)
+                    return False
 
-                # BM25インデックスを再構築
-                self._rebuild_bm25_index()
-                return True
-            else:
-                logger.debug("No chunks found for %s", filename)
+            except Exception as e:
+                logger.debug("Error deleting document: %s", e)
                 return False
 
-        except Exception as e:
-            logger.debug("Error deleting document: %s", e)
-            return False
-
     def get_document_content(self, filename: str) -> str:
         """
         ドキュメントの内容を取得（プレビュー用）
@@ -1162,27 +1864,22 @@ class RAGService:
         """
         try:
             logger.debug("Getting content for document: %s", filename)
-            collection = self.vectorstore._collection
-            all_data = collection.get()
 
-            # 指定されたファイルのチャンクを全て取得
-            chunks = []
-            for i, metadata in enumerate(all_data['metadatas']):
-                if metadata and metadata.get('source_file') == filename:
-                    chunks.append({
-                        'text': all_data['documents'][i],
-                        'page': metadata.get('page', 0)
-                    })
+            # 指定されたファイルのチャンクだけを取得（カタログ上でページ番号順に並んでいる）
+            chunk_ids = self.catalog.chunk_ids(filename)
+            if not chunk_ids:
+                logger.debug("No chunks found for %s", filename)
+                return None
 
+            data = self.vectorstore._collection.get(ids=chunk_ids, include=["documents"])
+            texts = dict(zip(data['ids'], data['documents']))
+            chunks = [texts[chunk_id] for chunk_id in chunk_ids if chunk_id in texts]
             if not chunks:
                 logger.debug("No chunks found for %s", filename)
                 return None
 
-            # ページ番号でソート（PDFの場合）
-            chunks.sort(key=lambda x: x.get('page', 0))
-
             # 全チャンクを結合
-            content = '\n\n---\n\n'.join([chunk['text'] for chunk in chunks])
+            content = '\n\n---\n\n'.join(chunks)
             logger.debug("Retrieved %d chunks for %s", len(chunks), filename)
 
             return content
@@ -1199,72 +1896,90 @@ class RAGService:
         import time
         import gc
 
-        logger.debug("Clearing all documents...")
+        # 取り込み中のスレッドが閉じたカタログや削除中のディレクトリを使わないよう、書き込みが終わるのを待つ
+        with self._write_lock:
+            logger.debug("Clearing all documents...")
 
-        try:
-            # 既存のベクトルストアへの参照を解放
-            if self.vectorstore is not None:
-                try:
-                    # コレクションを明示的にクリア
-                    collection = self.vectorstore._collection
-                    if collection:
-                        # すべてのIDを取得して削除
-                        all_ids = collection.get()['ids']
-                        if all_ids:
-                            collection.delete(ids=all_ids)
-                            logger.debug("Deleted %s items from collection", len(all_ids))
-                except Exception as e:
-                    logger.debug("Error clearing collection: %s", e)
+            # カタログは作り直すが、キャッシュ済みの結果が再利用されないようインデックスのバージョンは引き継ぐ
+            index_version = self.catalog.index_version
 
-                self.vectorstore = None
-                gc.collect()  # ガベージコレクション実行
+            try:
+                # 既存のベクトルストアへの参照を解放
+                if self.vectorstore is not None:
+                    try:
+                        # コレクションを明示的にクリア
+                        collection = self.vectorstore._collection
+                        if collection:
+                            # すべてのIDを取得して削除
+                            all_ids = collection.get()['ids']
+                            if all_ids:
+                                collection.delete(ids=all_ids)
+                                logger.debug("Deleted %s items from collection", len(all_ids))
+                    except Exception as e:
+                        logger.debug("Error clearing collection: %s", e)
+
+                    self.vectorstore = None
+                    gc.collect()  # ガベージコレクション実行
+
+                # カタログのSQLiteファイルもディレクトリごと削除されるため、先に閉じておく
+                self.catalog.close()
+
+                # ディレクトリが存在する場合は削除
+                if os.path.exists(self.persist_directory):
+                    logger.debug("Removing directory: %s", self.persist_directory)
+                    try:
+                        shutil.rmtree(self.persist_directory)
+                        logger.debug("Directory removed successfully")
+                    except Exception as e:
+                        logger.debug("Error removing directory: %s", e)
+                    # ディレクトリ削除後、少し待機
+                    time.sleep(0.5)
+
+                # 新しいベクトルストアを作成
+                logger.debug("Creating new vector store...")
+                self.vectorstore = Chroma(
+                    persist_directory=self.persist_directory,
+                    embedding_function=self.embeddings,
+                    collection_metadata=self._embedding_metadata()
+                )
 
-            # ディレクトリが存在する場合は削除
-            if os.path.exists(self.persist_directory):
-                logger.debug("Removing directory: %s", self.persist_directory)
+                # 永続化
                 try:
-                    shutil.rmtree(self.persist_directory)
-                    logger.debug("Directory removed successfully")
+                    self.vectorstore.persist()
+                    logger.debug("New empty vector store persisted successfully")
                 except Exception as e:
-                    logger.debug("Error removing directory: %s", e)
-                # ディレクトリ削除後、少し待機
-                time.sleep(0.5)
+                    logger.error("Error persisting new vector store: %s", e)
 
-            # 新しいベクトルストアを作成
-            logger.debug("Creating new vector store...")
-            self.vectorstore = Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=self.embeddings
-            )
-
-            # 永続化
-            try:
-                self.vectorstore.persist()
-                logger.debug("New empty vector store persisted successfully")
-            except Exception as e:
-                logger.error("Error persisting new vector store: %s", e)
-
-            # 空であることを確認
-            try:
-                count = len(self.vectorstore.get()['ids'])
-                logger.debug("New vector store created with %s documents", count)
-            except:
-                logger.debug("New vector store created (empty)")
+                # 空であることを確認
+                try:
+                    count = len(self.vectorstore.get()['ids'])
+                    logger.debug("New vector store created with %s documents", count)
+                except:
+                    logger.debug("New vector store created (empty)")
 
-            # BM25インデックスも再構築
-            self._rebuild_bm25_index()
+                # BM25インデックスとカタログも空にする
+                with self._bm25_lock:
+                    self.bm25_index.clear()
+                    self._save_bm25_index_locked()
+                self.catalog = DocumentCatalog(self.catalog_path)
+                self.catalog.advance_index_version(index_version)
+                self._migrate_tag_metadata()
 
-            logger.debug("Documents cleared successfully")
+                logger.debug("Documents cleared successfully")
 
-        except Exception as e:
-            logger.debug("Error clearing documents: %s", e)
-            import traceback
-            traceback.print_exc()
-            # エラーが発生しても新しいベクトルストアを作成
-            self.vectorstore = Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=self.embeddings
-            )
+            except Exception as e:
+                logger.debug("Error clearing documents: %s", e)
+                import traceback
+                traceback.print_exc()
+                # エラーが発生しても新しいベクトルストアを作成
+                self.vectorstore = Chroma(
+                    persist_directory=self.persist_directory,
+                    embedding_function=self.embeddings,
+                    collection_metadata=self._embedding_metadata()
+                )
+                self.catalog = DocumentCatalog(self.catalog_path)
+                self.catalog.advance_index_version(index_version)
+                self._load_document_catalog()
 
     @staticmethod
     def _get_available_models_static() -> List[str]:
@@ -1274,42 +1989,58 @@ class RAGService:
         Returns:
             モデル名のリスト
         """
-        try:
-            import requests
-            response = requests.get("http://localhost:11434/api/tags", timeout=2)
-            if response.status_code == 200:
-                data = response.json()
-                models = [model["name"] for model in data.get("models", [])]
-                return models
-            else:
-                return []
-        except Exception as e:
-            logger.debug("Exception fetching models: %s", e)
-            return []
+        return ollama_client.list_models()
 
-    def check_ollama_connection(self) -> bool:
+    async def check_ollama_connection(self) -> bool:
         """
         Ollamaへの接続をチェック
 
         Returns:
             接続が成功した場合True
         """
-        try:
-            import requests
-            # Ollamaサーバーが起動しているかを確認（モデルの有無に関わらず）
-            response = requests.get("http://localhost:11434/api/tags", timeout=2)
-            return response.status_code == 200
-        except Exception as e:
-            logger.debug("Ollama connection check failed: %s", e)
-            return False
+        # Ollamaサーバーが起動しているかを確認（モデルの有無に関わらず）
+        return await ollama_client.is_available()
+
+    def get_stats(self) -> dict:
+        """
+        コーパスの統計を取得（追加・削除時に更新しているカウンタを返すだけで、コレクションは走査しない）
+
+        Returns:
+            ファイル数、チャンク数、タグ数、インデックスのバージョン、BM25インデックスのチャンク数
+        """
+        stats = self.catalog.stats()
+        stats["bm25_chunks"] = len(self.bm25_index)
+        return stats
+
+    def get_metrics(self) -> dict:
+        """
+        埋め込み・キャッシュなどのメトリクスを取得
+
+        Returns:
+            メトリクスの辞書
+        """
+        return {
+            "ollama_client": ollama_client.stats(),
+            "embeddings": self.embeddings.stats(),
+            "query_embedding_cache": self._query_embedding_cache.stats(),
+            "query_expansion_cache": self._query_expansion_cache.stats(),
+            "retrieval_cache": self._retrieval_cache.stats(),
+            "answer_cache": self._answer_cache.stats(),
+            "semantic_answer_cache": self._semantic_answer_cache.stats(),
+            "bm25": self.bm25_index.stats(),
+            "document_catalog": self.catalog.stats(),
+            "retrieval_timings": self.retrieval_timings.stats(),
+            "context_packing": self.context_packer.stats(),
+            "generation_timings": self.generation_timings.stats(),
+        }
 
-    def get_available_models(self) -> List[str]:
+    async def get_available_models(self) -> List[str]:
         """
         利用可能なOllamaモデルの一覧を取得
 
         Returns:
             モデル名のリスト
         """
-        models = self._get_available_models_static()
+        models = await ollama_client.alist_models()
         logger.debug("Found %d models: %s", len(models), models)
         return models
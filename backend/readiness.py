@@ -0,0 +1,89 @@
+"""
+起動状態の管理 - バックグラウンドで初期化するコンポーネントごとの準備状況を記録する
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+PENDING = "pending"
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+
+
+class Readiness:
+    """コンポーネントごとの状態（pending -> starting -> ready / failed）を記録するスレッドセーフなクラス"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._components: Dict[str, dict] = {}
+
+    def register(self, *names: str) -> None:
+        """準備が必要なコンポーネントを登録（すべて ready になるまで全体は準備中）"""
+        with self._lock:
+            for name in names:
+                self._components.setdefault(name, {"status": PENDING, "started_at": None,
+                                                   "elapsed_sec": None, "error": None})
+
+    def _set(self, name: str, status: str, error: Optional[str] = None) -> None:
+        with self._lock:
+            entry = self._components.setdefault(name, {"status": PENDING, "started_at": None,
+                                                       "elapsed_sec": None, "error": None})
+            now = time.perf_counter()
+            if status == STARTING:
+                entry["started_at"] = now
+            elif entry["started_at"] is not None:
+                entry["elapsed_sec"] = round(now - entry["started_at"], 3)
+            entry["status"] = status
+            entry["error"] = error
+
+    def starting(self, name: str) -> None:
+        self._set(name, STARTING)
+
+    def ready(self, name: str) -> None:
+        self._set(name, READY)
+
+    def failed(self, name: str, error: Exception) -> None:
+        self._set(name, FAILED, str(error))
+
+    @contextmanager
+    def track(self, name: str) -> Iterator[None]:
+        """
+        ブロックの実行中を starting、正常に終わったら ready、例外の場合は failed として記録（例外はそのまま送出）
+
+        Args:
+            name: コンポーネントの名前
+        """
+        self.starting(name)
+        try:
+            yield
+        except Exception as e:
+            self.failed(name, e)
+            raise
+        self.ready(name)
+        logger.info("Component %s ready", name)
+
+    def is_ready(self, name: str = None) -> bool:
+        """指定したコンポーネント（省略した場合はすべて）が ready か"""
+        with self._lock:
+            if name is not None:
+                entry = self._components.get(name)
+                return entry is not None and entry["status"] == READY
+            return all(entry["status"] == READY for entry in self._components.values())
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """コンポーネントごとの状態を取得"""
+        with self._lock:
+            return {
+                name: {"status": entry["status"], "elapsed_sec": entry["elapsed_sec"], "error": entry["error"]}
+                for name, entry in self._components.items()
+            }
+
+
+# アプリケーション全体で共有する起動状態
+readiness = Readiness()
@@ -0,0 +1,145 @@
+"""
+意味的な回答キャッシュ - 言い換えた質問にも、質問ベクトルのコサイン類似度で過去の回答を再利用する
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    質問ベクトルのインメモリインデックス（サイズ上限（LRU）と有効期限（TTL）付き）
+    ベクトルは正規化して固定長の行列に保持し、同じスコープのエントリだけと内積で比較する
+    """
+
+    def __init__(self, max_entries: int, threshold: float, ttl: Optional[float] = None):
+        """
+        Args:
+            max_entries: 保持するエントリ数の上限
+            threshold: ヒットとみなすコサイン類似度の下限
+            ttl: 有効期限（秒）。Noneの場合は期限なし
+        """
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self._vectors: Optional[np.ndarray] = None  # 最初の登録時に次元数に合わせて確保
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        # スロット -> (スコープ, 値, 有効期限)、最近使用したものが末尾
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        # スコープ -> スロットのリスト
+        self._scopes: Dict[Hashable, List[int]] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def _normalize(vector) -> Optional[np.ndarray]:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def _remove(self, slot: int) -> None:
+        scope, _value, _expires_at = self._entries.pop(slot)
+        slots = self._scopes[scope]
+        slots.remove(slot)
+        if not slots:
+            del self._scopes[scope]
+        self._free_slots.append(slot)
+
+    def get(self, scope: Hashable, vector) -> Optional[Tuple[Any, float]]:
+        """
+        同じスコープで最も類似した質問の値を取得
+
+        Args:
+            scope: スコープ（モデル・タグ・インデックスのバージョンなど、質問以外の条件）
+            vector: 質問のベクトル
+
+        Returns:
+            (値, コサイン類似度) のタプル（閾値以上のものがない場合はNone）
+        """
+        query = self._normalize(vector)
+        with self._lock:
+            slots = self._scopes.get(scope)
+            if query is None or not slots or query.shape[0] != self._vectors.shape[1]:
+                self._misses += 1
+                return None
+
+            now = time.monotonic()
+            for slot in [slot for slot in slots if self._entries[slot][2] is not None and self._entries[slot][2] <= now]:
+                self._remove(slot)
+            slots = self._scopes.get(scope)
+            if not slots:
+                self._misses += 1
+                return None
+
+            similarities = self._vectors[slots] @ query
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self._misses += 1
+                return None
+            slot = slots[best]
+            self._entries.move_to_end(slot)
+            self._hits += 1
+            return self._entries[slot][1], similarity
+
+    def set(self, scope: Hashable, vector, value: Any) -> None:
+        """
+        値を保存（上限を超えた場合は最も古いものから削除）
+
+        Args:
+            scope: スコープ
+            vector: 質問のベクトル
+            value: 値
+        """
+        vector = self._normalize(vector)
+        if vector is None:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            elif vector.shape[0] != self._vectors.shape[1]:
+                # 埋め込みモデルが変わった場合は古いベクトルと比較できないため作り直す
+                self._clear()
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            if not self._free_slots:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+            slot = self._free_slots.pop()
+            self._vectors[slot] = vector
+            self._entries[slot] = (scope, value, expires_at)
+            self._scopes.setdefault(scope, []).append(slot)
+
+    def _clear(self) -> None:
+        self._entries.clear()
+        self._scopes.clear()
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+    def clear(self) -> None:
+        """すべてのエントリを削除"""
+        with self._lock:
+            self._clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """キャッシュのメトリクスを取得"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+                "scopes": len(self._scopes),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0,
+                "evictions": self._evictions,
+            }
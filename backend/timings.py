@@ -0,0 +1,64 @@
+"""
+処理時間の計測 - 検索パイプラインの段階ごとの所要時間を集計する
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+
+class StageTimings:
+    """段階ごとの所要時間（件数・平均・最大・直近）を集計するスレッドセーフなクラス"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, dict] = {}
+
+    @contextmanager
+    def measure(self, stage: str, items: int = None) -> Iterator[None]:
+        """
+        ブロックの所要時間を記録
+
+        Args:
+            stage: 段階の名前
+            items: 処理した件数（候補数など）
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started_at, items)
+
+    def record(self, stage: str, seconds: float, items: int = None) -> None:
+        """
+        所要時間を記録
+
+        Args:
+            stage: 段階の名前
+            seconds: 所要時間（秒）
+            items: 処理した件数（候補数など）
+        """
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0, "items": 0}
+            entry["count"] += 1
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+            entry["last"] = seconds
+            if items is not None:
+                entry["items"] += items
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """段階ごとのメトリクスを取得"""
+        with self._lock:
+            return {
+                stage: {
+                    "count": entry["count"],
+                    "avg_ms": round(entry["total"] / entry["count"] * 1000, 3),
+                    "max_ms": round(entry["max"] * 1000, 3),
+                    "last_ms": round(entry["last"] * 1000, 3),
+                    "avg_items": round(entry["items"] / entry["count"], 1),
+                }
+                for stage, entry in self._stages.items()
+            }
@@ -0,0 +1,104 @@
+"""
+アップロード保存 - アップロードされたファイルをチャンク単位でディスクに書き込む
+"""
+import hashlib
+import os
+import uuid
+from typing import List
+
+from fastapi import UploadFile
+
+from config import RAGConfig
+from exceptions import FileTooLargeError
+from executor import execution_layer
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+async def save_upload_stream(upload: UploadFile, directory: str = None,
+                             max_size: int = None, chunk_size: int = None) -> dict:
+    """
+    アップロードファイルを一時ファイルへ逐次書き込み、完了後に "<保存先>/<SHA-256>/<ファイル名>" へ移動する
+    ファイル全体をメモリに読み込まず、書き込みと同時にサイズ上限の確認とハッシュ計算を行う
+    （内容ごとに保存先を分けるため、取り込み待ちのファイルが同じ名前の別の内容で上書きされない）
+
+    Args:
+        upload: アップロードファイル
+        directory: 保存先ディレクトリ
+        max_size: ファイルサイズの上限（バイト）
+        chunk_size: 1回に読み書きするサイズ（バイト）
+
+    Returns:
+        保存したファイルの情報（filename: 元のファイル名, path, size, sha256,
+        created: 新しく保存したか。同じ名前・内容のファイルが保存済みの場合はFalse）
+
+    Raises:
+        FileTooLargeError: ファイルサイズが上限を超えた場合
+    """
+    directory = directory or RAGConfig.UPLOAD_DIRECTORY
+    max_size = max_size or RAGConfig.MAX_FILE_SIZE
+    chunk_size = chunk_size or RAGConfig.UPLOAD_CHUNK_SIZE
+
+    # パス区切りを含むファイル名でディレクトリ外に書き込まれないようにする
+    filename = os.path.basename(upload.filename)
+    os.makedirs(directory, exist_ok=True)
+    temp_path = os.path.join(directory, f".{filename}.{uuid.uuid4().hex}.part")
+
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(temp_path, "wb") as f:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    # 上限を超えた時点で中断
+                    raise FileTooLargeError(filename, max_size)
+                hasher.update(chunk)
+                await execution_layer.io.run(f.write, chunk)
+            await execution_layer.io.run(f.flush)
+            await execution_layer.io.run(os.fsync, f.fileno())
+
+        # 書き込み完了後にアトミックに移動（同じ名前・内容のファイルが保存済みの場合はそれを使う）
+        sha256 = hasher.hexdigest()
+        final_path = os.path.join(directory, sha256, filename)
+        created = not os.path.exists(final_path)
+        if created:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(temp_path, final_path)
+        else:
+            os.remove(temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    logger.debug("Saved upload %s (%d bytes)", filename, size)
+    return {
+        "filename": filename,
+        "path": final_path,
+        "size": size,
+        "sha256": sha256,
+        "created": created,
+    }
+
+
+def discard_uploads(saved_files: List[dict]) -> None:
+    """
+    取り込まなかったアップロードを削除する（このリクエストで新しく保存したファイルのみ）
+
+    Args:
+        saved_files: save_upload_stream の戻り値のリスト
+    """
+    for saved in saved_files:
+        if not saved.get("created"):
+            continue
+        try:
+            os.remove(saved["path"])
+            os.rmdir(os.path.dirname(saved["path"]))
+        except OSError:
+            # 同じ内容の別のファイル名が残っている場合など
+            pass
@@ -1,6 +1,6 @@
 // FastAPI APIとの通信モジュール
 
-import { API_BASE_URL } from '$lib/config/constants';
+import { API_BASE_URL, ERROR_MESSAGES } from '$lib/config/constants';
 
 export interface SourceInfo {
 	source: string;
@@ -79,6 +79,14 @@ export async function sendQuestionStream(
 		signal
 	});
 
+	// 生成の待ち行列に空きがない場合（Retry-After に再試行までの目安の秒数）
+	if (response.status === 429) {
+		const retryAfter = response.headers.get('Retry-After');
+		throw new Error(
+			retryAfter ? `${ERROR_MESSAGES.SERVER_BUSY}（約${retryAfter}秒後）` : ERROR_MESSAGES.SERVER_BUSY
+		);
+	}
+
 	if (!response.ok) {
 		throw new Error(`API Error: ${response.status} ${response.statusText}`);
 	}
@@ -97,13 +105,15 @@ export async function sendQuestionStream(
  * @param onSources ソース情報を受信したときのコールバック
  * @param onComplete 完了時のコールバック
  * @param onSpeed 速度情報更新時のコールバック
+ * @param onQueue 生成の順番待ちの間、待ち行列での順番が変わったときのコールバック
  */
 export async function processStream(
 	stream: ReadableStream<Uint8Array>,
 	onChunk: (chunk: string) => void,
 	onComplete?: () => void,
 	onSources?: (sources: SourceInfo[], qualityScore: number) => void,
-	onSpeed?: (responseTime: number, generationTime: number, speed: number) => void
+	onSpeed?: (responseTime: number, generationTime: number, speed: number) => void,
+	onQueue?: (position: number) => void
 ): Promise<void> {
 	const reader = stream.getReader();
 	const decoder = new TextDecoder();
@@ -135,8 +145,16 @@ export async function processStream(
 				if (line.startsWith('data: ')) {
 					const data = line.slice(6); // "data: " を削除
 					if (data.trim()) {
-						// ソース情報のマーカーをチェック
-						if (data.includes('__SOURCES__')) {
+						// 順番待ちのマーカーをチェック（__QUEUE__:{json}、回答には含めない）
+						if (data.startsWith('__QUEUE__:')) {
+							try {
+								const queueData = JSON.parse(data.slice('__QUEUE__:'.length));
+								onQueue?.(queueData.position);
+							} catch (error) {
+								console.error('Failed to parse queue position:', error);
+							}
+						} else if (data.includes('__SOURCES__')) {
+							// ソース情報のマーカーをチェック
 							// ソース情報をパース
 							try {
 								// 新しい形式: __SOURCES__:{json}
@@ -5,39 +5,72 @@ import { API_BASE_URL } from '$lib/config/constants';
 export interface Document {
 	filename: string;
 	tags: string[];
+	chunk_count?: number;
+	page_count?: number | null;
+	size?: number | null;
+	ingested_at?: number | null;
 }
 
 export interface DocumentStats {
 	total_documents: number;
 	total_chunks: number;
-	tags: string[];
+	total_tags: number;
+	index_version: number;
 }
 
 /**
  * ドキュメント統計を取得
  */
 export async function getDocumentStats(): Promise<DocumentStats> {
-	const response = await fetch(`${API_BASE_URL}/documents/stats`);
+	const response = await fetch(`${API_BASE_URL}/stats`);
 	if (!response.ok) {
 		throw new Error(`API Error: ${response.status} ${response.statusText}`);
 	}
-	return response.json();
+	const data = await response.json();
+	return {
+		total_documents: data.documents,
+		total_chunks: data.chunks,
+		total_tags: data.tags,
+		index_version: data.index_version
+	};
+}
+
+export interface DocumentPage {
+	documents: Document[];
+	total: number;
 }
 
 /**
- * ドキュメント一覧を取得
+ * ドキュメント一覧を1ページ分取得
  */
 export async function getDocuments(
 	limit: number = 100,
 	offset: number = 0,
 	tags?: string[]
-): Promise<Document[]> {
-	const response = await fetch(`${API_BASE_URL}/documents/details`);
+): Promise<DocumentPage> {
+	const params = new URLSearchParams({ limit: String(limit), offset: String(offset) });
+	tags?.forEach((tag) => params.append('tags', tag));
+
+	const response = await fetch(`${API_BASE_URL}/documents/details?${params}`);
 	if (!response.ok) {
 		throw new Error(`API Error: ${response.status} ${response.statusText}`);
 	}
 	const data = await response.json();
-	return data.documents || [];
+	return { documents: data.documents || [], total: data.total ?? 0 };
+}
+
+/**
+ * ドキュメント一覧をすべて取得（total に達するまでページ単位で取得）
+ */
+export async function getAllDocuments(tags?: string[], pageSize: number = 100): Promise<Document[]> {
+	const documents: Document[] = [];
+	while (true) {
+		const page = await getDocuments(pageSize, documents.length, tags);
+		documents.push(...page.documents);
+		if (page.documents.length === 0 || documents.length >= page.total) {
+			return documents;
+		}
+	}
 }
 
 /**
@@ -61,13 +94,37 @@ export async function addDocument(
 	return response.json();
 }
 
+export interface IngestionFileStatus {
+	filename: string;
+	stage: string;
+	chunks: number;
+	elapsed_sec: number;
+	chunks_per_sec: number;
+	error: string | null;
+}
+
+export interface IngestionJob {
+	job_id: string;
+	status: 'queued' | 'running' | 'completed' | 'failed' | 'partial';
+	tags: string[];
+	created_at: string;
+	finished_at: string | null;
+	total_chunks: number;
+	files: IngestionFileStatus[];
+}
+
+export interface UploadResponse {
+	message: string;
+	job_id: string;
+	status: string;
+	files: string[];
+	tags: string[];
+}
+
 /**
- * ファイルをアップロード
+ * ファイルをアップロード（取り込みジョブを登録）
  */
-export async function uploadFile(
-	file: File,
-	tags: string[] = []
-): Promise<{ message: string; chunks_created: number }> {
+export async function uploadFile(file: File, tags: string[] = []): Promise<UploadResponse> {
 	const formData = new FormData();
 	formData.append('files', file);
 	if (tags.length > 0) {
@@ -86,6 +143,36 @@ export async function uploadFile(
 	return response.json();
 }
 
+/**
+ * 取り込みジョブの進捗を取得
+ */
+export async function getIngestionJob(jobId: string): Promise<IngestionJob> {
+	const response = await fetch(`${API_BASE_URL}/jobs/${encodeURIComponent(jobId)}`);
+	if (!response.ok) {
+		throw new Error(`API Error: ${response.status} ${response.statusText}`);
+	}
+	return response.json();
+}
+
+/**
+ * 取り込みジョブの完了を待つ
+ * @param onProgress 進捗取得のたびに呼ばれるコールバック
+ */
+export async function waitForIngestionJob(
+	jobId: string,
+	onProgress?: (job: IngestionJob) => void,
+	intervalMs: number = 1000
+): Promise<IngestionJob> {
+	while (true) {
+		const job = await getIngestionJob(jobId);
+		onProgress?.(job);
+		if (job.status !== 'queued' && job.status !== 'running') {
+			return job;
+		}
+		await new Promise((resolve) => setTimeout(resolve, intervalMs));
+	}
+}
+
 /**
  * ドキュメントを削除
  */
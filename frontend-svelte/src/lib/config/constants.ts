@@ -8,7 +8,8 @@ export const ERROR_MESSAGES = {
 	GENERATION_STOPPED: '[生成が停止されました]',
 	DELETE_FAILED: '削除に失敗しました',
 	CLEAR_FAILED: 'データベースのクリアに失敗しました',
-	UNKNOWN_ERROR: '不明なエラー'
+	UNKNOWN_ERROR: '不明なエラー',
+	SERVER_BUSY: 'サーバーが混雑しています。しばらくしてから再度お試しください'
 } as const;
 
 export const SUPPORTED_FILE_TYPES = {
@@ -663,8 +663,15 @@ async function handleFileUpload(files, tags = '') {
         const data = await response.json();
 
         if (response.ok) {
+            // 取り込みはバックグラウンドで行われるため、ジョブの完了を待つ
+            const job = await waitForIngestionJob(data.job_id);
             const tagMsg = data.tags && data.tags.length > 0 ? `\nタグ: ${data.tags.join(', ')}` : '';
-            showNotification(`アップロード完了: ${data.files.join(', ')}${tagMsg}`, 'success');
+            if (job.status === 'completed') {
+                showNotification(`アップロード完了: ${data.files.join(', ')}${tagMsg}`, 'success');
+            } else {
+                const failed = job.files.filter(f => f.error).map(f => `${f.filename}: ${f.error}`);
+                showNotification(`取り込みエラー: ${failed.join(', ')}`, 'error');
+            }
             await loadDocuments();
             await loadTags();  // タグリストを再読み込み
         } else {
@@ -679,6 +686,21 @@ async function handleFileUpload(files, tags = '') {
     }
 }
 
+// 取り込みジョブの完了を待つ
+async function waitForIngestionJob(jobId, intervalMs = 1000) {
+    while (true) {
+        const response = await fetch(`${API_BASE_URL}/jobs/${jobId}`);
+        const job = await response.json();
+        if (!response.ok) {
+            throw new Error(job.detail || `API Error: ${response.status}`);
+        }
+        if (job.status !== 'queued' && job.status !== 'running') {
+            return job;
+        }
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+    }
+}
+
 // ドキュメント削除
 async function clearDocuments() {
     if (!confirm('すべてのドキュメントを削除しますか?')) return;
@@ -881,6 +903,11 @@ async function sendQuestion() {
                 if (line.startsWith('data: ')) {
                     const content = line.slice(6);
 
+                    // 生成の順番待ち（特別なマーカー、回答には含めない）
+                    if (content.startsWith('__QUEUE__:')) {
+                        continue;
+                    }
+
                     // 参照元情報をチェック（特別なマーカー）
                     if (content.includes('__SOURCES__:')) {
                         try {